@@ -5,7 +5,7 @@ import json
 if sys.version_info[0] < 3:
 	import thread
 else:
-	import _thread
+	import _thread as thread
 import threading
 
 class AbstractConnector():
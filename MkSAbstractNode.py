@@ -5,15 +5,23 @@ import json
 if sys.version_info[0] < 3:
 	import thread
 else:
-	import _thread
+	import _thread as thread
 import threading
-import socket, select
+import socket
+from collections import deque
 
 from flask import Flask, render_template, jsonify, Response, request
 #from flask_cors import CORS
 import logging
 
 from mksdk import MkSUtils
+from mksdk import MkSStream
+from mksdk import MkSSocketPoller
+from mksdk import MkSTimerScheduler
+from mksdk import MkSHandlerExecutor
+from mksdk import MkSPendingRequests
+from mksdk import MkSBinaryProtocol
+from mksdk import MkSLocalNodesCommands
 
 class EndpointAction(object):
 	def __init__(self, page, args):
@@ -57,10 +65,94 @@ class LocalNode():
 		self.LocalType 	= "UNKNOWN"
 		self.Status 	= "Stopped"
 		self.Obj 		= None
+		self.Stream 	= MkSStream.StreamReassembler()
+		self.Outbound 	= MkSStream.OutboundQueue()
+		self.Protocol 	= "text" # Format of frames we send ("text" or "binary")
 	
 	def SetNodeName(self, name):
 		self.Name = name
 
+class ConnectionRegistry():
+	"""All connections of a node with hash indexes by socket, UUID and (ip, port).
+
+	Indexes are updated under one lock on append, remove and when UUID or
+	address of a connection is changed, so lookups on every packet are O(1).
+	Iteration returns a snapshot, connections can be removed while iterating.
+	"""
+
+	def __init__(self):
+		self.BySocket 	= {}
+		self.ByUUID 	= {}
+		self.ByAddress 	= {}
+		self.Lock 		= threading.RLock()
+
+	def __iter__(self):
+		return iter(self.GetList())
+
+	def __len__(self):
+		return len(self.BySocket)
+
+	def GetList(self):
+		self.Lock.acquire()
+		try:
+			return list(self.BySocket.values())
+		finally:
+			self.Lock.release()
+
+	def Append(self, node):
+		self.Lock.acquire()
+		try:
+			self.BySocket[node.Socket] = node
+			if node.UUID:
+				self.ByUUID[node.UUID] = node
+			self.ByAddress[(node.IP, node.Port)] = node
+		finally:
+			self.Lock.release()
+
+	def Remove(self, node):
+		self.Lock.acquire()
+		try:
+			if self.BySocket.get(node.Socket) is node:
+				del self.BySocket[node.Socket]
+			# Index may point to a newer connection with same key.
+			if self.ByUUID.get(node.UUID) is node:
+				del self.ByUUID[node.UUID]
+			if self.ByAddress.get((node.IP, node.Port)) is node:
+				del self.ByAddress[(node.IP, node.Port)]
+		finally:
+			self.Lock.release()
+
+	def SetUUID(self, node, uuid):
+		self.Lock.acquire()
+		try:
+			if self.ByUUID.get(node.UUID) is node:
+				del self.ByUUID[node.UUID]
+			node.UUID = uuid
+			if uuid:
+				self.ByUUID[uuid] = node
+		finally:
+			self.Lock.release()
+
+	def SetAddress(self, node, ip, port):
+		self.Lock.acquire()
+		try:
+			if self.ByAddress.get((node.IP, node.Port)) is node:
+				del self.ByAddress[(node.IP, node.Port)]
+			node.IP 	= ip
+			node.Port 	= port
+			self.ByAddress[(ip, port)] = node
+		finally:
+			self.Lock.release()
+
+	def GetBySocket(self, sock):
+		return self.BySocket.get(sock)
+
+	def GetByUUID(self, uuid):
+		return self.ByUUID.get(uuid)
+
+	def GetByAddress(self, ip, port):
+		return self.ByAddress.get((ip, port))
+
 class AbstractNode():
 	def __init__(self):
 		self.Ticker 							= 0
@@ -86,19 +178,37 @@ class AbstractNode():
 		self.OnNewNodeCallback						= None
 		self.OnSlaveNodeDisconnectedCallback		= None
 		self.OnSlaveResponseCallback				= None
+		# Proxy packet relayed with payload as JSON text (direction, destination, source, command, payload, piggy)
+		self.OnSlaveRelayCallback 					= None
 		# Network
 		self.ServerSocket 							= None
 		self.ServerAdderss							= None
-		self.RecievingSockets						= []
-		self.SendingSockets							= []
-		self.Connections 							= []
+		self.Poller 								= MkSSocketPoller.SocketPoller()
+		self.Waker 									= MkSSocketPoller.Waker() # Wakes the loop from other threads
+		self.LoopCalls 								= deque() # (method, args) queued by other threads
+		self.LoopThread 							= None
+		self.SendingSockets							= set() # Sockets with pending outbound data
+		self.OverflowSockets						= set() # Sockets to drop, peer does not read
+		self.Connections 							= ConnectionRegistry()
 		self.OpenSocketsCounter						= 0
+		self.RecvChunkSize							= 65536
+		self.Commands 								= MkSLocalNodesCommands.LocalNodeCommands()
 		# Flags
 		self.LocalSocketServerRun					= False
 		self.IsListenerEnabled 						= False
+		self.UseBinaryProtocol 						= True # Ask for binary frames on connections we open, old peers don't answer and stay on text
+		self.AcceptBinaryProtocol 					= True
 		# State machine
 		self.States 								= None
 		self.CurrentState							= ''
+		# Timers
+		self.Timers 								= MkSTimerScheduler.TimerScheduler()
+		self.StateTimers 							= {} # State -> [(interval, callback)]
+		self.ActiveStateTimers 						= []
+		self.StateTickInterval 						= 0.5
+		# Requests waiting for response (request_id -> future), timeouts on node timers
+		self.PendingRequests 						= MkSPendingRequests.PendingRequests(self.Timers)
+		self.MaxPollTimeout 						= 1
 		self.Pwd									= os.getcwd()
 		# Locks and Events
 		self.ExitLocalServerEvent					= threading.Event()
@@ -107,12 +217,28 @@ class AbstractNode():
 		# Handlers
 		self.ServerNodeRequestHandlers				= {
 			'get_node_info': 						self.GetNodeInfoRequestHandler,
-			'get_node_status': 						self.GetNodeStatusRequestHandler
+			'get_node_status': 						self.GetNodeStatusRequestHandler,
+			'protocol_negotiate': 					self.ProtocolNegotiateRequestHandler
 		}
 		self.ServerNodeResponseHandlers				= {
 			'get_node_info': 						self.GetNodeInfoResponseHandler,
-			'get_node_status': 						self.GetNodeStatusResponseHandler
+			'get_node_status': 						self.GetNodeStatusResponseHandler,
+			'protocol_negotiate': 					self.ProtocolNegotiateResponseHandler
 		}
+		# Dispatch table for local socket packets, (direction, command) -> handler(sock, packet).
+		# Packets not in the table go to default handler of their direction.
+		self.DispatchTable 							= {}
+		self.DispatchDefaults 						= {}
+		self.ScheduleCoroutine 						= None
+		# Called with text frames before decoding, returns True if frame was handled.
+		self.RawFrameHandler 						= None
+		# Slow handlers (direction, command) run in executor, off the socket loop,
+		# when it is enabled with SetHandlerExecutor().
+		self.SlowHandlers 							= set()
+		self.Executor 								= None
+		self.RegisterDispatchHandlers(["request", "proxy_request"], self.ServerNodeRequestHandlers)
+		self.RegisterDispatchHandlers(["response"], self.ServerNodeResponseHandlers)
+		self.SetDispatchDefault(["request", "response", "proxy_request", "proxy_response"], self.HandlerRouter)
 		# LocalFace UI
 		self.UI 									= None
 		self.LocalWebPort							= ""
@@ -157,16 +283,75 @@ class AbstractNode():
 	def ExitRoutine(self):
 		pass
 
+	# Old nodes do not answer, so connection stays on text frames.
+	def NegotiateProtocol(self, sock):
+		if self.UseBinaryProtocol is True:
+			self.SendData(sock, self.Commands.ProtocolNegotiateRequest(["binary", "text"]))
+
+	def ProtocolNegotiateRequestHandler(self, sock, packet):
+		protocol = "text"
+		if self.AcceptBinaryProtocol is True and "binary" in packet.get("protocols", []):
+			protocol = "binary"
+		# Response is sent in current format, we switch after it.
+		self.SendData(sock, self.Commands.ProtocolNegotiateResponse(protocol))
+		conn = self.GetConnection(sock)
+		if conn is not None:
+			conn.Protocol = protocol
+
+	def ProtocolNegotiateResponseHandler(self, sock, packet):
+		conn = self.GetConnection(sock)
+		if conn is not None:
+			conn.Protocol = packet["protocol"]
+
 	def SetSates (self, states):
 		self.States = states
 
 	def ChangeState(self, state):
+		if state != self.CurrentState:
+			# Timers of previous state are not relevant anymore.
+			for timer_id in self.ActiveStateTimers:
+				self.Timers.RemoveTimer(timer_id)
+			self.ActiveStateTimers = []
+			for interval, callback in self.StateTimers.get(state, []):
+				self.ActiveStateTimers.append(self.Timers.AddTimer(interval, callback))
 		self.CurrentState = state
 
-	# Overload
-	def HandlerRouter(self, sock, data):
+	# Call callback every interval seconds while node is in this state.
+	def RegisterStateTimer(self, state, interval, callback):
+		if state not in self.StateTimers:
+			self.StateTimers[state] = []
+		self.StateTimers[state].append((interval, callback))
+		if state == self.CurrentState:
+			self.ActiveStateTimers.append(self.Timers.AddTimer(interval, callback))
+
+	# Overload - Called with decoded packet when no handler registered for it.
+	def HandlerRouter(self, sock, packet):
 		pass
 
+	# Handlers registered first win, so AbstractNode protocol handlers
+	# (get_node_info, get_node_status) are not overridden by node handlers.
+	def RegisterDispatchHandlers(self, directions, handlers):
+		for direction in directions:
+			for command in handlers:
+				key = (direction, command)
+				if key not in self.DispatchTable:
+					self.DispatchTable[key] = handlers[command]
+
+	def SetDispatchDefault(self, directions, handler):
+		for direction in directions:
+			self.DispatchDefaults[direction] = handler
+
+	# Opt in handlers of these commands to run in the handler executor.
+	def SetSlowHandlers(self, directions, commands):
+		for direction in directions:
+			for command in commands:
+				self.SlowHandlers.add((direction, command))
+
+	def SetHandlerExecutor(self, workers=4, process_workers=0):
+		if self.Executor is not None:
+			self.Executor.Stop()
+		self.Executor = MkSHandlerExecutor.HandlerExecutor(workers, process_workers)
+
 	# Overload
 	def NodeConnectHandler(self, conn, addr):
 		pass
@@ -225,7 +410,7 @@ class AbstractNode():
 		if "ykiveish" in key:
 			response = "{\"response\":\"OK\",\"payload\":{\"list\":["
 			for idx, item in enumerate(self.Connections):
-				response += "{\"local_type\":\"" + str(item.LocalType) + "\",\"uuid\":\"" + str(item.UUID) + "\",\"ip\":\"" + str(item.IP) + "\",\"port\":" + str(item.Port) + ",\"type\":\"" + str(item.Type) + "\"},"
+				response += "{\"local_type\":\"" + str(item.LocalType) + "\",\"uuid\":\"" + str(item.UUID) + "\",\"ip\":\"" + str(item.IP) + "\",\"port\":" + str(item.Port) + ",\"type\":\"" + str(item.Type) + "\",\"queue\":" + str(item.Outbound.GetQueueDepth()) + "},"
 			response = response[:-1] + "]}}"
 			return jsonify(response)
 		else:
@@ -238,11 +423,11 @@ class AbstractNode():
 		method()
 
 	def AppendConnection(self, sock, ip, port):
-		# Append to recieving data sockets.
-		self.RecievingSockets.append(sock)
+		# Register once for read events.
+		self.Poller.Register(sock)
 		# Append to list of all connections.
 		node = LocalNode(ip, port, "", "", sock)
-		self.Connections.append(node)
+		self.Connections.Append(node)
 		# Increment socket counter.
 		self.OpenSocketsCounter += self.OpenSocketsCounter
 		return node
@@ -250,48 +435,52 @@ class AbstractNode():
 	def RemoveConnection(self, sock):
 		conn = self.GetConnection(sock)
 		if None is not conn:
-			# Remove socket from list.
-			self.RecievingSockets.remove(conn.Socket)
+			self.SendingSockets.discard(conn.Socket)
+			conn.Outbound.Clear()
+			# Stop polling socket (before it is closed).
+			if conn.Socket is not None:
+				self.Poller.Unregister(conn.Socket)
 			# Close connection.
 			if conn.Socket is not None:
 				conn.Socket.close()
 			# Remove LocalNode from the list.
-			self.Connections.remove(conn)
+			self.Connections.Remove(conn)
+			self.PendingRequests.FailSocket(sock)
 			# Deduce socket counter.
 			self.OpenSocketsCounter -= self.OpenSocketsCounter
 
 	def GetConnection(self, sock):
-		for conn in self.Connections:
-			if conn.Socket == sock:
-				return conn
-		return None
+		return self.Connections.GetBySocket(sock)
 
 	def GetNodeByUUID(self, uuid):
-		for conn in self.Connections:
-			if conn.UUID == uuid:
-				return conn
-		return None
+		return self.Connections.GetByUUID(uuid)
 
 	def GetNode(self, ip, port):
-		for conn in self.Connections:
-			if conn.IP == ip and conn.Port == port:
-				return conn
-		return None
+		return self.Connections.GetByAddress(ip, port)
+
+	def SetConnectionUUID(self, conn, uuid):
+		self.Connections.SetUUID(conn, uuid)
+
+	def SetConnectionAddress(self, conn, ip, port):
+		self.Connections.SetAddress(conn, ip, port)
 
 	def TryStartListener(self):
 		try:
 			print ("[AbstractNode] Start listener...")
 			self.ServerSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 			self.ServerSocket.setblocking(0)
+			if os.name != "nt":
+				# Restarted node binds while connections of the old one are in TIME_WAIT.
+				self.ServerSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
 			self.ServerSocket.bind(self.ServerAdderss)
 			# [socket, ip_address, port]
 			node = self.AppendConnection(self.ServerSocket, self.MyLocalIP, self.ServerAdderss[1])
 			node.LocalType 	= "LISTENER"
-			node.UUID 		= self.UUID
 			node.Type 		= self.Type
+			self.SetConnectionUUID(node, self.UUID)
 
-			self.ServerSocket.listen(32)
+			self.ServerSocket.listen(socket.SOMAXCONN)
 			self.LocalSocketServerRun = True
 
 			# Run preloader for UI interface
@@ -316,37 +505,37 @@ class AbstractNode():
 			print ("[Server Node] Failed to open listener, ", str(self.ServerAdderss[1]), e)
 			return False
 
-	def DataSocketInputHandler_Response(self, sock, json_data):
-		print ("[AbstractNode] DataSocketInputHandler_Response")
-		command = json_data['command']
-		if command in self.ServerNodeResponseHandlers:
-			self.ServerNodeResponseHandlers[command](sock, json_data)
+	def DispatchPacket(self, sock, packet):
+		direction = packet['direction']
+		if direction in ("response", "proxy_response") and packet.get('request_id'):
+			# Complete the future, callbacks of the command are still called.
+			self.PendingRequests.Resolve(sock, packet['request_id'], packet)
+		handler = self.DispatchTable.get((direction, packet['command']))
+		if handler is None:
+			handler = self.DispatchDefaults.get(direction)
+		if handler is not None:
+			if self.Executor is not None and (direction, packet['command']) in self.SlowHandlers:
+				# Ordered per connection, other connections are not delayed.
+				self.Executor.Submit(sock, self.CallHandler, (handler, sock, packet))
+			else:
+				self.CallHandler(handler, sock, packet)
 
-	def DataSocketInputHandler_Resquest(self, sock, json_data):
-		print ("[AbstractNode] DataSocketInputHandler_Resquest")
-		command = json_data['command']
-		if command in self.ServerNodeRequestHandlers:
-			self.ServerNodeRequestHandlers[command](sock, json_data)
+	def CallHandler(self, handler, sock, packet):
+		result = handler(sock, packet)
+		if result is not None and self.ScheduleCoroutine is not None:
+			# Coroutine handler (asyncio transport).
+			self.ScheduleCoroutine(result)
 
 	def DataSocketInputHandler(self, sock, data):
 		try:
-			jsonData 	= json.loads(data)
-			command 	= jsonData['command']
-			direction 	= jsonData['direction']
-
-			if command in ["get_node_info", "get_node_status"]:
-				print ("[AbstractNode] ['get_node_info', 'get_node_status']")
-				if direction in ["response", "proxy_response"]:
-					if (direction in "proxy_response"):
-						self.HandlerRouter(sock, data)
-					else:
-						self.DataSocketInputHandler_Response(sock, jsonData)
-				elif direction in ["request", "proxy_request"]:
-					self.DataSocketInputHandler_Resquest(sock, jsonData)
+			# The only place a local packet is decoded.
+			if MkSBinaryProtocol.IsBinaryFrame(data) is True:
+				packet = MkSBinaryProtocol.DecodeFrame(data)
 			else:
-				print ("[AbstractNode] HandlerRouter")
-				# Call for handler.
-				self.HandlerRouter(sock, data)
+				if self.RawFrameHandler is not None and self.RawFrameHandler(sock, data) is True:
+					return
+				packet = json.loads(data)
+			self.DispatchPacket(sock, packet)
 		except Exception as e:
 			print ("[AbstractNode] DataSocketInputHandler ERROR", e, data)
 
@@ -355,6 +544,8 @@ class AbstractNode():
 		sock.settimeout(5)
 		try:
 			sock.connect(ip_addr_port)
+			# Writes are queued by SendData, socket must never block the loop.
+			sock.setblocking(0)
 			return sock, True
 		except:
 			print ("[AbstractNode] Could not connect server", ip_addr_port)
@@ -395,69 +586,213 @@ class AbstractNode():
 		if self.OnLocalServerStartedCallback is not None:
 			self.OnLocalServerStartedCallback()
 
-		while self.LocalSocketServerRun is True:
-			self.TickState()
+		# State machine runs on real time, not per socket event.
+		tickTimer = self.Timers.AddTimer(self.StateTickInterval, self.TickState, delay=0)
+		self.LoopThread = threading.current_thread()
+		self.Poller.Register(self.Waker)
+		self.Timers.SetWakeup(self.Waker.Notify)
 
+		while self.LocalSocketServerRun is True:
 			try:
-				readable, writable, exceptional = select.select(self.RecievingSockets, self.SendingSockets, self.RecievingSockets, 0.5)
-
-				# Socket management.
-				for sock in readable:
-					if sock is self.ServerSocket and True == self.IsListenerEnabled:
-						conn, addr = sock.accept()
-						conn.setblocking(0)
-						self.AppendConnection(conn, addr[0], addr[1])
-						self.NodeConnectHandler(conn, addr)
-
-						# Raise event for user
-						if self.OnAceptNewConnectionCallback is not None:
-							self.OnAceptNewConnectionCallback(conn)
-					else:
-						try:
-							if sock is not None:
-								data = sock.recv(2048)
-								dataLen = len(data)
-								while dataLen == 2048:
-									chunk = sock.recv(2048)
-									data += chunk
-									dataLen = len(chunk)
-						except Exception as e:
-							print ("[AbstractNode] Recieve ERROR", e)
-							self.NodeDisconnectHandler(sock)
-							self.RemoveConnection(sock)
-						else:
-							if data:
-								# Each makesense packet should start from magic number "MKS"
-								if "MKS" in data[:3]:
-									# One packet can hold multiple MKS messages.
-									multiData = data.split("MKS: ")
-									for data in multiData[1:]:
-										req = (data.split('\n'))[1]
-										self.DataSocketInputHandler(sock, req)
-								else:
-									print ("[AbstractNode] Data Invalid")
-							else:
-								self.NodeDisconnectHandler(sock)
-								# Raise event for user
-								if self.OnTerminateConnectionCallback is not None:
-									self.OnTerminateConnectionCallback(sock)
-								self.RemoveConnection(sock)
-
-				for sock in exceptional:
-					print ("[AbstractNode] Socket Exceptional")
+				# Sleep till next timer or socket event.
+				readable, writable = self.Poller.Poll(self.Timers.GetTimeout(self.MaxPollTimeout))
+				self.SocketEventsHandler(readable, writable)
 			except Exception as e:
 				print ("[AbstractNode] Connection Close [ERROR]", e)
 
+			self.Timers.RunExpired()
+
+		self.Timers.RemoveTimer(tickTimer)
+		self.Poller.Unregister(self.Waker)
+		if self.Executor is not None:
+			self.Executor.Stop()
 		# Clean all resorses before exit.
 		self.CleanAllSockets()
 		print ("[AbstractNode] Exit execution thread")
 		self.ExitLocalServerEvent.set()
 
+	# Socket management (only sockets with pending events).
+	def SocketEventsHandler(self, readable, writable):
+		for sock in writable:
+			if self.Poller.IsRegistered(sock) is True:
+				self.SocketWriteHandler(sock)
+		for sock in readable:
+			if self.Poller.IsRegistered(sock) is False:
+				# Removed by a previous handler in this iteration.
+				continue
+			if sock is self.Waker:
+				self.Waker.Drain()
+				self.RunLoopCalls()
+				continue
+			if sock is self.ServerSocket and True == self.IsListenerEnabled:
+				self.AcceptConnectionHandler(sock)
+			else:
+				self.SocketReadHandler(sock)
+
+	# Run method(*args) on the loop thread, connections and the poller are only
+	# changed there. AsyncNodeRunner replaces it with call_soon_threadsafe.
+	def CallInLoop(self, method, *args):
+		self.LoopCalls.append((method, args))
+		self.Waker.Notify()
+
+	def RunLoopCalls(self):
+		while self.LoopCalls:
+			method, args = self.LoopCalls.popleft()
+			try:
+				method(*args)
+			except Exception as e:
+				print ("[AbstractNode] Loop call ERROR", e)
+
+	def IsLoopThread(self):
+		return self.LoopThread is None or threading.current_thread() is self.LoopThread
+
+	def AcceptConnectionHandler(self, sock):
+		conn, addr = sock.accept()
+		conn.setblocking(0)
+		self.AppendConnection(conn, addr[0], addr[1])
+		self.NodeConnectHandler(conn, addr)
+
+		# Raise event for user
+		if self.OnAceptNewConnectionCallback is not None:
+			self.OnAceptNewConnectionCallback(conn)
+
+	def SocketReadHandler(self, sock):
+		try:
+			data = sock.recv(self.RecvChunkSize)
+		except Exception as e:
+			print ("[AbstractNode] Recieve ERROR", e)
+			self.NodeDisconnectHandler(sock)
+			self.RemoveConnection(sock)
+			return
+
+		if data:
+			conn = self.GetConnection(sock)
+			if conn is not None:
+				# One recv can hold a part of a packet or multiple MKS packets.
+				conn.Stream.Feed(data)
+				for frame in conn.Stream.GetFrames():
+					self.DataSocketInputHandler(sock, frame)
+		else:
+			self.NodeDisconnectHandler(sock)
+			# Raise event for user
+			if self.OnTerminateConnectionCallback is not None:
+				self.OnTerminateConnectionCallback(sock)
+			self.RemoveConnection(sock)
+
+	def SocketWriteHandler(self, sock):
+		conn = self.GetConnection(sock)
+		if conn is None:
+			return
+		if conn.Outbound.IsOverflow is True:
+			self.OverflowHandler(sock)
+			return
+		self.FlushConnection(conn)
+
+	def OverflowHandler(self, sock):
+		self.OverflowSockets.discard(sock)
+		conn = self.GetConnection(sock)
+		if conn is None:
+			return
+		print ("[AbstractNode] Outbound queue overflow, closing connection", conn.IP, conn.Port)
+		self.NodeDisconnectHandler(sock)
+		self.RemoveConnection(sock)
+
+	def FlushConnection(self, conn):
+		try:
+			conn.Outbound.Flush(conn.Socket)
+		except Exception as e:
+			# Connection is broken, read handler will clean it up.
+			print ("[AbstractNode] Send ERROR", e)
+			conn.Outbound.Clear()
+		self.UpdateSocketEvents(conn)
+
+	def UpdateSocketEvents(self, conn):
+		if conn.Outbound.IsOverflow is True and conn.Socket not in self.OverflowSockets:
+			# Peer does not read, its socket may never be writable again. Dropped
+			# by the loop once the running handlers are done.
+			sock = conn.Socket
+			self.OverflowSockets.add(sock)
+			self.Timers.AddTimer(0, lambda: self.OverflowHandler(sock), repeat=False)
+		pending = conn.Outbound.IsEmpty() is False
+		if pending is True:
+			self.SendingSockets.add(conn.Socket)
+		else:
+			self.SendingSockets.discard(conn.Socket)
+		# Congested connection is still read, the peer may be waiting for our
+		# reply to drain its own queue.
+		self.Poller.Modify(conn.Socket, True, pending)
+
+	# Queue data (bytes or list of frame segments) on connection and write what
+	# socket accepts right now (never blocks). Called from another thread (handler
+	# executor) the send is passed to the loop and True means queued for it.
+	def SendData(self, sock, data):
+		if self.IsLoopThread() is False:
+			self.CallInLoop(self.SendData, sock, data)
+			return True
+		conn = self.GetConnection(sock)
+		if conn is None or conn.Socket is None:
+			print ("[AbstractNode] SendData ERROR, no connection")
+			return False
+		if conn.Protocol == "binary":
+			data = MkSBinaryProtocol.TextToBinary(data)
+		if conn.Outbound.Push(data) is False:
+			print ("[AbstractNode] Outbound queue overflow", conn.IP, conn.Port)
+			self.UpdateSocketEvents(conn)
+			return False
+		self.FlushConnection(conn)
+		return True
+
+	# Queue one frame on all connections (except listener and exclude sockets).
+	# Frame is encoded once per protocol and the same buffer is queued on every
+	# connection, the loop writes it when sockets are writable.
+	def Broadcast(self, data, exclude=None):
+		frames 	= {}
+		count 	= 0
+		for conn in self.Connections:
+			if conn.Socket is None or conn.Socket is self.ServerSocket:
+				continue
+			if exclude is not None and conn.Socket in exclude:
+				continue
+			frame = frames.get(conn.Protocol)
+			if frame is None:
+				frame = data
+				if conn.Protocol == "binary":
+					frame = MkSBinaryProtocol.TextToBinary(data)
+				frames[conn.Protocol] = frame
+			if conn.Outbound.Push(frame) is False:
+				print ("[AbstractNode] Outbound queue overflow", conn.IP, conn.Port)
+			else:
+				count += 1
+			self.UpdateSocketEvents(conn)
+		return count
+
+	# Send a request built with request.ID, request future is failed if it can't be queued.
+	def SendRequest(self, sock, request, data):
+		if self.SendData(sock, data) is False:
+			self.PendingRequests.Cancel(request.ID, "send failed")
+		return request
+
+	# Queue of sock is above its high watermark (until it drains below the low
+	# one). Traffic that can be dropped, like relayed proxy requests, is not
+	# queued on it.
+	def IsCongested(self, sock):
+		conn = self.GetConnection(sock)
+		if conn is None:
+			return False
+		return conn.Outbound.IsCongested
+
+	def GetQueueDepth(self, sock):
+		conn = self.GetConnection(sock)
+		if conn is None:
+			return 0
+		return conn.Outbound.GetQueueDepth()
+
 	def ConnectNode(self, ip, port):
 		sock, status = self.ConnectNodeSocket((ip, port))
 		if True == status:
 			node = self.AppendConnection(sock, ip, port)
 			node.LocalType = "NODE"
+			self.NegotiateProtocol(sock)
 		return sock, status
 
 	def ConnectMaster(self, ip):
@@ -465,8 +800,20 @@ class AbstractNode():
 		if status is True:
 			node = self.AppendConnection(sock, ip, 16999)
 			node.LocalType = "MASTER"
+			self.NegotiateProtocol(sock)
 		return sock, status
 
+	# States connect and search masters through StartConnectMaster() and
+	# StartFindMasters(), done gets what ConnectMaster() (sock, status) and
+	# FindMasters() (count) return. AsyncNodeRunner replaces both with
+	# versions that don't block its loop and call done in the loop.
+	def StartConnectMaster(self, ip, done):
+		sock, status = self.ConnectMaster(ip)
+		done(sock, status)
+
+	def StartFindMasters(self, done):
+		done(self.FindMasters())
+
 	def FindMasters(self):
 		# Let user know master search started.
 		if self.OnMasterSearchCallback is not None:
@@ -480,6 +827,7 @@ class AbstractNode():
 				if True == status:
 					node = self.AppendConnection(sock, ip, 16999)
 					node.LocalType = "MASTER"
+					self.NegotiateProtocol(sock)
 					# Raise event
 					if self.OnMasterFoundCallback is not None:
 						self.OnMasterFoundCallback([sock, ip])
@@ -492,6 +840,7 @@ class AbstractNode():
 		return len(ips)
 
 	def CleanAllSockets(self):
+		# Iteration is over a snapshot, safe to remove.
 		for conn in self.Connections:
 			self.RemoveConnection(conn.Socket)
 		
@@ -6,12 +6,14 @@ import time
 if sys.version_info[0] < 3:
 	import thread
 else:
-	import _thread
+	import _thread as thread
 import threading
 import socket
+from collections import OrderedDict
 
 from mksdk import MkSAbstractNode
 from mksdk import MkSLocalNodesCommands
+from mksdk import MkSMessages
 
 class ApplicationNode(MkSAbstractNode.AbstractNode):
 	def __init__(self, master_ip_list):
@@ -19,6 +21,8 @@ class ApplicationNode(MkSAbstractNode.AbstractNode):
 		self.Commands 								= MkSLocalNodesCommands.LocalNodeCommands()
 		self.MasterStaticIPList 					= master_ip_list
 		self.MasterNodesList						= []
+		self.TopologyVersions 						= {} # Master socket -> last topology version
+		self.MasterTopologies 						= {} # Subscribed master socket -> OrderedDict of UUID -> NodeItem
 		# Sates
 		self.States = {
 			'IDLE': 								self.StateIdle,
@@ -31,9 +35,13 @@ class ApplicationNode(MkSAbstractNode.AbstractNode):
 			'get_master_info': 						self.GetMasterInfoResponseHandler,
 			'master_append_node':					self.MasterAppendNodeResponseHandler,
 			'master_remove_node':					self.MasterRemoveNodeResponseHandler,
+			'master_nodes_delta':					self.MasterNodesDeltaResponseHandler,
+			'topology_subscribe':					self.TopologySubscribeResponseHandler,
 			'get_sensor_info': 						self.GetSensorInfoResponseHandler,
 			'undefined':							self.UndefindHandler
 		}
+		# Dispatch (packet is decoded once by AbstractNode)
+		self.RegisterDispatchHandlers(["response"], self.ResponseHandlers)
 		# Callbacks
 		self.LocalServerDataArrivedCallback			= None
 		self.OnGetLocalNodesResponeCallback 		= None
@@ -43,121 +51,178 @@ class ApplicationNode(MkSAbstractNode.AbstractNode):
 		self.OnGetSensorInfoResponseCallback 		= None
 		# Flags
 		self.SearchDontClean 						= False
-		self.MasterNodeLocatorRunning				= False
+		self.IsSearchingMasters 					= False
+		self.MasterNodeLocatorTimer 				= None
 		self.IsListenerEnabled 						= False
+		self.IsTopologySubscribeEnabled 			= True # Masters push topology changes, no polling
 		# Const
 		self.SEARCH_MASTER_INTERVAL 				= 60
+		self.SEARCH_MASTERS_RETRY_INTERVAL 			= 10
+		self.GET_LOCAL_NODES_INTERVAL 				= 20
+		# Timers (real time, independent of socket traffic)
+		self.RegisterStateTimer("SEARCH_MASTERS", self.SEARCH_MASTERS_RETRY_INTERVAL, self.SearchMastersTimerHandler)
+		self.RegisterStateTimer("WORKING", self.GET_LOCAL_NODES_INTERVAL, self.GetLocalNodesTimerHandler)
 
 		self.ChangeState("IDLE")
 
-	def GetLocalNodeResponseHandler(self, json_data):
+	def GetLocalNodeResponseHandler(self, sock, json_data):
+		message = MkSMessages.LocalNodesResponse.FromPacket(json_data)
+		if isinstance(message, MkSMessages.TopologyNotModified):
+			# Nodes list we have is current.
+			return
+		self.TopologyVersions[sock] = message.Version
 		# Get connection and change local type
 		if self.OnGetLocalNodesResponeCallback is not None:
 			nodes = json_data['nodes']
 			self.OnGetLocalNodesResponeCallback(nodes)
 
-	def GetMasterInfoResponseHandler(self, data):
+	def GetMasterInfoResponseHandler(self, sock, data):
+		if data.get("not_modified") is True:
+			return
 		# Get connection and change local type
 		if self.OnGetMasterInfoResponseCallback is not None:
 			self.OnGetMasterInfoResponseCallback(data)
 
-	def MasterAppendNodeResponseHandler(self, json_data):
+	# Snapshot of a subscribed master, its joins and leaves are applied to it.
+	def TopologySubscribeResponseHandler(self, sock, json_data):
+		message 	= MkSMessages.TopologySubscribeResponse.FromPacket(json_data)
+		topology 	= OrderedDict()
+		for node in message.Nodes:
+			topology[node.UUID] = node
+		self.MasterTopologies[sock] = topology
+		self.TopologyVersions[sock] = message.Version
+		if self.OnGetLocalNodesResponeCallback is not None:
+			self.OnGetLocalNodesResponeCallback(json_data['nodes'])
+
+	def MasterAppendNodeResponseHandler(self, sock, json_data):
+		topology = self.MasterTopologies.get(sock)
+		if topology is not None:
+			node = MkSMessages.NodeItem.FromPacket(json_data['node'])
+			topology[node.UUID] = node
 		# Get connection and change local type
 		if self.OnMasterAppendNodeResponseCallback is not None:
 			node = json_data['node']
 			self.OnMasterAppendNodeResponseCallback(node)
 
-	def MasterRemoveNodeResponseHandler(self, data):
+	def MasterRemoveNodeResponseHandler(self, sock, data):
+		topology = self.MasterTopologies.get(sock)
+		if topology is not None:
+			topology.pop(data['node']['uuid'], None)
 		if self.OnMasterRemoveNodeResponseCallback is not None:
 			self.OnMasterRemoveNodeResponseCallback(data)
 
-	def GetSensorInfoResponseHandler(self, data):
+	# Merged joins and leaves, passed to the single event handlers.
+	def MasterNodesDeltaResponseHandler(self, sock, data):
+		for event in MkSMessages.NodesDelta.FromPacket(data).GetEvents():
+			packet = { 'command': event.Command, 'direction': 'response', 'node': event.Node.ToDict() }
+			if "master_append_node" == event.Command:
+				self.MasterAppendNodeResponseHandler(sock, packet)
+			else:
+				self.MasterRemoveNodeResponseHandler(sock, packet)
+
+	def GetSensorInfoResponseHandler(self, sock, data):
 		if self.OnGetSensorInfoResponseCallback is not None:
 			self.OnGetSensorInfoResponseCallback(data)
 
-	def UndefindHandler(self, data, sock):
+	def UndefindHandler(self, sock, data):
 		if None is not self.LocalServerDataArrivedCallback:
 			self.LocalServerDataArrivedCallback(data, sock)
 
-	def SearchForMasters(self):
+	# Search is done by StartFindMasters(), done(count) is called when it ends.
+	def SearchForMasters(self, done=None):
+		if self.IsSearchingMasters is True:
+			return
 		# Clean master nodes list.
 		if False == self.SearchDontClean:
 			self.CleanMasterList()
+		self.IsSearchingMasters = True
 		# Find all master nodes on the network.
-		return self.FindMasters()
+		self.StartFindMasters(lambda count: self.SearchForMastersDone(count, done))
+
+	def SearchForMastersDone(self, count, done):
+		self.IsSearchingMasters = False
+		if done is not None:
+			done(count)
+
+	def ConnectStaticMasters(self):
+		for ip in self.MasterStaticIPList:
+			self.StartConnectMaster(ip, lambda sock, status, ip=ip: self.StaticMasterConnectedHandler(sock, status, ip))
+
+	def StaticMasterConnectedHandler(self, sock, status, ip):
+		if status is True:
+			self.NodeMasterAvailable(sock)
+			if self.OnMasterFoundCallback is not None:
+				self.OnMasterFoundCallback([sock, ip])
 
 	def StateIdle(self):
 		if self.MasterStaticIPList is None:
-			ret = self.SearchForMasters()
-			if ret > 0:
-				self.ChangeState("WORKING")
-				thread.start_new_thread(self.MasterNodeLocator, ())
-			else:
-				self.ChangeState("SEARCH_MASTERS")
-				self.SearchDontClean = False
+			self.SearchForMasters(self.IdleSearchDoneHandler)
 		else:
-			for ip in self.MasterStaticIPList:
-				sock, status = self.ConnectMaster(ip)
-				if status is True:
-					self.NodeMasterAvailable(sock)
-					if self.OnMasterFoundCallback is not None:
-						self.OnMasterFoundCallback([sock, ip])
+			self.ConnectStaticMasters()
+			self.ChangeState("WORKING")
+
+	def IdleSearchDoneHandler(self, count):
+		if count > 0:
 			self.ChangeState("WORKING")
+			self.StartMasterNodeLocator()
+		else:
+			self.ChangeState("SEARCH_MASTERS")
+			self.SearchDontClean = False
 
 	def StateSearchMasters(self):
-		if 0 == self.Ticker % 20:
-			if self.MasterStaticIPList is None:
-				ret = self.SearchForMasters()
-				if ret > 0:
-					self.ChangeState("WORKING")
-			else:
-				for ip in self.MasterStaticIPList:
-					sock, status = self.ConnectMaster(ip)
-					if status is True:
-						self.NodeMasterAvailable(sock)
-						if self.OnMasterFoundCallback is not None:
-							self.OnMasterFoundCallback([sock, ip])
-				self.ChangeState("WORKING")
+		pass
+
+	def SearchMastersTimerHandler(self):
+		if self.MasterStaticIPList is None:
+			self.SearchForMasters(self.RetrySearchDoneHandler)
+		else:
+			self.ConnectStaticMasters()
+			self.ChangeState("WORKING")
+
+	def RetrySearchDoneHandler(self, count):
+		if count > 0:
+			self.ChangeState("WORKING")
 
 	def StateWorking(self):
-		if 0 == self.Ticker % 40:
-			# Check for master list.
-			if not self.MasterNodesList:
-				# Master list is empty
-				self.ChangeState("SEARCH_MASTERS")
-				self.SearchDontClean = False
-				self.StopMasterNodeLocator()
-
-			payload = self.Commands.GetLocalNodesRequest()
-			for item in self.MasterNodesList:
-				item.Socket.send(payload)
+		pass
 
+	def GetLocalNodesTimerHandler(self):
+		# Check for master list.
+		if not self.MasterNodesList:
+			# Master list is empty
+			self.ChangeState("SEARCH_MASTERS")
+			self.SearchDontClean = False
+			self.StopMasterNodeLocator()
+
+		# Masters answer not_modified when the version we have is current.
+		for item in self.MasterNodesList:
+			if item.Socket in self.MasterTopologies:
+				# Subscribed, changes are pushed.
+				continue
+			payload = self.Commands.GetLocalNodesRequest(self.TopologyVersions.get(item.Socket) or None)
+			self.SendData(item.Socket, payload)
+
+	# Search runs on the loop thread, connections and the master list are only
+	# changed there.
 	def StartMasterNodeLocator(self):
-		self.MasterNodeLocatorRunning = True
+		if self.MasterNodeLocatorTimer is not None:
+			return
+		self.SearchDontClean 		= True
+		self.MasterNodeLocatorTimer = self.Timers.AddTimer(self.SEARCH_MASTER_INTERVAL, self.MasterNodeLocatorTimerHandler)
 
 	def StopMasterNodeLocator(self):
-		self.MasterNodeLocatorRunning = False
-
-	def MasterNodeLocator(self):
-		self.StartMasterNodeLocator()
-		self.SearchDontClean = True
-		while True == self.MasterNodeLocatorRunning:
-			# Rest for several seconds.
-			time.sleep(self.SEARCH_MASTER_INTERVAL)
-			print ("[Node] MasterNodeLocator WORKING")
-			# Search network.
-			self.SearchForMasters()
-
-	def HandlerRouter(self, sock, data):
-		jsonData 	= json.loads(data)
-		command 	= jsonData['command']
-		direction 	= jsonData['direction']
-
-		if command in self.ResponseHandlers:
-			if "response" == direction:
-				self.ResponseHandlers[command](jsonData)
+		if self.MasterNodeLocatorTimer is not None:
+			self.Timers.RemoveTimer(self.MasterNodeLocatorTimer)
+			self.MasterNodeLocatorTimer = None
+
+	def MasterNodeLocatorTimerHandler(self):
+		print ("[Node] MasterNodeLocator WORKING")
+		# Search network.
+		self.SearchForMasters()
 
 	def NodeDisconnectHandler(self, sock):
+		self.TopologyVersions.pop(sock, None)
+		self.MasterTopologies.pop(sock, None)
 		# Check if disconneced connection is a master.
 		for node in self.MasterNodesList:
 			if sock == node.Socket:
@@ -170,27 +235,35 @@ class ApplicationNode(MkSAbstractNode.AbstractNode):
 		conn = self.GetConnection(sock)
 		# TODO - Check if we don't have this connection already
 		self.MasterNodesList.append(conn)
-		# Get Master slave nodes.
-		packet = self.Commands.GetLocalNodesRequest()
-		sock.send(packet)
+		# Get Master slave nodes, subscribed masters push their changes.
+		if self.IsTopologySubscribeEnabled is True:
+			packet = self.Commands.TopologySubscribeRequest()
+		else:
+			packet = self.Commands.GetLocalNodesRequest()
+		self.SendData(sock, packet)
 	
 	def CleanMasterList(self):
 		for node in self.MasterNodesList:
 			self.RemoveConnection(node.Socket)
-		self.MasterNodesList = []
+		self.MasterNodesList 	= []
+		self.TopologyVersions 	= {}
+		self.MasterTopologies 	= {}
 
 	def GetMasters(self):
 		return self.MasterNodesList
 
+	# Nodes of subscribed masters (list of MkSMessages.NodeItem).
+	def GetTopology(self, sock=None):
+		if sock is not None:
+			return list(self.MasterTopologies.get(sock, {}).values())
+		nodes = []
+		for topology in self.MasterTopologies.values():
+			nodes.extend(topology.values())
+		return nodes
+
 	def GetMasterNodes(self, ip):
 		for node in self.MasterNodesList:
 			if ip == node.IP:
 				packet = self.Commands.GetLocalNodesRequest()
-				node.Socket.send(packet)
+				self.SendData(node.Socket, packet)
 				return
-
-	def GetNodeByUUID(self, uuid):
-		for conn in self.Connections:
-			if conn.UUID == uuid:
-				return conn
-		return None
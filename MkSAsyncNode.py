@@ -0,0 +1,296 @@
+#!/usr/bin/python
+import os
+import sys
+import socket
+import threading
+import asyncio
+
+from mksdk import MkSUtils
+
+# Python 3 only (asyncio transport for AbstractNode based nodes).
+
+class AsyncSocketPoller():
+	"""SocketPoller interface on top of an asyncio loop.
+
+	Node sockets are watched with loop.add_reader/add_writer and events are
+	passed to AbstractNode.SocketEventsHandler, so all node handlers and
+	callbacks stay the same as with the select loop. after_events() is called
+	when the handlers of an event are done.
+	"""
+
+	def __init__(self, loop, node, after_events=None):
+		self.Loop 		= loop
+		self.Node 		= node
+		self.AfterEvents 	= after_events
+		self.Sockets 	= {} # fileno -> [sock, read, write]
+
+	def IsLoopThread(self):
+		try:
+			return asyncio.get_running_loop() is self.Loop
+		except RuntimeError:
+			return False
+
+	# Loop is not thread safe, changes from other threads are done in loop and waited for.
+	def CallInLoop(self, method, *args):
+		if self.IsLoopThread() is True or self.Loop.is_running() is False:
+			return method(*args)
+		done 	= threading.Event()
+		result 	= []
+		def Call():
+			try:
+				result.append(method(*args))
+			finally:
+				done.set()
+		self.Loop.call_soon_threadsafe(Call)
+		done.wait()
+		return result[0] if result else None
+
+	def Register(self, sock, read=True, write=False):
+		self.CallInLoop(self.LoopRegister, sock, read, write)
+
+	def Modify(self, sock, read, write):
+		self.CallInLoop(self.LoopModify, sock, read, write)
+
+	def Unregister(self, sock):
+		self.CallInLoop(self.LoopUnregister, sock)
+
+	def IsRegistered(self, sock):
+		return sock.fileno() in self.Sockets
+
+	def LoopRegister(self, sock, read, write):
+		self.Sockets[sock.fileno()] = [sock, False, False]
+		self.LoopModify(sock, read, write)
+
+	def LoopModify(self, sock, read, write):
+		fd = sock.fileno()
+		item = self.Sockets.get(fd)
+		if item is None:
+			return
+		if read != item[1]:
+			if read is True:
+				self.Loop.add_reader(fd, self.ReadHandler, sock)
+			else:
+				self.Loop.remove_reader(fd)
+		if write != item[2]:
+			if write is True:
+				self.Loop.add_writer(fd, self.WriteHandler, sock)
+			else:
+				self.Loop.remove_writer(fd)
+		item[1] = read
+		item[2] = write
+
+	def LoopUnregister(self, sock):
+		fd = sock.fileno()
+		item = self.Sockets.pop(fd, None)
+		if item is None:
+			return
+		if item[1] is True:
+			self.Loop.remove_reader(fd)
+		if item[2] is True:
+			self.Loop.remove_writer(fd)
+
+	def ReadHandler(self, sock):
+		self.Node.SocketEventsHandler([sock], [])
+		if self.AfterEvents is not None:
+			self.AfterEvents()
+
+	def WriteHandler(self, sock):
+		self.Node.SocketEventsHandler([], [sock])
+		if self.AfterEvents is not None:
+			self.AfterEvents()
+
+	def Close(self):
+		for fd in list(self.Sockets.keys()):
+			self.LoopUnregister(self.Sockets[fd][0])
+
+class AsyncNodeRunner():
+	"""Runs an AbstractNode (MasterNode, SlaveNode, ApplicationNode) on an asyncio loop.
+
+	Replaces NodeLocalNetworkConectionListener. Several runners can share one
+	loop. Socket I/O, packet handlers, state machine ticks and timers all run
+	in the loop, handlers may be coroutines. States connect and search masters
+	with node.StartConnectMaster() and node.StartFindMasters(), the runner
+	replaces them with the ConnectMaster and FindMasters coroutines, so they
+	never stall the loop and can run concurrently.
+
+		loop 	= asyncio.get_event_loop()
+		master 	= AsyncNodeRunner(MkSMasterNode.MasterNode(), loop)
+		app 	= AsyncNodeRunner(MkSAppNode.ApplicationNode(None), loop)
+		loop.run_until_complete(asyncio.gather(master.Run(), app.Run()))
+	"""
+
+	def __init__(self, node, loop=None):
+		if loop is None:
+			loop = asyncio.get_event_loop()
+		self.Node 				= node
+		self.Loop 				= loop
+		self.Done 				= None
+		self.TimerHandle 		= None
+		# Const
+		self.MasterPort 		= 16999
+		self.ConnectTimeout 	= 2
+		self.ScanHosts 			= range(1, 255)
+
+		# Move already registered sockets to the loop.
+		poller = AsyncSocketPoller(loop, node, self.ScheduleTimers)
+		for fd, item in list(node.Poller.Sockets.items()):
+			poller.Register(item[0], item[1], item[2])
+		node.Poller.Close()
+		node.Poller 				= poller
+		node.ScheduleCoroutine 		= self.ScheduleCoroutine
+		node.StartConnectMaster 	= self.StartConnectMaster
+		node.StartFindMasters 		= self.StartFindMasters
+		node.CallInLoop 			= self.CallInLoop
+
+	# Awaitable for a RequestFuture, e.g. packet = await runner.AwaitRequest(node.GetNodeInfo(uuid)).
+	# Result is the response packet, None on timeout or failure.
+	def AwaitRequest(self, request):
+		future = self.Loop.create_future()
+		def Done(request):
+			def SetResult():
+				if future.done() is False:
+					future.set_result(request.Packet)
+			self.Loop.call_soon_threadsafe(SetResult)
+		request.AddCallback(Done)
+		return future
+
+	def ScheduleCoroutine(self, coro):
+		if asyncio.iscoroutine(coro) is False:
+			return
+		if self.Node.Poller.IsLoopThread() is True:
+			task = self.Loop.create_task(coro)
+			task.add_done_callback(self.CoroutineDoneHandler)
+		else:
+			future = asyncio.run_coroutine_threadsafe(coro, self.Loop)
+			future.add_done_callback(self.CoroutineDoneHandler)
+
+	def CoroutineDoneHandler(self, task):
+		if task.cancelled() is False and task.exception() is not None:
+			print ("[AsyncNodeRunner] Handler ERROR", task.exception())
+
+	async def Run(self):
+		node 		= self.Node
+		self.Done 	= self.Loop.create_future()
+
+		if node.IsListenerEnabled is True:
+			while node.LocalSocketServerRun is False:
+				if node.TryStartListener() is False:
+					await asyncio.sleep(1)
+		else:
+			node.LocalSocketServerRun = True
+
+		# Raise event for user
+		if node.OnLocalServerStartedCallback is not None:
+			node.OnLocalServerStartedCallback()
+
+		node.LoopThread = threading.current_thread()
+		tickTimer = node.Timers.AddTimer(node.StateTickInterval, node.TickState, delay=0)
+		# Timers added by other threads (request timeouts, supervisor) reschedule.
+		node.Timers.SetWakeup(lambda: self.Loop.call_soon_threadsafe(self.ScheduleTimers))
+		self.ScheduleTimers()
+		await self.Done
+
+		node.Timers.RemoveTimer(tickTimer)
+		if node.Executor is not None:
+			node.Executor.Stop()
+		# Clean all resorses before exit.
+		node.CleanAllSockets()
+		print ("[AsyncNodeRunner] Exit execution")
+		node.ExitLocalServerEvent.set()
+
+	def Stop(self):
+		self.Node.LocalSocketServerRun = False
+
+	def CallInLoop(self, method, *args):
+		self.Loop.call_soon_threadsafe(method, *args)
+
+	# Called after every socket event, a handler may have added an earlier timer.
+	def ScheduleTimers(self):
+		if self.Done is None or self.Done.done() is True:
+			return
+		timeout 	= self.Node.Timers.GetTimeout(self.Node.MaxPollTimeout)
+		deadline 	= self.Loop.time() + timeout
+		if self.TimerHandle is not None:
+			if self.TimerHandle.when() <= deadline:
+				return
+			self.TimerHandle.cancel()
+		self.TimerHandle = self.Loop.call_at(deadline, self.TimersHandler)
+
+	def TimersHandler(self):
+		self.TimerHandle = None
+		if self.Node.LocalSocketServerRun is False:
+			if self.Done.done() is False:
+				self.Done.set_result(True)
+			return
+		self.Node.Timers.RunExpired()
+		self.ScheduleTimers()
+
+	# States call these instead of the blocking ConnectMaster()/FindMasters()
+	# of AbstractNode, done is called in the loop.
+	def StartConnectMaster(self, ip, done):
+		async def Connect():
+			sock, status = await self.ConnectMaster(ip)
+			done(sock, status)
+		self.ScheduleCoroutine(Connect())
+
+	def StartFindMasters(self, done):
+		async def Find():
+			done(await self.FindMasters())
+		self.ScheduleCoroutine(Find())
+
+	async def ConnectNodeSocket(self, ip_addr_port):
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		sock.setblocking(False)
+		try:
+			await asyncio.wait_for(self.Loop.sock_connect(sock, ip_addr_port), self.ConnectTimeout)
+			return sock, True
+		except Exception:
+			sock.close()
+			return None, False
+
+	async def ConnectNode(self, ip, port):
+		sock, status = await self.ConnectNodeSocket((ip, port))
+		if True == status:
+			node = self.Node.AppendConnection(sock, ip, port)
+			node.LocalType = "NODE"
+			self.Node.NegotiateProtocol(sock)
+		return sock, status
+
+	async def ConnectMaster(self, ip):
+		sock, status = await self.ConnectNodeSocket((ip, self.MasterPort))
+		if status is True:
+			node = self.Node.AppendConnection(sock, ip, self.MasterPort)
+			node.LocalType = "MASTER"
+			self.Node.NegotiateProtocol(sock)
+		return sock, status
+
+	async def FindMasters(self):
+		node = self.Node
+		# Let user know master search started.
+		if node.OnMasterSearchCallback is not None:
+			node.OnMasterSearchCallback()
+
+		localIP 	= MkSUtils.GetLocalIP()
+		networkIP 	= '.'.join((localIP.split('.'))[:-1]) + '.'
+		ips 		= [networkIP + str(i) for i in self.ScanHosts]
+		# All hosts are probed at once.
+		results 	= await asyncio.gather(*[self.ConnectNodeSocket((ip, self.MasterPort)) for ip in ips])
+
+		found = 0
+		for ip, (sock, status) in zip(ips, results):
+			if status is False:
+				continue
+			found += 1
+			if node.GetNode(ip, self.MasterPort) is None:
+				conn = node.AppendConnection(sock, ip, self.MasterPort)
+				conn.LocalType = "MASTER"
+				node.NegotiateProtocol(sock)
+				# Raise event
+				if node.OnMasterFoundCallback is not None:
+					node.OnMasterFoundCallback([sock, ip])
+				node.NodeMasterAvailable(sock)
+			else:
+				sock.close()
+				if node.OnMasterFoundCallback is not None:
+					node.OnMasterFoundCallback([None, ip])
+		return found
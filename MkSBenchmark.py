@@ -0,0 +1,761 @@
+#!/usr/bin/python
+import os
+import sys
+import time
+import json
+import random
+
+from mksdk import MkSStream
+
+# Run with: python -m mksdk.MkSBenchmark [name ...]
+
+def Report(name, count, elapsed, extra=""):
+	rate = 0
+	if elapsed > 0:
+		rate = count / elapsed
+	print ("[Benchmark] {0:<40} {1:>10} ops {2:>8.3f} sec {3:>12.0f} ops/sec {4}".format(name, count, elapsed, rate, extra))
+
+# Counted result of a benchmark, not a timing.
+def ReportCount(name, count, unit=""):
+	print ("[Benchmark] {0:<40} {1:>10} {2}".format(name, count, unit))
+
+def BenchmarkStreamReassembler(frames_count=20000, seed=1):
+	random.seed(seed)
+	frames = []
+	for idx in range(frames_count):
+		if 0 == idx % 100:
+			# Some big frames (like get_file payloads).
+			body = json.dumps({ 'command': 'get_file', 'direction': 'proxy_response', 'payload': { 'data': { 'content': 'ab' * random.randint(1000, 20000) } } })
+		else:
+			body = json.dumps({ 'command': 'get_sensor_info', 'direction': 'response', 'id': idx })
+		frames.append(b"MKS: Data\n" + body.encode('utf-8') + b"\n")
+	stream = b"".join(frames)
+
+	# Cut the stream at random TCP segment boundaries.
+	segments 	= []
+	position 	= 0
+	while position < len(stream):
+		size = random.choice([1, 7, 64, 536, 1460, 2048, 8192, 65536])
+		segments.append(stream[position:position + size])
+		position += size
+
+	reassembler = MkSStream.StreamReassembler()
+	received 	= 0
+	start 		= time.time()
+	for segment in segments:
+		reassembler.Feed(segment)
+		received += len(reassembler.GetFrames())
+	elapsed = time.time() - start
+
+	if received != frames_count:
+		print ("[Benchmark] StreamReassembler ERROR lost frames", frames_count - received)
+	Report("StreamReassembler (frames)", received, elapsed, "{0:.1f} MB/sec, {1} segments".format((len(stream) / (1024.0 * 1024.0)) / elapsed, len(segments)))
+
+def BenchmarkDispatch(packets_count=100000):
+	from mksdk import MkSAbstractNode
+
+	counter 	= [0]
+	def Handler(sock, packet):
+		counter[0] += 1
+
+	handlers = {
+		'get_sensor_info': 	Handler,
+		'set_sensor_info': 	Handler,
+		'get_file': 		Handler
+	}
+	frames = []
+	for idx in range(packets_count):
+		frames.append(json.dumps({
+			'command': ['get_sensor_info', 'set_sensor_info', 'get_file', 'custom'][idx % 4],
+			'direction': ['request', 'proxy_request', 'response', 'proxy_response'][idx % 4],
+			'piggybag': 0,
+			'payload': { 'header': { 'source': 'A', 'destination': 'B' }, 'data': { 'id': idx, 'value': 'x' * 64 } }
+		}))
+
+	# Previous flow, decoded in AbstractNode and again in HandlerRouter.
+	def LegacyHandlerRouter(sock, data):
+		jsonData 	= json.loads(data)
+		direction 	= jsonData['direction']
+		if direction in ["response", "proxy_response"]:
+			if jsonData['command'] in handlers:
+				handlers[jsonData['command']](sock, jsonData)
+		elif direction in ["request", "proxy_request"]:
+			if jsonData['command'] in handlers:
+				handlers[jsonData['command']](sock, jsonData)
+
+	def LegacyDataSocketInputHandler(sock, data):
+		jsonData 	= json.loads(data)
+		command 	= jsonData['command']
+		direction 	= jsonData['direction']
+		if command in ["get_node_info", "get_node_status"]:
+			if direction in ["response", "proxy_response"]:
+				if (direction in "proxy_response"):
+					LegacyHandlerRouter(sock, data)
+		else:
+			LegacyHandlerRouter(sock, data)
+
+	start = time.time()
+	for frame in frames:
+		LegacyDataSocketInputHandler(None, frame)
+	legacy = time.time() - start
+	Report("Dispatch (decode twice, legacy)", packets_count, legacy)
+
+	node = MkSAbstractNode.AbstractNode()
+	node.RegisterDispatchHandlers(["request", "proxy_request", "response", "proxy_response"], handlers)
+	counter[0] = 0
+	start = time.time()
+	for frame in frames:
+		node.DataSocketInputHandler(None, frame)
+	elapsed = time.time() - start
+	Report("Dispatch (decode once, table)", packets_count, elapsed, "x{0:.2f}".format(legacy / elapsed))
+
+def BenchmarkBinaryProtocol(messages_count=60000):
+	from mksdk import MkSBinaryProtocol
+	from mksdk import MkSLocalNodesCommands
+
+	commands 	= MkSLocalNodesCommands.LocalNodeCommands()
+	request 	= commands.GenerateJsonProxyRequest("ac6de837-7863-72a9-c789-a0aae7e9d93e", "WEBFACE", "get_sensor_info", {}, 0)
+	samples 	= [
+		commands.GetPortRequest("ac6de837-7863-72a9-c789-a0aae7e9d93e", 1101, "Camera"),
+		commands.GetPortResponse(10005),
+		commands.GetLocalNodesRequest(),
+		commands.MasterAppendNodeResponse("10.0.0.12", 10005, "ac6de837-7863-72a9-c789-a0aae7e9d93e", 1101),
+		commands.MasterRemoveNodeResponse("10.0.0.12", 10005, "ac6de837-7863-72a9-c789-a0aae7e9d93e", 1101),
+		commands.GetSensorInfoRequest(),
+		commands.ExitResponse("OK"),
+		commands.ProxyResponse(request, { 'sensors': [{ 'id': 1, 'value': 23 }, { 'id': 2, 'value': 0 }] })
+	]
+	texts = []
+	for idx in range(messages_count):
+		text = samples[idx % len(samples)]
+		if not isinstance(text, bytes):
+			text = text.encode('utf-8')
+		texts.append(text)
+
+	start 		= time.time()
+	binaries 	= [MkSBinaryProtocol.TextToBinary(text) for text in texts]
+	elapsed 	= time.time() - start
+	Report("Binary encode (from text frame)", messages_count, elapsed)
+
+	packets = [json.loads(text[len(b"MKS: Data\n"):-1].decode('utf-8')) for text in texts[:len(samples)]]
+	start 	= time.time()
+	for idx in range(messages_count):
+		MkSBinaryProtocol.EncodePacket(packets[idx % len(packets)])
+	elapsed = time.time() - start
+	Report("Binary encode (from packet)", messages_count, elapsed)
+
+	textBytes 	= sum(len(text) for text in texts)
+	binaryBytes = sum(len(frame) for frame in binaries)
+	print ("[Benchmark] Wire bytes text {0} binary {1} ({2:.1f}%)".format(textBytes, binaryBytes, 100.0 * binaryBytes / textBytes))
+
+	results = {}
+	for name, stream in [("text", b"".join(texts)), ("binary", b"".join(binaries))]:
+		reassembler = MkSStream.StreamReassembler()
+		decoded 	= 0
+		start 		= time.time()
+		for position in range(0, len(stream), 1460):
+			reassembler.Feed(stream[position:position + 1460])
+			for frame in reassembler.GetFrames():
+				if MkSBinaryProtocol.IsBinaryFrame(frame) is True:
+					MkSBinaryProtocol.DecodeFrame(frame)
+				else:
+					json.loads(frame)
+				decoded += 1
+		results[name] = time.time() - start
+		if decoded != messages_count:
+			print ("[Benchmark] BinaryProtocol ERROR lost frames", name, messages_count - decoded)
+	Report("Receive and decode (text)", messages_count, results["text"])
+	Report("Receive and decode (binary)", messages_count, results["binary"], "x{0:.2f}".format(results["text"] / results["binary"]))
+
+def BenchmarkFileTransfer(loads_count=200):
+	import tempfile
+	from mksdk import MkSFile
+	from mksdk import MkSBinaryProtocol
+	from mksdk import MkSLocalNodesCommands
+
+	commands 	= MkSLocalNodesCommands.LocalNodeCommands()
+	html 		= "".join(["<div class=\"row\"><span id=\"sensor_{0}\">[NODE_UUID] {1}</span></div>\n".format(idx, random.randint(0, 1000)) for idx in range(4000)])
+	handle, path = tempfile.mkstemp(suffix=".html")
+	os.write(handle, html.encode('utf-8'))
+	os.close(handle)
+	replacements = [("[NODE_UUID]", "ac6de837-7863-72a9-c789-a0aae7e9d93e")]
+
+	results = {}
+	sizes 	= {}
+	for encoding in ["hex", "raw", "zlib"]:
+		wire 	= 0
+		start 	= time.time()
+		for idx in range(loads_count):
+			request = commands.GenerateJsonProxyRequest("ac6de837-7863-72a9-c789-a0aae7e9d93e", "WEBFACE", "get_file", {}, idx)
+			content, used = MkSFile.LoadUIFileContent(path, replacements, encoding)
+			payload = { 'file_type': 'html', 'ui_type': 'app', 'content': content }
+			if "hex" == used:
+				frame = commands.ProxyResponse(request, payload)
+			else:
+				payload['content'] = ""
+				frame = MkSBinaryProtocol.EncodeAttachment(commands.GenerateProxyResponse(request, payload), ["payload", "data", "content"], content, used)
+			wire += len(frame)
+			# Master side
+			reassembler = MkSStream.StreamReassembler()
+			reassembler.Feed(frame)
+			for item in reassembler.GetFrames():
+				if MkSBinaryProtocol.IsBinaryFrame(item) is True:
+					MkSBinaryProtocol.DecodeFrame(item)
+				else:
+					json.loads(item)
+		results[encoding] = time.time() - start
+		sizes[encoding] 	= wire // loads_count
+		extra = "{0} bytes/load".format(sizes[encoding])
+		if "hex" != encoding:
+			extra += ", x{0:.2f} faster".format(results["hex"] / results[encoding])
+		Report("get_file {0} ({1} bytes file)".format(encoding, len(html)), loads_count, results[encoding], extra)
+	os.remove(path)
+
+	# Default configuration, a slave connects to the master and negotiates the
+	# protocol, get_file encoding is then picked like SlaveNode.GetFileHandler does.
+	import socket
+	from mksdk import MkSAbstractNode
+	slave 	= MkSAbstractNode.AbstractNode()
+	master 	= MkSAbstractNode.AbstractNode()
+	local, remote = socket.socketpair()
+	local.setblocking(0)
+	remote.setblocking(0)
+	slave.AppendConnection(local, "10.0.0.12", 16999)
+	master.AppendConnection(remote, "10.0.0.12", 10001)
+	slave.NegotiateProtocol(local)
+	master.SocketReadHandler(remote)
+	slave.SocketReadHandler(local)
+	protocol = slave.GetConnection(local).Protocol
+	encoding = "hex"
+	if "binary" == protocol:
+		encoding = "zlib"
+	Report("get_file default ({0}, {1})".format(protocol, encoding), loads_count, results[encoding], "{0} bytes/load, x{1:.2f} less than hex".format(sizes[encoding], float(sizes["hex"]) / sizes[encoding]))
+	slave.CleanAllSockets()
+	master.CleanAllSockets()
+
+def BenchmarkCommands(calls_count=50000):
+	from mksdk import MkSLocalNodesCommands
+
+	commands 	= MkSLocalNodesCommands.LocalNodeCommands()
+	uuid 		= "ac6de837-7863-72a9-c789-a0aae7e9d93e"
+	sensors 	= '{"id":1,"value":23},{"id":2,"value":0}'
+	nodes 		= ",".join([commands.LocalNodeItem("10.0.0.12", 10000 + idx, uuid, 1101) for idx in range(10)])
+	data 		= { 'sensors': [{ 'id': 1, 'value': 23 }, { 'id': 2, 'value': 0 }] }
+	def Request():
+		return commands.GenerateJsonProxyRequest(uuid, "WEBFACE", "get_sensor_info", {}, { 'identifier': 9 })
+
+	builders = [
+		("GetLocalNodesRequest", 				lambda: commands.GetLocalNodesRequest()),
+		("GetLocalNodesResponse", 				lambda: commands.GetLocalNodesResponse(nodes)),
+		("GetPortRequest", 						lambda: commands.GetPortRequest(uuid, 1101, "Camera")),
+		("GetPortResponse", 					lambda: commands.GetPortResponse(10005)),
+		("GetMasterInfoRequest", 				lambda: commands.GetMasterInfoRequest()),
+		("GetMasterInfoResponse", 				lambda: commands.GetMasterInfoResponse(uuid, "raspberrypi", nodes)),
+		("LocalNodeItem", 						lambda: commands.LocalNodeItem("10.0.0.12", 10005, uuid, 1101)),
+		("MasterAppendNodeResponse", 			lambda: commands.MasterAppendNodeResponse("10.0.0.12", 10005, uuid, 1101)),
+		("MasterRemoveNodeResponse", 			lambda: commands.MasterRemoveNodeResponse("10.0.0.12", 10005, uuid, 1101)),
+		("SetSensorInfoRequest", 				lambda: commands.SetSensorInfoRequest(uuid, sensors)),
+		("GetSensorInfoRequest", 				lambda: commands.GetSensorInfoRequest()),
+		("GetSensorInfoResponse", 				lambda: commands.GetSensorInfoResponse(uuid, sensors)),
+		("ExitRequest", 						lambda: commands.ExitRequest()),
+		("ExitResponse", 						lambda: commands.ExitResponse("OK")),
+		("ProtocolNegotiateRequest", 			lambda: commands.ProtocolNegotiateRequest(["binary", "text"])),
+		("ProtocolNegotiateResponse", 			lambda: commands.ProtocolNegotiateResponse("binary")),
+		("SendPingRequest", 					lambda: commands.SendPingRequest("GATEWAY", uuid)),
+		("SendListOfNodesRequest", 				lambda: commands.SendListOfNodesRequest("GATEWAY", uuid)),
+		("NodeInfoRequest", 					lambda: commands.NodeInfoRequest(uuid, uuid)),
+		("SendMessageToNodeViaGatewayRequest", 	lambda: commands.SendMessageToNodeViaGatewayRequest("set_sensor_info", uuid, uuid, data)),
+		("GenerateJsonProxyRequest", 			lambda: commands.GenerateJsonProxyRequest(uuid, "WEBFACE", "get_sensor_info", data, 0)),
+		("GenerateJsonProxyResponse", 			lambda: commands.GenerateJsonProxyResponse(uuid, "WEBFACE", "get_sensor_info", data, 0)),
+		("GatewayToProxyResponse", 				lambda: commands.GatewayToProxyResponse(uuid, "WEBFACE", "get_sensor_info", data, 0)),
+		("ProxyRequest", 						lambda: commands.ProxyRequest(uuid, "WEBFACE", "get_sensor_info", data, 0)),
+		("GenerateProxyResponse", 				lambda: commands.GenerateProxyResponse(Request(), data)),
+		("ProxyResponse", 						lambda: commands.ProxyResponse(Request(), data)),
+		("GetNodeInfoRequest", 					lambda: commands.GetNodeInfoRequest(uuid, "WEBFACE", data, True)),
+		("GetNodeInfoResponse", 				lambda: commands.GetNodeInfoResponse(Request())),
+		("ProxyMessageRequest", 				lambda: commands.ProxyMessageRequest(uuid, "WEBFACE", data)),
+		("ProxyMessageResponse", 				lambda: commands.ProxyMessageResponse(uuid, "WEBFACE", data))
+	]
+	for name, builder in builders:
+		start = time.time()
+		for idx in range(calls_count):
+			builder()
+		Report("LocalNodeCommands." + name, calls_count, time.time() - start)
+
+def BenchmarkScatterSend(frames_count=200, body_size=512 * 1024):
+	import socket
+	import threading
+
+	header 	= b"MKS: Data\n"
+	footer 	= b"\n"
+	body 	= b"a" * body_size
+
+	def Run(name, build):
+		writer, reader = socket.socketpair()
+		writer.setblocking(False)
+		total 	= frames_count * (len(header) + len(body) + len(footer))
+		def Drain():
+			received = 0
+			while received < total:
+				received += len(reader.recv(1024 * 1024))
+		thread = threading.Thread(target=Drain)
+		thread.start()
+		queue = MkSStream.OutboundQueue(max_size=total + 1)
+		start = time.time()
+		for idx in range(frames_count):
+			queue.Push(build())
+			queue.Flush(writer)
+		while queue.Flush(writer) is False:
+			time.sleep(0)
+		thread.join()
+		elapsed = time.time() - start
+		writer.close()
+		reader.close()
+		Report(name, frames_count, elapsed, "{0:.1f} MB/sec".format((total / (1024.0 * 1024.0)) / elapsed))
+		return elapsed
+
+	joined 		= Run("Send (header + body + footer)", lambda: header + body + footer)
+	segments 	= Run("Send (segments, sendmsg)", lambda: [header, body, footer])
+	print ("[Benchmark] Segments x{0:.2f}".format(joined / segments))
+
+def BenchmarkSensorBatcher(changes_count=100000, sensors_count=50, window=0.05):
+	from mksdk import MkSTimerScheduler
+	from mksdk import MkSSensorBatcher
+
+	random.seed(1)
+	timers 	= MkSTimerScheduler.TimerScheduler()
+	sent 	= [0]
+	def Send(payload):
+		sent[0] += 1
+	batcher = MkSSensorBatcher.SensorChangeBatcher(Send, timers, window=window)
+	start = time.time()
+	for idx in range(changes_count):
+		batcher.Add({ 'sensors': [{ 'id': random.randint(1, sensors_count), 'value': idx }] })
+		if 0 == idx % 100:
+			# Node loop runs timers between socket events.
+			timers.RunExpired()
+	batcher.Flush()
+	elapsed = time.time() - start
+	stats = batcher.GetStatistics()
+	Report("SensorChangeBatcher (changes)", changes_count, elapsed, "{0} messages (was {1}), avg batch {2:.1f}, max latency {3:.3f} sec".format(sent[0], changes_count, stats['avg_batch_size'], stats['max_flush_latency']))
+
+def BenchmarkProxyRelay(messages_count=2000):
+	from mksdk import MkSProxyRelay
+	from mksdk import MkSMessages
+	from mksdk import MkSLocalNodesCommands
+
+	commands = MkSLocalNodesCommands.LocalNodeCommands()
+	# Big strings (file content) and many small members (sensor lists).
+	payloads = [("{0} bytes".format(size), { 'id': 1, 'content': 'a' * size }, messages_count) for size in [64, 4096, 262144]]
+	payloads.append(("5000 sensors", { 'sensors': [{ 'id': idx, 'value': idx * 0.5, 'unit': 'C' } for idx in range(5000)] }, messages_count // 20))
+	for name, payload, count in payloads:
+		message = json.dumps({
+			'header': { 'message_type': 'DIRECT', 'destination': 'ac6de837-7863-72a9-c789-a0aae7e9d93e', 'source': 'WEBFACE', 'direction': 'request' },
+			'data': { 'header': { 'command': 'set_sensor_info', 'timestamp': '1554159118' }, 'payload': payload },
+			'user': { 'key': 'key' },
+			'additional': {},
+			'piggybag': { 'identifier': 9 }
+		})
+
+		# Previous flow, decode websocket message and encode local packet.
+		start = time.time()
+		for idx in range(count):
+			packet = json.loads(message)
+			commands.ProxyRequest(packet["header"]["destination"], packet["header"]["source"], packet["data"]["header"]["command"], packet["data"]["payload"], packet["piggybag"])
+		legacy = time.time() - start
+		Report("Gateway to slave (decode, {0})".format(name), count, legacy)
+
+		start = time.time()
+		for idx in range(count):
+			relay = MkSProxyRelay.ParseGatewayMessage(message)
+			commands.ProxyRelayPacket(relay.Destination, relay.Source, relay.Command, "proxy_request", relay.Payload, relay.Piggy)
+		elapsed = time.time() - start
+		Report("Gateway to slave (relay, {0})".format(name), count, elapsed, "x{0:.2f}".format(legacy / elapsed))
+
+		frame = commands.ProxyRequest("GATEWAY", "ac6de837-7863-72a9-c789-a0aae7e9d93e", "set_sensor_info", payload, 0)[10:-1]
+		start = time.time()
+		for idx in range(count):
+			packet = json.loads(frame)
+			json.dumps({ 'header': packet["payload"]["header"], 'data': { 'payload': packet["payload"]["data"] }, 'piggybag': packet["piggybag"] })
+		legacy = time.time() - start
+		Report("Slave to gateway (decode, {0})".format(name), count, legacy)
+
+		start = time.time()
+		for idx in range(count):
+			# Master decodes to text on Python 3 only.
+			relay = MkSMessages.ProxyMessage.Decode(frame if bytes is str else frame.decode('utf-8'))
+			MkSProxyRelay.BuildGatewayMessage("key", "request", "DIRECT", relay.Destination, relay.Source, relay.Command, relay.DataJson, relay.Piggy, "1554159118")
+		elapsed = time.time() - start
+		Report("Slave to gateway (relay, {0})".format(name), count, elapsed, "x{0:.2f}".format(legacy / elapsed))
+
+def BenchmarkMessages(messages_count=2000):
+	from mksdk import MkSMessages
+	from mksdk import MkSLocalNodesCommands
+
+	commands = MkSLocalNodesCommands.LocalNodeCommands()
+	# Typed decode is used by the master relay only, above ProxyRelayMinSize.
+	# Decoded packets are routed with dict access.
+	for size in [64, 262144]:
+		body = commands.ProxyResponse(commands.GenerateJsonProxyRequest("ac6de837-7863-72a9-c789-a0aae7e9d93e", "WEBFACE", "get_file", {}, 0), { 'content': 'a' * size })[10:-1]
+		if bytes is not str:
+			# Frames are text on Python 3 only, like in MasterNode.RelaySlaveFrame.
+			body = body.decode('utf-8')
+
+		# Route by header fields only, payload is forwarded.
+		start = time.time()
+		for idx in range(messages_count):
+			packet = json.loads(body)
+			packet["payload"]["header"]["destination"]
+			json.dumps(packet)
+		legacy = time.time() - start
+		Report("Route proxy packet (dict, {0} bytes)".format(size), messages_count, legacy)
+
+		start = time.time()
+		for idx in range(messages_count):
+			message = MkSMessages.Decode(body)
+			message.Destination
+			message.Encode()
+		elapsed = time.time() - start
+		Report("Route proxy packet (typed, {0} bytes)".format(size), messages_count, elapsed, "x{0:.2f}".format(legacy / elapsed))
+
+	event = MkSMessages.NodeEvent("master_append_node", MkSMessages.NodeItem("10.0.0.12", 10005, "ac6de837-7863-72a9-c789-a0aae7e9d93e", 1101))
+	frame = event.Encode()[10:-1]
+	start = time.time()
+	for idx in range(messages_count * 10):
+		MkSMessages.Decode(frame).Node.UUID
+	Report("Decode NodeEvent", messages_count * 10, time.time() - start)
+	start = time.time()
+	for idx in range(messages_count * 10):
+		event.Encode()
+	Report("Encode NodeEvent", messages_count * 10, time.time() - start)
+
+def BenchmarkTopology(slaves_count=30, apps_count=2, rounds=200):
+	import socket
+	from mksdk import MkSAbstractNode
+	from mksdk import MkSMessages
+	from mksdk import MkSTopology
+
+	# Master with a connection per slave and application, frames are queued by
+	# AbstractNode.Broadcast and not sent (nobody reads the other ends).
+	node 	= MkSAbstractNode.AbstractNode()
+	peers 	= []
+	for idx in range(slaves_count + apps_count):
+		local, remote = socket.socketpair()
+		local.setblocking(0)
+		node.AppendConnection(local, "10.0.0.12", 10000 + idx)
+		peers.append(remote)
+
+	# Restart of all slaves, each one leaves and joins again on a new port.
+	events = []
+	for idx in range(slaves_count):
+		events.append((False, MkSMessages.NodeItem("10.0.0.12", 10000 + idx, "uuid-{0}".format(idx), 1101)))
+	for idx in range(slaves_count):
+		events.append((True, MkSMessages.NodeItem("10.0.0.12", 10100 + idx, "uuid-{0}".format(idx), 1101)))
+
+	def Run(restart):
+		elapsed = 0
+		for idx in range(rounds):
+			start = time.time()
+			restart()
+			elapsed += time.time() - start
+			frames 	= sum([len(conn.Outbound.Chunks) for conn in node.Connections])
+			size 	= sum([conn.Outbound.GetQueueDepth() for conn in node.Connections])
+			for conn in node.Connections:
+				conn.Outbound.Clear()
+		return elapsed, frames, size
+
+	# Previous flow, one frame per event broadcast to every connection.
+	def PerEvent():
+		for is_append, item in events:
+			command = "master_append_node" if is_append is True else "master_remove_node"
+			node.Broadcast(MkSMessages.NodeEvent(command, item).Encode())
+	legacy, frames, size = Run(PerEvent)
+	Report("Topology restart (per event)", rounds, legacy)
+	ReportCount("Topology restart frames (per event)", frames, "frames queued, {0} bytes".format(size))
+
+	# Window is longer than the burst, it ends with Flush().
+	batcher = MkSTopology.TopologyDeltaBatcher(node.Broadcast, node.Timers, window=60)
+	def Merged():
+		for is_append, item in events:
+			if is_append is True:
+				batcher.Append(item)
+			else:
+				batcher.Remove(item)
+		batcher.Flush()
+	elapsed, frames, size = Run(Merged)
+	Report("Topology restart (merged deltas)", rounds, elapsed, "x{0:.2f}".format(legacy / elapsed))
+	ReportCount("Topology restart frames (merged deltas)", frames, "frames queued, {0} bytes".format(size))
+
+	node.CleanAllSockets()
+	for remote in peers:
+		remote.close()
+
+def BenchmarkTopologySnapshot(requests_count=20000, slaves_count=30):
+	from mksdk import MkSMessages
+	from mksdk import MkSTopology
+
+	uuid 	= "ac6de837-7863-72a9-c789-a0aae7e9d93e"
+	nodes 	= [MkSMessages.NodeItem("10.0.0.12", 10000 + idx, "uuid-{0}".format(idx), 1101) for idx in range(slaves_count)]
+	def GetNodes():
+		return list(nodes)
+
+	# Previous flow, list encoded on every request.
+	start = time.time()
+	for idx in range(requests_count):
+		frame = MkSMessages.MasterInfoResponse("raspberrypi", uuid, GetNodes()).Encode()
+	Report("get_master_info (encoded per request)", requests_count, time.time() - start, "{0} bytes".format(len(frame)))
+
+	snapshot = MkSTopology.TopologySnapshot(GetNodes)
+	start = time.time()
+	for idx in range(requests_count):
+		frame = snapshot.MasterInfoResponse("raspberrypi", uuid)
+	Report("get_master_info (cached snapshot)", requests_count, time.time() - start, "{0} bytes".format(len(frame)))
+
+	version = snapshot.GetVersion()
+	start = time.time()
+	for idx in range(requests_count):
+		frame = snapshot.MasterInfoResponse("raspberrypi", uuid, version)
+	Report("get_master_info (not modified)", requests_count, time.time() - start, "{0} bytes".format(len(frame)))
+
+# Stress test of the slave port leases, fails if a port is leased twice.
+def BenchmarkPortLeases(slaves_count=5000, rounds=5, seed=1):
+	from mksdk import MkSTimerScheduler
+	from mksdk import MkSPortLeases
+
+	rand 	= random.Random(seed)
+	leases 	= MkSPortLeases.PortLeaseAllocator([(10001, 12000), (20001, 23500)], lease_time=300)
+	uuids 	= ["slave-{0}".format(idx) for idx in range(slaves_count)]
+
+	start = time.time()
+	ports = dict((uuid, leases.Allocate(uuid)) for uuid in uuids)
+	Report("Port leases attach", slaves_count, time.time() - start, "capacity {0}".format(leases.GetCapacity()))
+	if 0 in ports.values() or len(set(ports.values())) != slaves_count:
+		raise Exception("Port leased twice or missing")
+
+	# Random half of the slaves restart in every round.
+	operations 	= 0
+	start 		= time.time()
+	for idx in range(rounds):
+		restarted = rand.sample(uuids, slaves_count // 2)
+		for uuid in restarted:
+			leases.Release(ports[uuid])
+		rand.shuffle(restarted)
+		for uuid in restarted:
+			if leases.Allocate(uuid) != ports[uuid]:
+				raise Exception("Port of {0} changed on reconnect".format(uuid))
+		operations += 2 * len(restarted)
+	Report("Port leases reconnect", operations, time.time() - start, "stable ports")
+
+	# Leases expire, new slaves get the ports of gone ones.
+	gone = uuids[:slaves_count // 2]
+	for uuid in gone:
+		leases.Release(ports[uuid])
+	leases.Expire(MkSTimerScheduler.GetTime() + leases.LeaseTime + 1)
+	start = time.time()
+	fresh = [leases.Allocate("new-{0}".format(idx)) for idx in range(len(gone) + leases.GetCapacity() - slaves_count)]
+	Report("Port leases after expiry", len(fresh), time.time() - start, str(leases.GetStatistics()))
+	if 0 in fresh or len(set(fresh)) != len(fresh) or leases.Allocate("one-too-many") != 0:
+		raise Exception("Expired ports are not reused")
+
+def BenchmarkPipeReader(processes_count=20, lines_count=20000):
+	import subprocess
+	import threading
+	from mksdk import MkSPipeReader
+
+	# One quiet child next to busy ones, it must not hold the others.
+	script 	= "import sys\nfor i in range({0}): sys.stdout.write('%d node output line\\n' % i)\n".format(lines_count)
+	done 	= threading.Event()
+	counts 	= { 'lines': 0, 'exits': 0 }
+	def OnLine(name, stream, line):
+		counts['lines'] += 1
+	def OnExit(name, returncode):
+		counts['exits'] += 1
+		if counts['exits'] == processes_count:
+			done.set()
+
+	reader = MkSPipeReader.PipeReader(OnLine, OnExit)
+	reader.Start()
+	quiet = subprocess.Popen(["sleep", "30"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	reader.Add("quiet", quiet)
+	start = time.time()
+	for idx in range(processes_count):
+		reader.Add("node-{0}".format(idx), subprocess.Popen([sys.executable, "-c", script], stdout=subprocess.PIPE, stderr=subprocess.PIPE))
+	done.wait(60)
+	elapsed = time.time() - start
+	Report("Pipe reader lines", counts['lines'], elapsed, "{0} processes exited".format(counts['exits']))
+	reader.Remove("quiet")
+	quiet.kill()
+	quiet.wait()
+	reader.Stop()
+
+def BenchmarkScreenBuffer(lines_count=200000, poll_every=100):
+	from mksdk import MkSScreenBuffer
+
+	# Chatty node, UI polls its shell screen while it prints.
+	screen 		= MkSScreenBuffer.ScreenBuffer()
+	offset 		= 0
+	full 		= 0
+	incremental = 0
+	start 		= time.time()
+	for idx in range(lines_count):
+		screen.Append("[Node] sensor {0} value changed to {1}".format(idx % 16, idx))
+		if 0 == idx % poll_every:
+			lines, offset, dropped = screen.ReadSince(offset)
+			incremental += len(lines)
+			full 		+= len(screen.GetLines())
+	elapsed = time.time() - start
+	Report("Screen buffer append", lines_count, elapsed, "{0} lines / {1} chars kept".format(screen.GetOffset() - screen.FirstSeq, screen.Chars))
+	ReportCount("Screen lines sent (full screen)", full, "lines")
+	ReportCount("Screen lines sent (since offset)", incremental, "lines")
+
+def BenchmarkSupervisor(nodes_count=12, boot_time=0.3):
+	import subprocess
+	from mksdk import MkSTimerScheduler
+	from mksdk import MkSPipeReader
+	from mksdk import MkSNodeSupervisor
+
+	# Nodes print "WORKING" after boot_time, as if they got their port.
+	script = "import time\ntime.sleep({0})\nprint('WORKING')\ntime.sleep(60)\n".format(boot_time)
+	for parallel in (1, 4):
+		timers 		= MkSTimerScheduler.TimerScheduler()
+		supervisor 	= [None]
+		def OnLine(name, stream, line):
+			if "WORKING" == line.rstrip():
+				supervisor[0].OnReady(name)
+		reader = MkSPipeReader.PipeReader(OnLine)
+		reader.Start()
+		def Spawn(node):
+			process = subprocess.Popen(node.Command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+			reader.Add(node.UUID, process)
+			return process
+		supervisor[0] = MkSNodeSupervisor.NodeSupervisor(Spawn, timers, parallel=parallel)
+		for idx in range(nodes_count):
+			supervisor[0].Add("node-{0}".format(idx), [sys.executable, "-u", "-c", script])
+		start = time.time()
+		supervisor[0].StartAll()
+		while time.time() - start < 60:
+			status = supervisor[0].GetStatus()
+			if all([item['ready_latency'] is not None for item in status]):
+				break
+			timers.RunExpired()
+			time.sleep(0.005)
+		elapsed = time.time() - start
+		Report("Supervisor boot to WORKING (parallel {0})".format(parallel), nodes_count, elapsed)
+		for node in supervisor[0].Nodes.values():
+			supervisor[0].Stop(node.UUID)
+			node.Process.kill()
+			node.Process.wait()
+		reader.Stop()
+
+def BenchmarkHostMetrics(samples_count=2000, forks_count=100):
+	import subprocess
+	from mksdk import MkSHostMetrics
+
+	# Previous flow, a shell is forked to read one file.
+	start = time.time()
+	for idx in range(forks_count):
+		subprocess.call("cat /proc/loadavg > /dev/null", shell=True)
+	Report("Host metric (fork cat, one file)", forks_count, time.time() - start)
+
+	sampler = MkSHostMetrics.HostMetricsSampler()
+	start = time.time()
+	for idx in range(samples_count):
+		sampler.Sample()
+	Report("Host metrics (sample all, no fork)", samples_count, time.time() - start)
+
+	start = time.time()
+	for idx in range(samples_count * 100):
+		sampler.GetInfoJson()
+	Report("Host metrics (cached query)", samples_count * 100, time.time() - start)
+
+# Master and application node on one asyncio loop, the application finds the
+# master, subscribes to its topology and sends get_local_nodes requests one
+# after the other (request, response, next request).
+def BenchmarkAsyncNodes(requests_count=2000):
+	if sys.version_info[0] < 3:
+		print ("[Benchmark] Async nodes need Python 3, skipped")
+		return
+	import asyncio
+	from mksdk import MkSUtils
+	from mksdk import MkSMasterNode
+	from mksdk import MkSAppNode
+	from mksdk import MkSAsyncNode
+
+	loop 		= asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	master 		= MkSMasterNode.MasterNode()
+	app 		= MkSAppNode.ApplicationNode(None)
+	runners 	= [MkSAsyncNode.AsyncNodeRunner(master, loop), MkSAsyncNode.AsyncNodeRunner(app, loop)]
+	# Search probes the master host only.
+	runners[1].ScanHosts = [int(MkSUtils.GetLocalIP().split('.')[-1])]
+	times 		= {}
+	counter 	= [0]
+
+	def Stop():
+		for runner in runners:
+			runner.Stop()
+
+	def OnNodes(nodes):
+		if 'subscribed' not in times:
+			times['subscribed'] = time.time()
+		else:
+			counter[0] += 1
+			if counter[0] == requests_count:
+				times['done'] = time.time()
+				Stop()
+				return
+		app.SendData(app.MasterNodesList[0].Socket, app.Commands.GetLocalNodesRequest())
+	app.OnGetLocalNodesResponeCallback = OnNodes
+
+	# Application starts once the master listens.
+	tasks = []
+	def StartApp():
+		if master.CurrentState != "WORKING":
+			loop.call_later(0.01, StartApp)
+			return
+		times['start'] = time.time()
+		tasks.append(loop.create_task(runners[1].Run()))
+
+	# Give up if the master is never found.
+	loop.call_later(30, Stop)
+	loop.call_soon(StartApp)
+	loop.run_until_complete(runners[0].Run())
+	if tasks:
+		loop.run_until_complete(tasks[0])
+	master.ExitRoutine()
+	loop.close()
+
+	if 'done' not in times:
+		print ("[Benchmark] Async nodes ERROR master {0} app {1} responses {2}".format(master.CurrentState, app.CurrentState, counter[0]))
+		return
+	Report("Async master + app, search to subscribed", 1, times['subscribed'] - times['start'])
+	Report("Async master + app, request round trips", requests_count, times['done'] - times['subscribed'])
+
+Benchmarks = {
+	'stream': 		BenchmarkStreamReassembler,
+	'dispatch': 	BenchmarkDispatch,
+	'binary': 		BenchmarkBinaryProtocol,
+	'file': 		BenchmarkFileTransfer,
+	'commands': 	BenchmarkCommands,
+	'send': 		BenchmarkScatterSend,
+	'sensors': 		BenchmarkSensorBatcher,
+	'relay': 		BenchmarkProxyRelay,
+	'messages': 	BenchmarkMessages,
+	'topology': 	BenchmarkTopology,
+	'snapshot': 	BenchmarkTopologySnapshot,
+	'leases': 		BenchmarkPortLeases,
+	'pipes': 		BenchmarkPipeReader,
+	'screen': 		BenchmarkScreenBuffer,
+	'supervisor': 	BenchmarkSupervisor,
+	'metrics': 		BenchmarkHostMetrics,
+	'async': 		BenchmarkAsyncNodes
+}
+
+def Main(names):
+	if not names:
+		names = sorted(Benchmarks.keys())
+	for name in names:
+		Benchmarks[name]()
+
+if __name__ == "__main__":
+	Main(sys.argv[1:])
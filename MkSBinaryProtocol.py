@@ -0,0 +1,223 @@
+#!/usr/bin/python
+import os
+import sys
+import json
+import zlib
+import struct
+import binascii
+
+# Binary frame:
+#   "MKB" | flags (uint8) | command id (uint16) | direction id (uint8) | body length (uint32) | body
+# Body is either the fields of a fixed command packed by its schema (FLAG_SCHEMA)
+# or the JSON text of the packet, carried as is. With FLAG_ATTACHMENT the body is
+#   JSON length (uint32) | JSON | raw bytes
+# and "attachment" in JSON is the path where the raw bytes go (zlib compressed with FLAG_ZLIB).
+MKB_MAGIC 			= b"MKB"
+HEADER 				= struct.Struct("!3sBHBI")
+HEADER_SIZE 		= HEADER.size
+
+FLAG_SCHEMA 		= 0x01
+FLAG_ZLIB 			= 0x02
+FLAG_ATTACHMENT 	= 0x04
+
+TEXT_HEADER 		= b"MKS: Data\n"
+TEXT_FOOTER 		= b"\n"
+COMMAND_PREFIX 		= b'{"command":"'
+DIRECTION_PREFIX 	= b'","direction":"'
+
+# Numeric ids of fixed commands (0 - command is only in JSON body).
+COMMANDS = {
+	'get_port': 				1,
+	'get_local_nodes': 			2,
+	'get_master_info': 			3,
+	'master_append_node': 		4,
+	'master_remove_node': 		5,
+	'get_sensor_info': 			6,
+	'set_sensor_info': 			7,
+	'exit': 					8,
+	'get_node_info': 			9,
+	'get_node_status': 			10,
+	'nodes_list': 				11,
+	'get_file': 				12,
+	'upload_file': 				13,
+	'ping': 					14,
+	'protocol_negotiate': 		15,
+	'topology_subscribe': 		16
+}
+COMMAND_NAMES = dict((value, key) for key, value in COMMANDS.items())
+
+DIRECTIONS = {
+	'request': 					1,
+	'response': 				2,
+	'proxy_request': 			3,
+	'proxy_response': 			4
+}
+DIRECTION_NAMES = dict((value, key) for key, value in DIRECTIONS.items())
+
+# Fixed packets, fields as (path, kind). Kind 'i' is int32, 's' is utf-8 string.
+SCHEMAS = {
+	('get_port', 'request'): 				[(('uuid',), 's'), (('type',), 'i'), (('name',), 's')],
+	('get_port', 'response'): 				[(('port',), 'i')],
+	('get_local_nodes', 'request'): 		[],
+	('get_master_info', 'request'): 		[],
+	('get_sensor_info', 'request'): 		[],
+	('exit', 'request'): 					[],
+	('exit', 'response'): 					[(('status',), 's')],
+	('master_append_node', 'response'): 	[(('node', 'ip'), 's'), (('node', 'port'), 'i'), (('node', 'uuid'), 's'), (('node', 'type'), 'i')],
+	('master_remove_node', 'response'): 	[(('node', 'ip'), 's'), (('node', 'port'), 'i'), (('node', 'uuid'), 's'), (('node', 'type'), 'i')],
+	('protocol_negotiate', 'request'): 		[],
+	('topology_subscribe', 'request'): 		[],
+	('protocol_negotiate', 'response'): 	[(('protocol',), 's')]
+}
+
+# Top level members of the schema packets, a packet with other members
+# (e.g. a versioned get_local_nodes request) does not fit and is sent as JSON.
+SCHEMA_MEMBERS = dict((key, set(['command', 'direction'] + [path[0] for path, kind in schema])) for key, schema in SCHEMAS.items())
+
+INT32 	= struct.Struct("!i")
+UINT16 	= struct.Struct("!H")
+UINT32 	= struct.Struct("!I")
+
+def IsBinaryFrame(frame):
+	return frame[:3] == MKB_MAGIC
+
+def PackSchema(packet, schema):
+	parts = []
+	for path, kind in schema:
+		value = packet
+		for key in path:
+			value = value[key]
+		if 'i' == kind:
+			parts.append(INT32.pack(int(value)))
+		else:
+			if not isinstance(value, bytes):
+				value = value.encode('utf-8')
+			parts.append(UINT16.pack(len(value)))
+			parts.append(value)
+	return b"".join(parts)
+
+def UnpackSchema(packet, schema, body):
+	offset = 0
+	for path, kind in schema:
+		if 'i' == kind:
+			value = INT32.unpack_from(body, offset)[0]
+			offset += 4
+		else:
+			length = UINT16.unpack_from(body, offset)[0]
+			offset += 2
+			value = body[offset:offset + length].decode('utf-8')
+			offset += length
+		item = packet
+		for key in path[:-1]:
+			if key not in item:
+				item[key] = {}
+			item = item[key]
+		item[path[-1]] = value
+	return packet
+
+def BuildFrame(flags, command_id, direction_id, body):
+	return HEADER.pack(MKB_MAGIC, flags, command_id, direction_id, len(body)) + body
+
+# Encode a packet (dict). JSON body can be given when it is already serialized.
+def EncodePacket(packet, body=None):
+	command 	= packet.get('command')
+	direction 	= packet.get('direction')
+	schema 		= SCHEMAS.get((command, direction))
+	if schema is not None and SCHEMA_MEMBERS[(command, direction)].issuperset(packet):
+		try:
+			return BuildFrame(FLAG_SCHEMA, COMMANDS[command], DIRECTIONS[direction], PackSchema(packet, schema))
+		except (KeyError, ValueError, TypeError, struct.error):
+			# Packet does not fit the schema, send it as JSON.
+			pass
+	if body is None:
+		body = json.dumps(packet, separators=(',', ':'))
+	if not isinstance(body, bytes):
+		body = body.encode('utf-8')
+	return BuildFrame(0, COMMANDS.get(command, 0), DIRECTIONS.get(direction, 0), body)
+
+# Packet with bytes (file content) sent without text encoding. Encoding is "raw" or "zlib".
+# Frame is returned as segments, the attachment is not copied.
+def AttachmentSegments(packet, path, attachment, encoding="raw"):
+	flags = FLAG_ATTACHMENT
+	if "zlib" == encoding:
+		flags |= FLAG_ZLIB
+	packet["attachment"] = path
+	body = json.dumps(packet, separators=(',', ':'))
+	if not isinstance(body, bytes):
+		body = body.encode('utf-8')
+	commandId 		= COMMANDS.get(packet.get('command'), 0)
+	directionId 	= DIRECTIONS.get(packet.get('direction'), 0)
+	return [HEADER.pack(MKB_MAGIC, flags, commandId, directionId, UINT32.size + len(body) + len(attachment)) + UINT32.pack(len(body)), body, attachment]
+
+def EncodeAttachment(packet, path, attachment, encoding="raw"):
+	return b"".join(AttachmentSegments(packet, path, attachment, encoding))
+
+# Attachment as hex string, for peers that only take JSON (Gateway).
+def AttachmentToText(packet):
+	path = packet.pop("attachment", None)
+	if path:
+		item = packet
+		for key in path[:-1]:
+			item = item[key]
+		item[path[-1]] = binascii.hexlify(item[path[-1]]).decode('ascii')
+	return packet
+
+# Convert a "MKS: Data\n<json>\n" frame to binary. Anything else is returned as is.
+# Segments [header, body, footer] are converted without joining them.
+def TextToBinary(data):
+	if isinstance(data, (list, tuple)):
+		if len(data) != 3 or data[0] != TEXT_HEADER or data[2] != TEXT_FOOTER:
+			return data
+		body = data[1]
+		if TEXT_FOOTER in body:
+			return data
+		return BodyToBinary(body, True)
+
+	if not isinstance(data, bytes):
+		data = data.encode('utf-8')
+	if data[:len(TEXT_HEADER)] != TEXT_HEADER or data[-1:] != TEXT_FOOTER:
+		return data
+	body = data[len(TEXT_HEADER):-1]
+	if TEXT_FOOTER in body:
+		# More than one frame.
+		return data
+	return BodyToBinary(body, False)
+
+def BodyToBinary(body, segments):
+	command 	= None
+	direction 	= None
+	# Packets built by LocalNodeCommands start with command and direction.
+	if body[:len(COMMAND_PREFIX)] == COMMAND_PREFIX:
+		end = body.find(b'"', len(COMMAND_PREFIX))
+		if end > 0 and body[end:end + len(DIRECTION_PREFIX)] == DIRECTION_PREFIX:
+			start 		= end + len(DIRECTION_PREFIX)
+			command 	= body[len(COMMAND_PREFIX):end].decode('utf-8')
+			direction 	= body[start:body.find(b'"', start)].decode('utf-8')
+
+	if (command, direction) in SCHEMAS:
+		return EncodePacket(json.loads(body.decode('utf-8')), body)
+	if segments is True:
+		return [HEADER.pack(MKB_MAGIC, 0, COMMANDS.get(command, 0), DIRECTIONS.get(direction, 0), len(body)), body]
+	return BuildFrame(0, COMMANDS.get(command, 0), DIRECTIONS.get(direction, 0), body)
+
+# Decode a full binary frame (header included) to packet (dict).
+def DecodeFrame(frame):
+	magic, flags, command_id, direction_id, length = HEADER.unpack_from(frame, 0)
+	body = frame[HEADER_SIZE:HEADER_SIZE + length]
+	if flags & FLAG_SCHEMA:
+		command 	= COMMAND_NAMES[command_id]
+		direction 	= DIRECTION_NAMES[direction_id]
+		packet 		= { 'command': command, 'direction': direction }
+		return UnpackSchema(packet, SCHEMAS[(command, direction)], body)
+	if flags & FLAG_ATTACHMENT:
+		jsonLength 	= UINT32.unpack_from(body, 0)[0]
+		packet 		= json.loads(body[UINT32.size:UINT32.size + jsonLength].decode('utf-8'))
+		attachment 	= body[UINT32.size + jsonLength:]
+		if flags & FLAG_ZLIB:
+			attachment = zlib.decompress(attachment)
+		item = packet
+		for key in packet["attachment"][:-1]:
+			item = item[key]
+		item[packet["attachment"][-1]] = attachment
+		return packet
+	return json.loads(body.decode('utf-8'))
@@ -1,6 +1,8 @@
 #!/usr/bin/python
 import os
 import sys
+import zlib
+import binascii
 
 class File ():
 	def __init__(self):
@@ -32,7 +34,36 @@ class File ():
 	
 	def LoadStateFromFile (self, filename):
 		return self.LoadContent(filename)
+
+	def LoadBinaryContent(self, filename):
+		if os.path.isfile(filename) is True:
+			file = open(filename, "rb")
+			data = file.read()
+			file.close()
+			return data
+		return b""
 	
 	def ListFilesInFolder(self, path):
 		onlyfiles = [f for f in os.listdir(path) if os.path.isfile(os.path.join(path, f))]
-		return onlyfiles
\ No newline at end of file
+		return onlyfiles
+
+# Load UI file and encode it for transfer, returns (content, encoding).
+# Encoding "hex" is for JSON frames, "raw" and "zlib" for binary frames.
+# Module level so it can run in executor process pool.
+def LoadUIFileContent(path, replacements, encoding="hex"):
+	content = File().LoadBinaryContent(path)
+	for key, value in replacements:
+		if not isinstance(key, bytes):
+			key = key.encode('utf-8')
+		if not isinstance(value, bytes):
+			value = value.encode('utf-8')
+		content = content.replace(key, value)
+
+	if "hex" == encoding:
+		return binascii.hexlify(content).decode('ascii'), encoding
+	if "zlib" == encoding:
+		compressed = zlib.compress(content, 1)
+		# Images are compressed already.
+		if len(compressed) < len(content):
+			return compressed, encoding
+	return content, "raw"
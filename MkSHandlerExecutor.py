@@ -0,0 +1,113 @@
+#!/usr/bin/python
+import os
+import sys
+import time
+import threading
+import multiprocessing
+from collections import deque
+if sys.version_info[0] < 3:
+	import Queue as queue
+else:
+	import queue
+
+class HandlerExecutor():
+	"""Worker pool for slow packet handlers.
+
+	Handlers submitted with the same key (the connection socket) run one after
+	the other in submit order, so responses of one connection leave in request
+	order. Different keys run in parallel on the worker threads and never block
+	the socket loop. CPU heavy work inside a handler can be passed to Run(),
+	which uses a process pool when process_workers > 0.
+	"""
+
+	def __init__(self, workers=4, process_workers=0):
+		self.WorkersCount 		= workers
+		self.ProcessWorkers 	= process_workers
+		self.Queue 				= queue.Queue()
+		self.Threads 			= []
+		self.Pending 			= {} # Key -> deque of jobs waiting for the running one
+		self.Lock 				= threading.Lock()
+		self.ProcessPool 		= None
+		# Statistics
+		self.SubmittedCount 	= 0
+		self.CompletedCount 	= 0
+		self.MaxLatency 		= 0
+
+	def Start(self):
+		self.Lock.acquire()
+		try:
+			if self.Threads:
+				return
+			for idx in range(self.WorkersCount):
+				worker = threading.Thread(target=self.Worker_Thread)
+				worker.daemon = True
+				worker.start()
+				self.Threads.append(worker)
+			if self.ProcessWorkers > 0 and self.ProcessPool is None:
+				self.ProcessPool = multiprocessing.Pool(self.ProcessWorkers)
+		finally:
+			self.Lock.release()
+
+	def Stop(self):
+		self.Lock.acquire()
+		try:
+			threads 		= self.Threads
+			self.Threads 	= []
+			for worker in threads:
+				self.Queue.put(None)
+			if self.ProcessPool is not None:
+				self.ProcessPool.terminate()
+				self.ProcessPool = None
+		finally:
+			self.Lock.release()
+
+	def Submit(self, key, handler, args):
+		if not self.Threads:
+			self.Start()
+		job = (key, handler, args, time.time())
+		self.Lock.acquire()
+		try:
+			self.SubmittedCount += 1
+			if key in self.Pending:
+				# Previous handler of this connection still running.
+				self.Pending[key].append(job)
+				return
+			self.Pending[key] = deque()
+		finally:
+			self.Lock.release()
+		self.Queue.put(job)
+
+	# Run method in process pool if configured, otherwise in calling thread.
+	def Run(self, method, *args):
+		if self.ProcessPool is None:
+			return method(*args)
+		return self.ProcessPool.apply(method, args)
+
+	def Worker_Thread(self):
+		while True:
+			job = self.Queue.get()
+			if job is None:
+				return
+			key, handler, args, submitted = job
+			try:
+				handler(*args)
+			except Exception as e:
+				print ("[HandlerExecutor] Handler ERROR", e)
+
+			self.Lock.acquire()
+			try:
+				self.CompletedCount += 1
+				self.MaxLatency = max(self.MaxLatency, time.time() - submitted)
+				jobs = self.Pending.get(key)
+				if jobs:
+					nextJob = jobs.popleft()
+				else:
+					nextJob = None
+					self.Pending.pop(key, None)
+			finally:
+				self.Lock.release()
+			if nextJob is not None:
+				self.Queue.put(nextJob)
+
+	def GetPendingCount(self):
+		return self.SubmittedCount - self.CompletedCount
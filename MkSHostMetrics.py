@@ -0,0 +1,360 @@
+#!/usr/bin/python
+import os
+import sys
+import json
+import glob
+import platform
+import threading
+from array import array
+
+from mksdk import MkSTimerScheduler
+
+class MetricRing():
+	"""Last size values of a numeric metric, memory is allocated once."""
+
+	def __init__(self, size):
+		self.Size 		= size
+		self.Values 	= array('d', [0.0] * size)
+		self.Count 		= 0 # Values appended ever
+
+	def Append(self, value):
+		self.Values[self.Count % self.Size] = value
+		self.Count += 1
+
+	def Last(self):
+		if 0 == self.Count:
+			return None
+		return self.Values[(self.Count - 1) % self.Size]
+
+	# Oldest first.
+	def GetValues(self):
+		start = max(0, self.Count - self.Size)
+		return [self.Values[idx % self.Size] for idx in range(start, self.Count)]
+
+class ProcFile():
+	"""File of /proc or /sys kept open, read again from the start on every sample."""
+
+	def __init__(self, path):
+		self.Path 	= path
+		self.File 	= None
+
+	def Read(self):
+		try:
+			if self.File is None:
+				self.File = open(self.Path, "r")
+			self.File.seek(0)
+			return self.File.read()
+		except (IOError, OSError):
+			self.Close()
+			return None
+
+	def Close(self):
+		if self.File is not None:
+			self.File.close()
+			self.File = None
+
+class HostMetricsSampler():
+	"""Host cpu, ram, disk, network and temperature without forking.
+
+	A thread reads /proc/stat, /proc/meminfo, /proc/net/dev, statvfs and the
+	/sys thermal zones every interval. Every metric keeps the last history
+	samples in a MetricRing. The info dict and its JSON text are rebuilt after
+	each sample, so GetInfo() and GetInfoJson() do no I/O. Metrics the host
+	doesn't provide stay "N/A".
+	"""
+
+	METRICS = ("cpu_usage", "cpu_freq", "ram_ratio", "hdd_ratio", "temp", "rx_rate", "tx_rate")
+
+	def __init__(self, interval=5, history=120, disk_path="/", ip="N/A"):
+		self.Interval 		= interval
+		self.DiskPath 		= disk_path
+		self.IP 			= ip
+		self.Arch 			= platform.machine() or "N/A"
+		self.Rings 			= dict((name, MetricRing(history)) for name in self.METRICS)
+		self.Stat 			= ProcFile("/proc/stat")
+		self.MemInfo 		= ProcFile("/proc/meminfo")
+		self.NetDev 		= ProcFile("/proc/net/dev")
+		self.Freq 			= ProcFile("/sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq")
+		self.Thermal 		= [ProcFile(path) for path in sorted(glob.glob("/sys/class/thermal/thermal_zone*/temp"))]
+		self.LastCpu 		= None # (total, idle) jiffies
+		self.LastNet 		= None # (time, rx, tx) bytes
+		self.Info 			= None
+		self.InfoJson 		= None
+		self.Samplers 		= [] # Objects sampled after the host, see AddSampler()
+		self.Stopped 		= threading.Event()
+		self.Thread 		= None
+		self.BuildInfo({})
+
+	# Sample() of sampler is called on every interval by the sampler thread.
+	def AddSampler(self, sampler):
+		self.Samplers.append(sampler)
+
+	def Start(self):
+		if self.Thread is not None:
+			return
+		self.Stopped.clear()
+		self.Thread 		= threading.Thread(target=self.Sampler_Thread)
+		self.Thread.daemon 	= True
+		self.Thread.start()
+
+	def Stop(self):
+		self.Stopped.set()
+		self.Thread = None
+
+	def Sampler_Thread(self):
+		while not self.Stopped.is_set():
+			for sampler in [self] + self.Samplers:
+				try:
+					sampler.Sample()
+				except Exception as e:
+					print ("[HostMetricsSampler] Sample ERROR", e)
+			self.Stopped.wait(self.Interval)
+
+	def Sample(self):
+		values = {}
+		self.SampleCpu(values)
+		self.SampleMemory(values)
+		self.SampleDisk(values)
+		self.SampleNetwork(values)
+		self.SampleTemperature(values)
+		for name, value in values.items():
+			self.Rings[name].Append(value)
+		self.BuildInfo(values)
+		return values
+
+	def SampleCpu(self, values):
+		text = self.Stat.Read()
+		if text:
+			# cpu  user nice system idle iowait irq softirq steal ...
+			fields 	= [int(item) for item in text[:text.find("\n")].split()[1:]]
+			idle 	= fields[3] + (fields[4] if len(fields) > 4 else 0)
+			total 	= sum(fields[:8])
+			if self.LastCpu is not None and total > self.LastCpu[0]:
+				busy = (total - self.LastCpu[0]) - (idle - self.LastCpu[1])
+				values["cpu_usage"] = round(100.0 * busy / (total - self.LastCpu[0]), 1)
+			self.LastCpu = (total, idle)
+		text = self.Freq.Read()
+		if text:
+			values["cpu_freq"] = int(text) // 1000 # MHz
+
+	def SampleMemory(self, values):
+		text = self.MemInfo.Read()
+		if not text:
+			return
+		memory = {}
+		for line in text.splitlines():
+			name, sep, rest = line.partition(":")
+			if name in ("MemTotal", "MemAvailable", "MemFree"):
+				memory[name] = int(rest.split()[0])
+		total 		= memory.get("MemTotal", 0)
+		available 	= memory.get("MemAvailable", memory.get("MemFree", 0))
+		if total > 0:
+			values["ram_ratio"] = round(1.0 - float(available) / total, 3)
+
+	def SampleDisk(self, values):
+		if not hasattr(os, "statvfs"):
+			return
+		try:
+			stat = os.statvfs(self.DiskPath)
+		except OSError:
+			return
+		# Used of what non root users can have, like df.
+		used = (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+		size = used + stat.f_bavail * stat.f_frsize
+		if size > 0:
+			values["hdd_ratio"] = round(float(used) / size, 3)
+
+	def SampleNetwork(self, values):
+		text = self.NetDev.Read()
+		if not text:
+			return
+		rx = 0
+		tx = 0
+		for line in text.splitlines()[2:]:
+			name, sep, rest = line.partition(":")
+			if "lo" == name.strip():
+				continue
+			fields = rest.split()
+			rx += int(fields[0])
+			tx += int(fields[8])
+		now = MkSTimerScheduler.GetTime()
+		if self.LastNet is not None and now > self.LastNet[0]:
+			elapsed = now - self.LastNet[0]
+			values["rx_rate"] = int(max(0, rx - self.LastNet[1]) / elapsed) # Bytes/sec
+			values["tx_rate"] = int(max(0, tx - self.LastNet[2]) / elapsed)
+		self.LastNet = (now, rx, tx)
+
+	def SampleTemperature(self, values):
+		temps = []
+		for item in self.Thermal:
+			text = item.Read()
+			if text:
+				temps.append(int(text) / 1000.0)
+		if temps:
+			values["temp"] = max(temps)
+
+	def BuildInfo(self, values):
+		def Get(name):
+			return values.get(name, "N/A")
+		info = {
+			"cpu": {
+				"arch": self.Arch,
+				"usage": Get("cpu_usage")
+			},
+			"hdd": {
+				"capacity_ratio": Get("hdd_ratio")
+			},
+			"ram": {
+				"capacity_ratio": Get("ram_ratio")
+			},
+			"sensors": {
+				"temp": Get("temp"),
+				"freq": Get("cpu_freq")
+			},
+			"network": {
+				"ip": self.IP,
+				"rx_rate": Get("rx_rate"),
+				"tx_rate": Get("tx_rate")
+			}
+		}
+		# Swapped as a whole, readers never see a half built info.
+		self.InfoJson 	= json.dumps(info)
+		self.Info 		= info
+
+	def GetInfo(self):
+		return self.Info
+
+	def GetInfoJson(self):
+		return self.InfoJson
+
+	# Recent values of a metric (see METRICS), oldest first.
+	def GetHistory(self, name):
+		return self.Rings[name].GetValues()
+
+class ProcessMetrics():
+	"""CPU, RSS, fd and thread count of one process from /proc/<pid>."""
+
+	if hasattr(os, "sysconf"):
+		CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+		PAGE_SIZE 	= os.sysconf("SC_PAGE_SIZE")
+	else:
+		CLOCK_TICKS = 100
+		PAGE_SIZE 	= 4096
+
+	def __init__(self, pid, history=60):
+		self.Pid 		= pid
+		self.Alive 		= True
+		self.Stat 		= ProcFile("/proc/{0}/stat".format(pid))
+		self.FdPath 	= "/proc/{0}/fd".format(pid)
+		self.LastCpu 	= None # (time, cpu seconds)
+		self.Values 	= {}
+		self.Rings 		= {
+			'cpu_usage': 	MetricRing(history), # Percent of one core
+			'rss': 			MetricRing(history), # Bytes
+			'fds': 			MetricRing(history),
+			'threads': 		MetricRing(history)
+		}
+
+	# Return values of this sample, None when the process is gone.
+	def Sample(self):
+		if self.Alive is False:
+			return None
+		text = self.Stat.Read()
+		if not text:
+			self.Alive = False
+			self.Stat.Close()
+			return None
+		# Process name (2nd field) may have spaces, fields are counted after it.
+		fields 	= text[text.rfind(")") + 2:].split()
+		if "Z" == fields[0]:
+			# Zombie, exited and not reaped yet.
+			self.Alive = False
+			self.Stat.Close()
+			return None
+		now 	= MkSTimerScheduler.GetTime()
+		cpu 	= float(int(fields[11]) + int(fields[12])) / self.CLOCK_TICKS
+		values 	= {
+			'threads': 	int(fields[17]),
+			'rss': 		int(fields[21]) * self.PAGE_SIZE
+		}
+		try:
+			values['fds'] = len(os.listdir(self.FdPath))
+		except OSError:
+			# Not our process (permissions) or it just exited.
+			pass
+		if self.LastCpu is not None and now > self.LastCpu[0]:
+			values['cpu_usage'] = round(100.0 * (cpu - self.LastCpu[1]) / (now - self.LastCpu[0]), 1)
+		self.LastCpu = (now, cpu)
+		for name, value in values.items():
+			self.Rings[name].Append(value)
+		self.Values = values
+		return values
+
+	def GetInfo(self, history=True):
+		info = {
+			'pid': 		self.Pid,
+			'alive': 	self.Alive
+		}
+		info.update(self.Values)
+		if history is True:
+			info['history'] = dict((name, ring.GetValues()) for name, ring in self.Rings.items())
+		return info
+
+class ProcessAccounting():
+	"""Resource use of named processes (supervised nodes), sampled together.
+
+	Sample() is called by the HostMetricsSampler thread, never by the node
+	socket loop.
+	"""
+
+	def __init__(self, history=60):
+		self.History 	= history
+		self.Processes 	= {} # Name -> ProcessMetrics
+		self.Lock 		= threading.Lock()
+
+	# Process of name was (re)started.
+	def Add(self, name, pid):
+		self.Lock.acquire()
+		try:
+			self.Processes[name] = ProcessMetrics(pid, self.History)
+		finally:
+			self.Lock.release()
+
+	def Remove(self, name):
+		self.Lock.acquire()
+		try:
+			item = self.Processes.pop(name, None)
+		finally:
+			self.Lock.release()
+		if item is not None:
+			item.Stat.Close()
+
+	# Process of name exited, its last values are kept until Add() or Remove().
+	def MarkExited(self, name):
+		self.Lock.acquire()
+		try:
+			item = self.Processes.get(name)
+		finally:
+			self.Lock.release()
+		if item is not None:
+			item.Alive = False
+			item.Stat.Close()
+
+	def Sample(self):
+		self.Lock.acquire()
+		try:
+			items = list(self.Processes.values())
+		finally:
+			self.Lock.release()
+		for item in items:
+			item.Sample()
+
+	# Latest values and history of name, None if it was never started.
+	def GetInfo(self, name, history=True):
+		item = self.Processes.get(name)
+		if item is None:
+			return None
+		return item.GetInfo(history)
+
+	def GetAll(self, history=False):
+		return dict((name, item.GetInfo(history)) for name, item in list(self.Processes.items()))
@@ -1,8 +1,167 @@
 #!/usr/bin/python
 import os
 import sys
+import re
 import json
 
+MKS_HEADER 	= "MKS: Data\n"
+MKS_FOOTER 	= "\n"
+
+if sys.version_info[0] < 3:
+	TEXT_TYPE 		= unicode
+	STRING_TYPES 	= (str, unicode)
+	INTEGER_TYPES 	= (int, long)
+else:
+	TEXT_TYPE 		= str
+	STRING_TYPES 	= (str,)
+	INTEGER_TYPES 	= (int,)
+
+# C encoders, no per call json.dumps() setup.
+QuoteString 	= json.encoder.encode_basestring_ascii
+JsonEncoder 	= json.JSONEncoder(separators=(',', ':'))
+
+def EncodeString(value):
+	if value.__class__ is TEXT_TYPE:
+		# Most values are already strings.
+		return QuoteString(value)
+	if not isinstance(value, STRING_TYPES):
+		value = str(value)
+	if isinstance(value, bytes):
+		# Python 2 str may hold utf-8.
+		value = value.decode('utf-8')
+	return QuoteString(value)
+
+def EncodeInteger(value):
+	if isinstance(value, INTEGER_TYPES):
+		return "%d" % value
+	try:
+		return str(int(value))
+	except (TypeError, ValueError):
+		return JsonEncoder.encode(value)
+
+def EncodeJson(value):
+	return JsonEncoder.encode(value)
+
+# Value is already a JSON fragment.
+def EncodeRaw(value):
+	if isinstance(value, bytes) and bytes is not str:
+		value = value.decode('utf-8')
+	return value
+
+def ToBytes(text):
+	if isinstance(text, bytes):
+		return text
+	return text.encode('utf-8')
+
+# Rendered frame text to bytes.
+if sys.version_info[0] < 3:
+	EncodeFrame = ToBytes
+else:
+	EncodeFrame = str.encode
+
+class PacketTemplate():
+	"""Precompiled MKS frame with slots.
+
+	Template is the JSON body with {{name}} slots, {{name:kind}} selects the
+	encoder (str - escaped JSON string, int, json - any value, raw - JSON
+	fragment as is). Header, footer and constant parts are escaped once into a
+	%-format string, Render(values...) takes the slot values in template
+	order, so a packet costs one encoder call per value and one string format.
+	Template with framed=False renders a JSON fragment (text) without header
+	and footer.
+	"""
+
+	Encoders = {
+		'str': 		EncodeString,
+		'int': 		EncodeInteger,
+		'json': 	EncodeJson,
+		'raw': 		EncodeRaw
+	}
+
+	def __init__(self, template, framed=True):
+		self.Slots 		= []
+		parts 			= []
+		position 		= 0
+		for match in re.finditer(r"\{\{(\w+)(?::(\w+))?\}\}", template):
+			# Constant parts are escaped once, values are inserted with %s.
+			parts.append(template[position:match.start()].replace("%", "%%"))
+			self.Slots.append((match.group(1), match.group(2) or 'str'))
+			position = match.end()
+		parts.append(template[position:].replace("%", "%%"))
+		self.Format = "%s".join(parts)
+		if framed is True:
+			self.Format = MKS_HEADER + self.Format + MKS_FOOTER
+		self.Framed 	= framed
+		self.Encode 	= [self.Encoders[kind] for name, kind in self.Slots]
+		self.Render 	= self.BuildRender()
+
+	# Plain closures for the usual slot counts, one generic above them.
+	def BuildRender(self):
+		fmt 	= self.Format
+		encode 	= self.Encode
+		if self.Framed is True:
+			finish = EncodeFrame
+		else:
+			finish = lambda text: text
+		count = len(encode)
+		if 0 == count:
+			packet = finish(fmt % ())
+			return lambda: packet
+		if 1 == count:
+			e0, = encode
+			return lambda a: finish(fmt % (e0(a),))
+		if 2 == count:
+			e0, e1 = encode
+			return lambda a, b: finish(fmt % (e0(a), e1(b)))
+		if 3 == count:
+			e0, e1, e2 = encode
+			return lambda a, b, c: finish(fmt % (e0(a), e1(b), e2(c)))
+		if 4 == count:
+			e0, e1, e2, e3 = encode
+			return lambda a, b, c, d: finish(fmt % (e0(a), e1(b), e2(c), e3(d)))
+		return lambda *values: finish(fmt % tuple([e(value) for e, value in zip(encode, values)]))
+
+MKS_HEADER_BYTES 	= ToBytes(MKS_HEADER)
+MKS_FOOTER_BYTES 	= ToBytes(MKS_FOOTER)
+
+def ConstantPacket(body):
+	return ToBytes(MKS_HEADER + body + MKS_FOOTER)
+
+# Constant packets
+GET_LOCAL_NODES_REQUEST 	= ConstantPacket('{"command":"get_local_nodes","direction":"request"}')
+GET_MASTER_INFO_REQUEST 	= ConstantPacket('{"command":"get_master_info","direction":"request"}')
+GET_SENSOR_INFO_REQUEST 	= ConstantPacket('{"command":"get_sensor_info","direction":"request"}')
+EXIT_REQUEST 				= ConstantPacket('{"command":"exit","direction":"request"}')
+TOPOLOGY_SUBSCRIBE_REQUEST 	= ConstantPacket('{"command":"topology_subscribe","direction":"request"}')
+
+# Parameterized packets
+GET_LOCAL_NODES_RESPONSE 	= PacketTemplate('{"command":"get_local_nodes","direction":"response","version":{{version:int}},"nodes":[{{nodes:raw}}]}')
+# Topology requests with the version the client has, answered by not_modified when it is current.
+GET_LOCAL_NODES_VERSION_REQUEST = PacketTemplate('{"command":"get_local_nodes","direction":"request","version":{{version:int}}}')
+GET_MASTER_INFO_VERSION_REQUEST = PacketTemplate('{"command":"get_master_info","direction":"request","version":{{version:int}}}')
+# Snapshot sent to a topology subscriber, master_append_node, master_remove_node and master_nodes_delta follow.
+TOPOLOGY_SUBSCRIBE_RESPONSE = PacketTemplate('{"command":"topology_subscribe","direction":"response","version":{{version:int}},"nodes":[{{nodes:raw}}]}')
+TOPOLOGY_NOT_MODIFIED_RESPONSE 	= PacketTemplate('{"command":{{command}},"direction":"response","version":{{version:int}},"not_modified":true}')
+GET_PORT_REQUEST 			= PacketTemplate('{"command":"get_port","direction":"request","uuid":{{uuid}},"type":{{type:int}},"name":{{name}}}')
+GET_PORT_RESPONSE 			= PacketTemplate('{"command":"get_port","direction":"response","port":{{port:int}}}')
+GET_MASTER_INFO_RESPONSE 	= PacketTemplate('{"command":"get_master_info","direction":"response","version":{{version:int}},"info":{"hostname":{{hostname}},"uuid":{{uuid}},"nodes":[{{nodes:raw}}]}}')
+MASTER_APPEND_NODE_RESPONSE = PacketTemplate('{"command":"master_append_node","direction":"response","node":{"ip":{{ip}},"port":{{port:int}},"uuid":{{uuid}},"type":{{type:int}}}}')
+MASTER_REMOVE_NODE_RESPONSE = PacketTemplate('{"command":"master_remove_node","direction":"response","node":{"ip":{{ip}},"port":{{port:int}},"uuid":{{uuid}},"type":{{type:int}}}}')
+MASTER_NODES_DELTA_RESPONSE = PacketTemplate('{"command":"master_nodes_delta","direction":"response","removed":[{{removed:raw}}],"appended":[{{appended:raw}}]}')
+SET_SENSOR_INFO_REQUEST 	= PacketTemplate('{"command":"set_sensor_info","direction":"request","uuid":{{uuid}},"sensors":[{{sensors:raw}}]}')
+GET_SENSOR_INFO_RESPONSE 	= PacketTemplate('{"command":"get_sensor_info","direction":"response","uuid":{{uuid}},"sensors":[{{sensors:raw}}]}')
+EXIT_RESPONSE 				= PacketTemplate('{"command":"exit","direction":"response","status":{{status}}}')
+PROTOCOL_NEGOTIATE_REQUEST 	= PacketTemplate('{"command":"protocol_negotiate","direction":"request","protocols":{{protocols:json}}}')
+PROTOCOL_NEGOTIATE_RESPONSE = PacketTemplate('{"command":"protocol_negotiate","direction":"response","protocol":{{protocol}}}')
+# Node item of get_local_nodes and get_master_info responses (JSON fragment, no header).
+LOCAL_NODE_ITEM 			= PacketTemplate('{"ip":{{ip}},"port":{{port:int}},"uuid":{{uuid}},"type":{{type:int}}}', framed=False)
+# Proxy packets
+PROXY_PACKET 				= PacketTemplate('{"command":{{command}},"direction":{{direction}},"request_id":{{request_id:int}},"piggybag":{{piggy:json}},"payload":{"header":{"destination":{{destination}},"source":{{source}}},"data":{{data:json}}}}')
+# Relayed proxy packet, data is JSON text taken as is from the Gateway message.
+PROXY_RELAY_PACKET 			= PacketTemplate('{"command":{{command}},"direction":{{direction}},"request_id":{{request_id:int}},"piggybag":{{piggy:json}},"payload":{"header":{"destination":{{destination}},"source":{{source}}},"data":{{data:raw}}}}')
+PROXY_GATEWAY_PACKET 		= PacketTemplate('{"command":"proxy_gateway","direction":{{direction}},"payload":{"header":{"destination":{{destination}},"source":{{source}}},"data":{{data:json}}}}')
+GET_NODE_INFO_REQUEST 		= PacketTemplate('{"command":"get_node_info","direction":{{direction}},"payload":{"header":{"destination":{{destination}},"source":{{source}}},"data":{{data:json}}}}')
+
 class LocalNodeCommands:
 	def __init__(self):
 		pass
@@ -13,173 +172,86 @@ class LocalNodeCommands:
 	def GetFooter(self):
 		return "\n"
 
-	def GetLocalNodesRequest(self):
-		packet = self.GetHeader()
-		packet += "{\"command\":\"get_local_nodes\",\"direction\":\"request\"}"
-		packet += self.GetFooter()
-
-		return packet
-
-	def GetLocalNodesResponse(self, nodes):
-		packet = self.GetHeader()
-		packet += "{\"command\":\"get_local_nodes\",\"direction\":\"response\",\"nodes\":[" + nodes + "]}"
-		packet += self.GetFooter()
+	def GetLocalNodesRequest(self, version=None):
+		if version is None:
+			return GET_LOCAL_NODES_REQUEST
+		return GET_LOCAL_NODES_VERSION_REQUEST.Render(version)
 
-		return packet
+	def GetLocalNodesResponse(self, nodes, version=0):
+		return GET_LOCAL_NODES_RESPONSE.Render(version, nodes)
 
 	def GetPortRequest(self, uuid, node_type, node_name):
-		packet = self.GetHeader()
-		packet += "{\"command\":\"get_port\",\"direction\":\"request\",\"uuid\":\"" + uuid + "\",\"type\":" + str(node_type) + ",\"name\":\"" + str(node_name) + "\"}"
-		packet += self.GetFooter()
-
-		return packet
+		return GET_PORT_REQUEST.Render(uuid, node_type, node_name)
 
 	def GetPortResponse(self, port):
-		packet = self.GetHeader()
-		packet += "{\"command\":\"get_port\",\"direction\":\"response\",\"port\":" + str(port) + "}"
-		packet += self.GetFooter()
+		return GET_PORT_RESPONSE.Render(port)
 
-		return packet
+	def GetMasterInfoRequest(self, version=None):
+		if version is None:
+			return GET_MASTER_INFO_REQUEST
+		return GET_MASTER_INFO_VERSION_REQUEST.Render(version)
 
-	def GetMasterInfoRequest(self):
-		packet = self.GetHeader()
-		packet += "{\"command\":\"get_master_info\",\"direction\":\"request\"}"
-		packet += self.GetFooter()
+	def GetMasterInfoResponse(self, uuid, host_name, nodes, version=0):
+		return GET_MASTER_INFO_RESPONSE.Render(version, host_name, uuid, nodes)
 
-		return packet
+	def TopologySubscribeRequest(self):
+		return TOPOLOGY_SUBSCRIBE_REQUEST
 
-	def GetMasterInfoResponse(self, uuid, host_name, nodes):
-		packet = self.GetHeader()
-		packet += "{\"command\":\"get_master_info\",\"direction\":\"response\",\"info\":{\"hostname\":\"" + str(host_name) + "\",\"uuid\":\"" + uuid + "\",\"nodes\":[" + nodes + "]}}"
-		packet += self.GetFooter()
+	def TopologySubscribeResponse(self, nodes, version=0):
+		return TOPOLOGY_SUBSCRIBE_RESPONSE.Render(version, nodes)
 
-		return packet
+	def TopologyNotModifiedResponse(self, command, version):
+		return TOPOLOGY_NOT_MODIFIED_RESPONSE.Render(command, version)
 
-	def MasterAppendNodeResponse(self, ip, port, uuid, node_type):
-		packet = self.GetHeader()
-		packet += "{\"command\":\"master_append_node\",\"direction\":\"response\",\"node\":{\"ip\":\"" + str(ip) + "\",\"port\":" + str(port) + ",\"uuid\":\"" + uuid + "\",\"type\":" + str(node_type) + "}}"
-		packet += self.GetFooter()
+	def LocalNodeItem(self, ip, port, uuid, node_type):
+		return LOCAL_NODE_ITEM.Render(ip, port, uuid, node_type)
 
-		return packet
+	def MasterAppendNodeResponse(self, ip, port, uuid, node_type):
+		return MASTER_APPEND_NODE_RESPONSE.Render(ip, port, uuid, node_type)
 
 	def MasterRemoveNodeResponse(self, ip, port, uuid, node_type):
-		packet = self.GetHeader()
-		packet += "{\"command\":\"master_remove_node\",\"direction\":\"response\",\"node\":{\"ip\":\"" + str(ip) + "\",\"port\":" + str(port) + ",\"uuid\":\"" + uuid + "\",\"type\":" + str(node_type) + "}}"
-		packet += self.GetFooter()
+		return MASTER_REMOVE_NODE_RESPONSE.Render(ip, port, uuid, node_type)
 
-		return packet
+	# Nodes are JSON fragments of LocalNodeItem joined with ",".
+	def MasterNodesDeltaResponse(self, removed, appended):
+		return MASTER_NODES_DELTA_RESPONSE.Render(removed, appended)
 
 	def SetSensorInfoRequest(self, uuid, sensors):
-		packet = self.GetHeader()
-		packet += "{\"command\":\"set_sensor_info\",\"direction\":\"request\",\"uuid\":\"" + uuid + "\",\"sensors\":[" + sensors + "]}"
-		packet += self.GetFooter()
-
-		return packet
+		return SET_SENSOR_INFO_REQUEST.Render(uuid, sensors)
 
 	def GetSensorInfoRequest(self):
-		packet = self.GetHeader()
-		packet += "{\"command\":\"get_sensor_info\",\"direction\":\"request\"}"
-		packet += self.GetFooter()
-
-		return packet
+		return GET_SENSOR_INFO_REQUEST
 
 	def GetSensorInfoResponse(self, uuid, sensors):
-		packet = self.GetHeader()
-		packet += "{\"command\":\"get_sensor_info\",\"direction\":\"response\",\"uuid\":\"" + uuid + "\",\"sensors\":[" + sensors + "]}"
-		packet += self.GetFooter()
-
-		return packet
+		return GET_SENSOR_INFO_RESPONSE.Render(uuid, sensors)
 
 	def ExitRequest(self):
-		packet = self.GetHeader()
-		packet += "{\"command\":\"exit\",\"direction\":\"request\"}"
-		packet += self.GetFooter()
-
-		return packet
+		return EXIT_REQUEST
 
 	def ExitResponse(self, status):
-		packet = self.GetHeader()
-		packet += "{\"command\":\"exit\",\"direction\":\"response\",\"status\":\"" + str(status) + "\"}"
-		packet += self.GetFooter()
-
-		return packet
-
-	def SendPingRequest(self, destination, source):
-		packet = self.GetHeader()
-		packet += json.dumps({	
-								'command': 'ping',
-								'direction': 'proxy_request',
-								'piggybag': 0,
-								'payload': {
-									'header': {
-										'destination': str(destination),
-										'source': str(source)
-									},
-									'data': {
-
-									}
-								}
-							})
-		packet += self.GetFooter()
-		return packet
-	
-	def SendListOfNodesRequest(self, destination, source):
-		packet = self.GetHeader()
-		packet += json.dumps({	
-								'command': 'nodes_list',
-								'direction': 'proxy_request',
-								'piggybag': 0,
-								'payload': {
-									'header': {
-										'destination': str(destination),
-										'source': str(source)
-									},
-									'data': {
-
-									}
-								}
-							})
-		packet += self.GetFooter()
-		return packet
-	
-	def NodeInfoRequest(self, destination, source):
-		packet = self.GetHeader()
-		packet += json.dumps({	
-								'command': 'get_node_info',
-								'direction': 'proxy_request',
-								'piggybag': 0,
-								'payload': {
-									'header': {
-										'destination': str(destination),
-										'source': str(source)
-									},
-									'data': {
-
-									}
-								}
-							})
-		packet += self.GetFooter()
-		return packet
-	
-	def SendMessageToNodeViaGatewayRequest(self, command, destination, source, data):
-		packet = self.GetHeader()
-		packet += json.dumps({	
-								'command': str(command),
-								'direction': 'proxy_request',
-								'piggybag': 0,
-								'payload': {
-									'header': {
-										'destination': str(destination),
-										'source': str(source)
-									},
-									'data': data
-								}
-							})
-		packet += self.GetFooter()
-		return packet
+		return EXIT_RESPONSE.Render(status)
+
+	def ProtocolNegotiateRequest(self, protocols):
+		return PROTOCOL_NEGOTIATE_REQUEST.Render(protocols)
+
+	def ProtocolNegotiateResponse(self, protocol):
+		return PROTOCOL_NEGOTIATE_RESPONSE.Render(protocol)
+
+	# request_id (0 - none) is echoed back in the response, see MkSPendingRequests.
+	def SendPingRequest(self, destination, source, request_id=0):
+		return PROXY_PACKET.Render("ping", "proxy_request", request_id, 0, destination, source, {})
+
+	def SendListOfNodesRequest(self, destination, source, request_id=0):
+		return PROXY_PACKET.Render("nodes_list", "proxy_request", request_id, 0, destination, source, {})
+
+	def NodeInfoRequest(self, destination, source, request_id=0):
+		return PROXY_PACKET.Render("get_node_info", "proxy_request", request_id, 0, destination, source, {})
+
+	def SendMessageToNodeViaGatewayRequest(self, command, destination, source, data, request_id=0):
+		return PROXY_PACKET.Render(command, "proxy_request", request_id, 0, destination, source, data)
 
 	def GenerateJsonProxyRequest(self, destination, source, command, data, piggy):
-		return {	
+		return {
 			'command': command,
 			'direction': 'proxy_request',
 			'piggybag': piggy,
@@ -191,9 +263,9 @@ class LocalNodeCommands:
 				'data': data
 			}
 		}
-	
+
 	def GenerateJsonProxyResponse(self, destination, source, command, data, piggy):
-		return {	
+		return {
 			'command': command,
 			'direction': 'proxy_response',
 			'piggybag': piggy,
@@ -206,21 +278,28 @@ class LocalNodeCommands:
 			}
 		}
 
-	def GatewayToProxyResponse(self, destination, source, command, data, piggy):
-		packet = self.GetHeader()
-		packet += json.dumps(self.GenerateJsonProxyResponse(destination, source, command, data, piggy))
-		packet += self.GetFooter()
-		return packet
+	def GatewayToProxyResponse(self, destination, source, command, data, piggy, request_id=0):
+		return PROXY_PACKET.Render(command, "proxy_response", request_id, piggy, destination, source, data)
 
-	def ProxyRequest(self, destination, source, command, data, piggy):
-		packet = self.GetHeader()
-		packet += json.dumps(self.GenerateJsonProxyRequest(destination, source, command, data, piggy))
-		packet += self.GetFooter()
-		return packet
+	def ProxyRequest(self, destination, source, command, data, piggy, request_id=0):
+		return PROXY_PACKET.Render(command, "proxy_request", request_id, piggy, destination, source, data)
 
-	def ProxyResponse(self, data, payload):
-		packet = self.GetHeader()
+	def ProxyRelayPacket(self, destination, source, command, direction, data_json, piggy, request_id=0):
+		return PROXY_RELAY_PACKET.Render(command, direction, request_id, piggy, destination, source, data_json)
+
+	# Gateway only echoes piggybag, so request id crosses it packed in piggybag.
+	def PackPiggybag(self, piggy, request_id):
+		if not request_id:
+			return piggy
+		return { 'request_id': request_id, 'piggybag': piggy }
 
+	# Return (piggy, request_id).
+	def UnpackPiggybag(self, piggy):
+		if isinstance(piggy, dict) and 2 == len(piggy) and 'request_id' in piggy and 'piggybag' in piggy:
+			return piggy['piggybag'], piggy['request_id']
+		return piggy, 0
+
+	def GenerateProxyResponse(self, data, payload):
 		source 		= data["payload"]["header"]["source"]
 		destination = data["payload"]["header"]["destination"]
 
@@ -229,37 +308,27 @@ class LocalNodeCommands:
 		data["payload"]["header"]["destination"] 	= source
 		data["payload"]["data"] 					= payload
 
-		packet += json.dumps(data)
-		packet += self.GetFooter()
-		return packet
+		return data
+
+	# Request packet may hold more keys than a proxy packet, so it is serialized as is.
+	def ProxyResponse(self, data, payload):
+		return b"".join(self.ProxyResponseSegments(data, payload))
+
+	# Frame as [header, body, footer] segments for SendData, body is not copied again.
+	def ProxyResponseSegments(self, data, payload):
+		return [MKS_HEADER_BYTES, ToBytes(EncodeJson(self.GenerateProxyResponse(data, payload))), MKS_FOOTER_BYTES]
 
 # =============== GetNodeInfo ==============================================================================================
 
 	def GetNodeInfoRequest(self, destination, source, data, is_proxy):
-		packet = self.GetHeader()
-
 		if (True == is_proxy):
 			direction = 'proxy_request'
 		else:
 			direction = 'request'
 
-		packet += json.dumps({	
-								'command': 'get_node_info',
-								'direction': direction,
-								'payload': {
-									'header': {
-										'destination': str(destination),
-										'source': str(source)
-									},
-									'data': data
-								}
-							})
-		packet += self.GetFooter()
-		return packet
+		return GET_NODE_INFO_REQUEST.Render(direction, destination, source, data)
 
 	def GetNodeInfoResponse(self, data):
-		packet = self.GetHeader()
-
 		if ("proxy" in data["direction"]):
 			direction = 'proxy_response'
 		else:
@@ -272,42 +341,12 @@ class LocalNodeCommands:
 		data["payload"]["header"]["source"] 		= destination
 		data["payload"]["header"]["destination"] 	= source
 
-		packet += json.dumps(data)
-		packet += self.GetFooter()
-		return packet
+		return ToBytes(MKS_HEADER + EncodeJson(data) + MKS_FOOTER)
 
 # =============== GetNodeInfo ==============================================================================================
 
 	def ProxyMessageRequest(self, destination, source, data):
-		packet = self.GetHeader()
-		packet += json.dumps({	
-								'command': 'proxy_gateway',
-								'direction': 'request',
-								'payload': {
-									'header': {
-										'destination': str(destination),
-										'source': str(source)
-									},
-									'data': data
-								}
-							})
-		packet += self.GetFooter()
-
-		return packet
+		return PROXY_GATEWAY_PACKET.Render("request", destination, source, data)
 
 	def ProxyMessageResponse(self, destination, source, data):
-		packet = self.GetHeader()
-		packet += json.dumps({	
-								'command': 'proxy_gateway',
-								'direction': 'response',
-								'payload': {
-									'header': {
-										'destination': str(destination),
-										'source': str(source)
-									},
-									'data': data
-								}
-							})
-		packet += self.GetFooter()
-
-		return packet
+		return PROXY_GATEWAY_PACKET.Render("response", destination, source, data)
@@ -6,69 +6,54 @@ import time
 if sys.version_info[0] < 3:
 	import thread
 else:
-	import _thread
+	import _thread as thread
 import threading
 import socket
 import subprocess
 from subprocess import call
-import urllib2
+if sys.version_info[0] < 3:
+	import urllib2
+else:
+	import urllib.request as urllib2
 import urllib
 
 from flask import Flask, render_template, jsonify, Response, request
 import logging
 
-import MkSGlobals
+from mksdk import MkSGlobals
 from mksdk import MkSFile
 from mksdk import MkSAbstractNode
 from mksdk import MkSLocalNodesCommands
 from mksdk import MkSShellExecutor
-
-class MachineInformation():
-	def __init__(self):
-		self.Terminal	= MkSShellExecutor.ShellExecutor()
-		self.Json 		= {
-			"cpu": {
-				"arch": "N/A"
-			},
-			"hdd": {
-				"capacity_ratio": "N/A"
-			},
-			"ram": {
-				"capacity_ratio": "N/A"
-			},
-			"sensors": {
-				"temp": "N/A",
-				"freq": "N/A"
-			},
-			"network": {
-				"ip": "N/A"
-			}
-		}
-
-		thread.start_new_thread(self.MachineInformationWorker_Thread, ())
-
-	def MachineInformationWorker_Thread(self):
-		while True:
-			if MkSGlobals.OS_TYPE in ["linux", "linux2"]:
-				self.Json["sensors"]["temp"] = str(self.Terminal.ExecuteCommand("cat /sys/devices/virtual/thermal/thermal_zone0/temp"))
-			time.sleep(5)
-
-	def GetInfo(self):
-		return self.Json
+from mksdk import MkSBinaryProtocol
+from mksdk import MkSProxyRelay
+from mksdk import MkSMessages
+from mksdk import MkSTopology
+from mksdk import MkSPortLeases
+from mksdk import MkSPipeReader
+from mksdk import MkSScreenBuffer
+from mksdk import MkSNodeSupervisor
+from mksdk import MkSHostMetrics
 
 class LocalPipe():
 	def __init__(self, uuid, pipe):
 		self.Uuid 	= uuid
 		self.Pipe 	= pipe
-		self.Buffer = []
+		self.Screen = MkSScreenBuffer.ScreenBuffer()
 
-	def ReadToBuffer(self):
-		if (len(self.Buffer) > 20):
-			self.Buffer = []
-		self.Buffer.append(self.Pipe.stdout.readline())
+	# Line of node output, read by MasterNode.PipeReader.
+	def AppendLine(self, line):
+		self.Screen.Append(line)
 
 	def ReadBuffer(self):
-		return self.Buffer
+		return self.Screen.GetLines()
+
+	# Return (lines, next offset, dropped lines) of output after offset.
+	def ReadSince(self, offset):
+		return self.Screen.ReadSince(offset)
+
+	def ReadTail(self, count):
+		return self.Screen.ReadTail(count)
 
 	def IsPipeError(self):
 		return self.Pipe.returncode is not None
@@ -94,14 +79,23 @@ class MasterNode(MkSAbstractNode.AbstractNode):
 		self.File 							= MkSFile.File()
 		self.Commands 						= MkSLocalNodesCommands.LocalNodeCommands()
 		self.Terminal 						= MkSShellExecutor.ShellExecutor()
-		self.MachineInfo 					= MachineInformation()
-		self.PortsForClients				= [1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,31,32]
+		# Host metrics read from /proc and /sys, served from cache.
+		self.MachineInfo 					= MkSHostMetrics.HostMetricsSampler(ip=str(self.MyLocalIP))
+		# CPU, RSS, fds and threads of started nodes, sampled with host metrics.
+		self.NodeResources 					= MkSHostMetrics.ProcessAccounting()
+		self.MachineInfo.AddSampler(self.NodeResources)
+		# Slave ports, kept for a reconnecting slave (same UUID) for lease time.
+		self.PortLeases 					= MkSPortLeases.PortLeaseAllocator([(10001, 10999)], lease_time=300)
 		self.MasterHostName					= socket.gethostname()
 		self.MasterVersion					= "1.0.1"
 		self.PackagesList					= ["Gateway","LinuxTerminal","USBManager"] # Default Master capabilities.
 		self.LocalSlaveList					= [] # Used ONLY by Master.
 		self.InstalledNodes 				= []
 		self.Pipes 							= []
+		self.NodeCommands 					= {} # UUID -> (command, path) of installed nodes that can be started
+		# Output of started nodes, all pipes are read by one thread.
+		self.PipeReader 					= MkSPipeReader.PipeReader(self.OnPipeLine, self.OnPipeExit)
+		self.ShellTailLines 				= 20 # Lines of a shell request without offset
 		self.InstalledApps 					= None
 		# Sates
 		self.States = {
@@ -113,22 +107,41 @@ class MasterNode(MkSAbstractNode.AbstractNode):
 			'get_port': 					self.GetPortRequestHandler,
 			'get_local_nodes': 				self.GetLocalNodesRequestHandler,
 			'get_master_info':				self.GetMasterInfoRequestHandler,
-			'get_file':						self.GetFileHandler,
-			'upload_file':					self.UploadFileHandler
+			'topology_subscribe':			self.TopologySubscribeRequestHandler
 		}
 		self.ResponseHandlers 				= {
 		}
+		# Requests from Gateway to master itself (no socket)
+		self.GatewayRequestHandlers			= {
+			'get_file':						self.GetFileHandler,
+			'upload_file':					self.UploadFileHandler
+		}
+		# Dispatch (packet is decoded once by AbstractNode)
+		self.RegisterDispatchHandlers(["request"], self.RequestHandlers)
+		self.RegisterDispatchHandlers(["response"], self.ResponseHandlers)
+		self.SetDispatchDefault(["request"], self.HandlerRouter_Request)
+		self.SetDispatchDefault(["response"], self.HandlerRouter_Response)
+		self.SetDispatchDefault(["proxy_request", "proxy_response"], self.HandlerRouter_Proxy)
 		# Callbacks
 		self.OnCustomCommandRequestCallback		= None
 		self.OnCustomCommandResponseCallback	= None
 		# Flags
 		self.IsListenerEnabled 				= False
-		self.PipeStdoutRun					= False
+		self.IsProxyRelayEnabled 			= True # Relay proxy payloads without decoding them
+		self.ProxyRelayMinSize 				= 8192 # Smaller messages are as fast or faster to decode
+		self.RawFrameHandler 				= self.RelaySlaveFrame
+		# Slave joins and leaves are broadcast as merged deltas.
+		self.TopologyBatcher 				= MkSTopology.TopologyDeltaBatcher(self.Broadcast, self.Timers)
+		# Node list responses are cached until a slave joins or leaves.
+		self.Topology 						= MkSTopology.TopologySnapshot(self.GetTopologyNodes)
+		# Installed nodes are started in parallel and restarted when they crash.
+		self.Supervisor 					= MkSNodeSupervisor.NodeSupervisor(self.SpawnNode, self.Timers, parallel=4)
 
 		self.ChangeState("IDLE")
 		self.LoadNodesOnMasterStart()
 
-		thread.start_new_thread(self.PipeStdoutListener_Thread, ())
+		self.PipeReader.Start()
+		self.MachineInfo.Start()
 
 	def GetFileHandler(self, packet):
 		print ("[MasterNode] GetFileHandler")
@@ -162,7 +175,6 @@ class MasterNode(MkSAbstractNode.AbstractNode):
 		}
 		'''
 
-		objFile 	= MkSFile.File()
 		uiType 		= packet["data"]["payload"]["ui_type"]
 		fileType 	= packet["data"]["payload"]["file_type"]
 		fileName 	= packet["data"]["payload"]["file_name"]
@@ -175,16 +187,16 @@ class MasterNode(MkSAbstractNode.AbstractNode):
 
 		path = os.path.join(".","ui",folder[uiType],"ui." + fileType)
 		print (path)
-		content = objFile.LoadStateFromFile(path)
-		
+		replacements = []
 		if ("html" in fileType):
-			content = content.replace("[NODE_UUID]", self.UUID)
-			content = content.replace("[GATEWAY_IP]", self.GatewayIP)
+			replacements = [("[NODE_UUID]", self.UUID), ("[GATEWAY_IP]", self.GatewayIP)]
+		# Gateway takes JSON only.
+		content, encoding = MkSFile.LoadUIFileContent(path, replacements, "hex")
 		
 		resPayload = {
 			'file_type': fileType,
 			'ui_type': uiType,
-			'content': content.encode('hex')
+			'content': content
 		}
 
 		command 	= packet['data']['header']['command']
@@ -206,7 +218,7 @@ class MasterNode(MkSAbstractNode.AbstractNode):
 		if "ykiveish" in key:
 			response = "{\"response\":\"OK\",\"payload\":{\"list\":["
 			for idx, item in enumerate(self.GetInstalledNodes()):
-				response += "{\"uuid\":\"" + str(item.UUID) + "\",\"type\":\"" + str(item.Type) + "\",\"ip\":\"" + str(item.IP) + "\",\"port\":" + str(item.Port) + ",\"widget_port\":" + str(item.Port - 10000) + ",\"status\":\"" + str(item.Status) + "\"},"
+				response += "{\"uuid\":\"" + str(item.UUID) + "\",\"type\":\"" + str(item.Type) + "\",\"ip\":\"" + str(item.IP) + "\",\"port\":" + str(item.Port) + ",\"widget_port\":" + str(item.Port - 10000) + ",\"status\":\"" + str(item.Status) + "\",\"resources\":" + json.dumps(self.GetNodeResources(item.UUID, False)) + "},"
 			response = response[:-1] + "]}}"
 			return jsonify(response)
 		else:
@@ -242,10 +254,21 @@ class MasterNode(MkSAbstractNode.AbstractNode):
 		if action in "Stop":
 			self.ExitRemoteNode(uuid)
 		elif action in "Start":
-			self.StartRemoteNode(uuid)
+			if self.StartRemoteNode(uuid) is False:
+				return "{\"response\":\"FAILED\"}"
 		elif action in "shell":
-			shell = self.GetShellScreen(uuid)
-			return "{\"response\":\"OK\",\"shell\":" + str(json.dumps(shell)) + "}"
+			# UI passes back the offset it got to receive only new lines, without
+			# one it gets the last lines of the screen.
+			offset = data.get("offset")
+			if offset is None:
+				shell, offset, dropped = self.GetShellScreenTail(uuid, self.ShellTailLines)
+			else:
+				try:
+					offset = int(offset)
+				except (TypeError, ValueError):
+					return "{\"response\":\"FAILED\"}"
+				shell, offset, dropped = self.GetShellScreenSince(uuid, max(0, offset))
+			return "{\"response\":\"OK\",\"shell\":" + str(json.dumps(shell)) + ",\"offset\":" + str(offset) + ",\"dropped\":" + str(dropped) + "}"
 
 		# Send response
 		return "{\"response\":\"OK\"}"
@@ -266,7 +289,7 @@ class MasterNode(MkSAbstractNode.AbstractNode):
 		return "{\"response\":\"OK\",\"shell\":" + str(json.dumps(rows)) + "}"
 
 	def GetNodeConfigInfoHandler(self, key):
-		return str(json.dumps(self.MachineInfo.GetInfo()))
+		return self.MachineInfo.GetInfoJson()
 
 	def GetApplicationListHandler(self, key):
 		jsonCxt = self.InstalledApps
@@ -368,10 +391,8 @@ class MasterNode(MkSAbstractNode.AbstractNode):
 	# Sending response to "get_node_info" request (mostly for proxy request)
 	def GetNodeInfoResponseHandler(self, sock, packet):
 		print ("[DEBUG MASTER] GetNodeInfoResponseHandler")
-		source 		= packet["payload"]["header"]["source"]
-		destination = packet["payload"]["header"]["destination"]
-		command 	= packet["command"]
-		payload 	= packet["payload"]["data"]
+		# Packet is decoded already, plain dict access is the cheapest routing.
+		header 		= packet["payload"]["header"]
 		# This data traveling from App request and back to App
 		piggy  		= packet["piggybag"]
 
@@ -379,7 +400,7 @@ class MasterNode(MkSAbstractNode.AbstractNode):
 		# 		 Otherwise this is a response to master request. (MUST HANDLE IT LOCALY)
 
 		if self.OnSlaveResponseCallback is not None:
-			self.OnSlaveResponseCallback("response", destination, source, command, payload, piggy)
+			self.OnSlaveResponseCallback("response", header["destination"], header["source"], packet["command"], packet["payload"]["data"], piggy)
 
 	def GetNodeStatusRequestHandler(self, sock, packet):
 		pass
@@ -391,8 +412,8 @@ class MasterNode(MkSAbstractNode.AbstractNode):
 		command = packet["data"]["header"]['command']
 		print ("[MasterNode] HandleInternalReqest", command)
 		
-		if command in self.RequestHandlers:
-			self.RequestHandlers[command](packet)
+		if command in self.GatewayRequestHandlers:
+			self.GatewayRequestHandlers[command](packet)
 
 	# PROXY - Application -> Slave Node
 	def HandleExternalRequest(self, packet):
@@ -405,20 +426,69 @@ class MasterNode(MkSAbstractNode.AbstractNode):
 
 		node = self.GetSlaveNode(destination)
 		if node is not None:
-			if (direction in "response"):
+			if self.IsCongested(node.Socket) is True:
+				# Slow slave, requester times out instead of master memory growing.
+				print ("[MasterNode] HandleInternalReqest NODE CONGESTED, dropped", destination)
+			elif ("response" == direction):
 				# TODO - Incorrect translation between websocket prot to socket prot
-				msg = self.Commands.GatewayToProxyResponse(destination, source, command, data, piggy)
-				node.Socket.send(msg)
+				piggy, requestId = self.Commands.UnpackPiggybag(piggy)
+				msg = self.Commands.GatewayToProxyResponse(destination, source, command, data, piggy, requestId)
+				self.SendData(node.Socket, msg)
 				print ("[MasterNode] HandleInternalReqest RESPONSE")
-			elif (direction in "request"):
+			elif ("request" == direction):
 				msg = self.Commands.ProxyRequest(destination, source, command, data, piggy)
-				node.Socket.send(msg)
+				self.SendData(node.Socket, msg)
 				print ("[MasterNode] HandleInternalReqest REQUEST")
 		else:
 			print ("[MasterNode] HandleInternalReqest NODE NOT FOUND")
 			# Need to look at other masters list.
 			pass
 
+	# PROXY - Application -> Slave Node, only header fields are rewritten.
+	# Return False if message must be handled by HandleExternalRequest.
+	def RelayExternalRequest(self, message):
+		if self.IsProxyRelayEnabled is False:
+			return False
+		node = self.GetSlaveNode(message.Destination)
+		if node is None:
+			return False
+		if self.IsCongested(node.Socket) is True:
+			print ("[MasterNode] RelayExternalRequest NODE CONGESTED, dropped", message.Destination)
+			return True
+		if ("response" == message.Direction):
+			piggy, requestId = self.Commands.UnpackPiggybag(message.Piggy)
+			msg = self.Commands.ProxyRelayPacket(message.Destination, message.Source, message.Command, "proxy_response", message.Payload, piggy, requestId)
+		elif ("request" == message.Direction):
+			msg = self.Commands.ProxyRelayPacket(message.Destination, message.Source, message.Command, "proxy_request", message.Payload, message.Piggy)
+		else:
+			return False
+		self.SendData(node.Socket, msg)
+		return True
+
+	# PROXY - Slave Node -> Application, payload is not decoded.
+	# Return False if frame must be decoded and dispatched.
+	def RelaySlaveFrame(self, sock, data):
+		if self.IsProxyRelayEnabled is False or self.OnSlaveRelayCallback is None or len(data) < self.ProxyRelayMinSize:
+			return False
+		if isinstance(data, bytes) and bytes is not str:
+			data = data.decode('utf-8')
+		# Packets built by LocalNodeCommands have direction in front.
+		if '"direction":"proxy_' not in data[:256]:
+			return False
+		message = MkSMessages.ProxyMessage.Decode(data)
+		if message is None or (message.Direction, message.Command) in self.DispatchTable:
+			return False
+		if "proxy_request" == message.Direction:
+			direction 	= "request"
+			piggy 		= self.Commands.PackPiggybag(message.Piggy, message.RequestID)
+		elif "proxy_response" == message.Direction:
+			direction 	= "response"
+			piggy 		= message.Piggy
+		else:
+			return False
+		self.OnSlaveRelayCallback(direction, message.Destination, message.Source, message.Command, message.DataJson, piggy)
+		return True
+
 	def LoadNodesOnMasterStart(self):
 		jsonInstalledNodesStr 	= ""
 		jsonInstalledAppsStr 	= ""
@@ -437,6 +507,11 @@ class MasterNode(MkSAbstractNode.AbstractNode):
 					node.Status = "Running"
 				else:
 					node = LocalNode("", 0, item["uuid"], item["type"], None)
+					# Nodes with a start command are supervised.
+					if "command" in item:
+						self.NodeCommands[item["uuid"]] = (item["command"], item.get("path"))
+						if item.get("autostart", True) is True:
+							self.Supervisor.Add(item["uuid"], item["command"], item.get("path"))
 				self.InstalledNodes.append(node)
 
 		if MkSGlobals.OS_TYPE == "win32":
@@ -466,105 +541,100 @@ class MasterNode(MkSAbstractNode.AbstractNode):
 		if True == status:
 			self.IsListenerEnabled = True
 			self.ChangeState("WORKING")
-		time.sleep(1)
+			# Nodes ask for a port as soon as they run, start them once listening.
+			self.Supervisor.StartAll()
+		# Retried on next state tick, sleeping here would stall the loop.
 
 	def StateWorking(self):
-		if 0 == self.Ticker % 20:
-			pass
+		pass
 
 	def GetPortRequestHandler(self, sock, packet):
-		nodeType 	= packet['type']
-		uuid 		= packet['uuid']
-		name 		= packet['name']
+		request 	= MkSMessages.PortRequest.FromPacket(packet)
+		nodeType 	= request.Type
+		uuid 		= request.UUID
+		name 		= request.Name
 		print ("[MASTER]: GetPortRequestHandler")
-		# Do we have available port.
-		if self.PortsForClients:
-			node = self.GetConnection(sock)
-			existingSlave = None
-			for slave in self.LocalSlaveList:
-				if slave.UUID == node.UUID:
-					existingSlave = slave
-					continue
-			if None == existingSlave:
-				# New request
-				port = 10000 + self.PortsForClients.pop()
-				# Update node
-				node.Type = nodeType
-				node.Port = port
-				node.UUID = uuid
-				node.SetNodeName(name)
-
-				# Update installed node list (UI will be updated)
-				for item in self.InstalledNodes:
-					# print item.UUID + "<?>" + node.UUID
-					if item.UUID == node.UUID:
-						item.IP 	= node.IP
-						item.Port 	= node.Port
-						item.Status = "Running"
-
-				# Send message to all nodes.
-				paylod = self.Commands.MasterAppendNodeResponse(node.IP, port, node.UUID, nodeType)
-				for client in self.Connections:
-					if client.Socket == self.ServerSocket:
-						pass
-					else:
-						client.Socket.send(paylod)
-				self.LocalSlaveList.append(node)
-				payload = self.Commands.GetPortResponse(port)
-				# print payload
-				sock.send(payload)
-
-				# TODO - What will happen when slave node will try to get port when we are not connected to AWS?
-				# Send message to Gateway
-				if self.OnNewNodeCallback is not None:
-					self.OnNewNodeCallback({ 'ip':		str(node.IP), 
-											 'port':	port, 
-											 'uuid':	node.UUID, 
-											 'type':	nodeType,
-											 'name':	str(node.Name)
-											})
-			else:
-				# Already assigned port (resending)
-				payload = self.Commands.GetPortResponse(node.Port)
-				sock.send(payload)
-		else:
+		node = self.GetConnection(sock)
+		existingSlave = None
+		if node.UUID:
+			existingSlave = self.GetSlaveNode(node.UUID)
+		if existingSlave is not None:
+			# Already assigned port (resending)
+			payload = self.Commands.GetPortResponse(node.Port)
+			self.SendData(sock, payload)
+			return
+
+		# New request, reconnecting slave gets its previous port.
+		port = self.PortLeases.Allocate(uuid)
+		if 0 == port:
 			# No available ports
 			payload = self.Commands.GetPortResponse(0)
-			sock.send(payload)
+			self.SendData(sock, payload)
+			return
+		# Node is WORKING once it has a port.
+		self.Supervisor.OnReady(uuid)
+
+		# Update node
+		node.Type = nodeType
+		self.SetConnectionAddress(node, node.IP, port)
+		self.SetConnectionUUID(node, uuid)
+		node.SetNodeName(name)
+
+		# Update installed node list (UI will be updated)
+		for item in self.InstalledNodes:
+			# print item.UUID + "<?>" + node.UUID
+			if item.UUID == node.UUID:
+				item.IP 	= node.IP
+				item.Port 	= node.Port
+				item.Status = "Running"
+
+		# Send message to all nodes.
+		self.TopologyBatcher.Append(MkSMessages.NodeItem(node.IP, port, node.UUID, nodeType))
+		self.LocalSlaveList.append(node)
+		self.Topology.Invalidate()
+		payload = self.Commands.GetPortResponse(port)
+		# print payload
+		self.SendData(sock, payload)
+
+		# TODO - What will happen when slave node will try to get port when we are not connected to AWS?
+		# Send message to Gateway
+		if self.OnNewNodeCallback is not None:
+			self.OnNewNodeCallback({ 'ip':		str(node.IP), 
+									 'port':	port, 
+									 'uuid':	node.UUID, 
+									 'type':	nodeType,
+									 'name':	str(node.Name)
+									})
+
+	def GetTopologyNodes(self):
+		return [MkSMessages.NodeItem.FromNode(node) for node in self.LocalSlaveList]
 
 	def GetLocalNodesRequestHandler(self, sock, packet):
-		nodes = ""
-		if self.LocalSlaveList:
-			for node in self.LocalSlaveList:
-				#nodes += "{\"ip\":\"{ip}\",\"port\":\"{port}\",\"uuid\":\"{uuid}\",\"type\":\"{type}\"},".format(ip = str(node.IP), port = str(node.Port), uuid = node.UUID, type = str(node.Type))
-				nodes += "{\"ip\":\"" + str(node.IP) + "\",\"port\":" + str(node.Port) + ",\"uuid\":\"" + node.UUID + "\",\"type\":" + str(node.Type) + "},"
-			if nodes is not "":
-				nodes = nodes[:-1]
-		payload = self.Commands.GetLocalNodesResponse(nodes)
-		sock.send(payload)
+		request = MkSMessages.TopologyRequest.FromPacket(packet)
+		payload = self.Topology.LocalNodesResponse(request.Version)
+		self.SendData(sock, payload)
 
 	def GetMasterInfoRequestHandler(self, sock, packet):
-		nodes = ""
-		if self.LocalSlaveList:
-			for node in self.LocalSlaveList:
-				#nodes += "{\"ip\":\"{ip}\",\"port\":\"{port}\",\"uuid\":\"{uuid}\",\"type\":\"{type}\"},".format(ip = str(node.IP), port = str(node.Port), uuid = node.UUID, type = str(node.Type))
-				nodes += "{\"ip\":\"" + str(node.IP) + "\",\"port\":" + str(node.Port) + ",\"uuid\":\"" + node.UUID + "\",\"type\":" + str(node.Type) + "},"
-			if nodes is not "":
-				nodes = nodes[:-1]
-		payload = self.Commands.GetMasterInfoResponse(self.UUID, self.MasterHostName, nodes)
-		sock.send(payload)
+		request = MkSMessages.TopologyRequest.FromPacket(packet)
+		payload = self.Topology.MasterInfoResponse(self.MasterHostName, self.UUID, request.Version)
+		self.SendData(sock, payload)
+
+	# Snapshot now, joins and leaves are broadcast to every connection after it.
+	def TopologySubscribeRequestHandler(self, sock, packet):
+		# Snapshot is built from the slave list, so it has the joins the batcher
+		# still holds. They go out first, otherwise a leave in the same window
+		# cancels the join and the subscriber never hears the node is gone.
+		self.TopologyBatcher.Flush()
+		self.SendData(sock, self.Topology.SubscribeResponse())
 
 	def GetNodeInfoRequestHandler(self, sock, packet):
 		direction = packet['direction']
 		if (direction in "proxy_request"):
 			# Send data response to requestor via MkSNode module.
 			if self.OnSlaveResponseCallback is not None:
-				command 	= packet['command']
-				source 		= packet["payload"]["header"]["source"]
-				destination = packet["payload"]["header"]["destination"]
-				payload 	= packet["payload"]["data"]
-				piggy 		= packet["piggybag"]
-				self.OnSlaveResponseCallback("request", destination, source, command, payload, piggy)
+				header 	= packet["payload"]["header"]
+				piggy 	= self.Commands.PackPiggybag(packet["piggybag"], packet.get("request_id", 0))
+				self.OnSlaveResponseCallback("request", header["destination"], header["source"], packet["command"], packet["payload"]["data"], piggy)
 	
 	# INBOUND
 	def HandlerRouter_Request(self, sock, packet):
@@ -589,39 +659,30 @@ class MasterNode(MkSAbstractNode.AbstractNode):
 	# OUTBOUND PROXY
 	def HandlerRouter_Proxy(self, sock, json_data):
 		print ("[MasterNode] HandlerRouter_ProxyResponse")
+		# File content from binary connection, Gateway takes JSON only.
+		MkSBinaryProtocol.AttachmentToText(json_data)
+		# Packet is decoded already, plain dict access is the cheapest routing.
 		command 	= json_data['command']
-		source 		= json_data["payload"]["header"]["source"]
-		destination = json_data["payload"]["header"]["destination"]
+		header 		= json_data["payload"]["header"]
 		payload 	= json_data["payload"]["data"]
 		piggy 		= json_data["piggybag"]
 		direction 	= json_data['direction']
 
 		# Send data response to requestor via MkSNode module.
 		if self.OnSlaveResponseCallback is not None:
-			if (direction in "proxy_request"):
-				self.OnSlaveResponseCallback("request", destination, source, command, payload, piggy)
-			elif (direction in "proxy_response"):
-				self.OnSlaveResponseCallback("response", destination, source, command, payload, piggy)
+			if "proxy_request" == direction:
+				piggy = self.Commands.PackPiggybag(piggy, json_data.get("request_id", 0))
+				self.OnSlaveResponseCallback("request", header["destination"], header["source"], command, payload, piggy)
+			elif "proxy_response" == direction:
+				self.OnSlaveResponseCallback("response", header["destination"], header["source"], command, payload, piggy)
 			else:
 				print("[MasterNode] ERROR - HandlerRouter_Proxy")
 
-	# Description - Handling input date from local server.
-	def HandlerRouter(self, sock, data):
-		jsonData 	= json.loads(data)
-		direction 	= jsonData['direction']
-
-		if "response" == direction:
-			self.HandlerRouter_Response(sock, jsonData)
-		elif "request" == direction:
-			self.HandlerRouter_Request(sock, jsonData)
-		elif direction in ["proxy_request", "proxy_response"]:
-			self.HandlerRouter_Proxy(sock, jsonData)
-
 	def NodeDisconnectHandler(self, sock):
 		print ("NodeDisconnectHandler")
 		for slave in self.LocalSlaveList:
 			if slave.Socket == sock:
-				self.PortsForClients.append(slave.Port - 10000)
+				self.PortLeases.Release(slave.Port)
 
 				# Update installed node list (UI will be updated)
 				for item in self.InstalledNodes:
@@ -630,14 +691,8 @@ class MasterNode(MkSAbstractNode.AbstractNode):
 						item.Port 	= 0
 						item.Status = "Stopped"
 
-				payload = self.Commands.MasterRemoveNodeResponse(slave.IP, slave.Port, slave.UUID, slave.Type)
 				# Send to all nodes
-				for client in self.Connections:
-					if client.Socket == self.ServerSocket or client.Socket == sock:
-						pass
-					else:
-						if client.Socket is not None:
-							client.Socket.send(payload)
+				self.TopologyBatcher.Remove(MkSMessages.NodeItem.FromNode(slave))
 
 				# Send message to Gateway
 				if self.OnSlaveNodeDisconnectedCallback is not None:
@@ -648,25 +703,42 @@ class MasterNode(MkSAbstractNode.AbstractNode):
 														})
 
 				self.LocalSlaveList.remove(slave)
-				continue
+				self.Topology.Invalidate()
+				# A socket belongs to one slave.
+				break
 
 	def GetSlaveNode(self, uuid):
-		for item in self.LocalSlaveList:
-			if item.UUID == uuid:
-				return item
+		# Only slaves get UUID on master side (on get_port), except the listener.
+		node = self.GetNodeByUUID(uuid)
+		if node is not None and node.Socket is not self.ServerSocket:
+			return node
 		return None
 
 	def GetInstalledNodes(self):
 		return self.InstalledNodes
 
+	# Latest CPU, RSS, fds and threads of a started node, None if it was not started.
+	def GetNodeResources(self, uuid, history=True):
+		return self.NodeResources.GetInfo(uuid, history)
+
+	def GetInstalledNodesResources(self):
+		return dict((item.UUID, self.GetNodeResources(item.UUID, False)) for item in self.InstalledNodes)
+
 	def ExitRemoteNode(self, uuid):
+		process = self.Supervisor.Stop(uuid)
+		self.NodeResources.Remove(uuid)
 		node = self.GetNodeByUUID(uuid)
-		if node is not None:
+		if node is None:
+			# Starting or waiting to restart, no socket to send exit on.
+			if process is not None and process.poll() is None:
+				process.terminate()
+		else:
 			payload = self.Commands.ExitRequest()
-			node.Socket.send(payload)
+			self.SendData(node.Socket, payload)
 			# Remove pipe (note better to do it on response of exit command)
 			for item in self.Pipes:
 				if item.Uuid == uuid:
+					self.PipeReader.Remove(uuid)
 					self.Pipes.remove(item)
 					return
 
@@ -675,21 +747,64 @@ class MasterNode(MkSAbstractNode.AbstractNode):
 			if item.Uuid == uuid:
 				return item.ReadBuffer()
 
-	def PipeStdoutListener_Thread(self):
-		self.PipeStdoutRun = True
-		while True == self.PipeStdoutRun:
-			for item in self.Pipes:
-				if item.IsPipeError():
-					print str(item.GetError())
-				item.ReadToBuffer()
-			time.sleep(0.5)
+	def GetShellScreenSince(self, uuid, offset):
+		pipe = self.GetPipe(uuid)
+		if pipe is None:
+			return [], 0, 0
+		return pipe.ReadSince(offset)
 
+	def GetShellScreenTail(self, uuid, count):
+		pipe = self.GetPipe(uuid)
+		if pipe is None:
+			return [], 0, 0
+		return pipe.ReadTail(count)
+
+	def GetPipe(self, uuid):
+		for item in self.Pipes:
+			if item.Uuid == uuid:
+				return item
+		return None
+
+	# Called by PipeReader thread.
+	def OnPipeLine(self, uuid, stream, line):
+		pipe = self.GetPipe(uuid)
+		if pipe is not None:
+			pipe.AppendLine(line)
+
+	# Called by PipeReader thread when all pipes of the node are closed and it exited.
+	def OnPipeExit(self, uuid, returncode):
+		print ("[MasterNode] Node process exited", uuid, returncode)
+		self.NodeResources.MarkExited(uuid)
+		self.Supervisor.OnExit(uuid, returncode)
+
+	# Only nodes with a command in installed_nodes.json can be started.
 	def StartRemoteNode(self, uuid):
-		path = "/home/yevgeniy/workspace/makesense/mksnodes/1981"
-		proc = subprocess.Popen(["python", '-u', "../1981/1981.py", "--path", path], stdout=subprocess.PIPE)
+		if self.Supervisor.GetNode(uuid) is None:
+			if uuid not in self.NodeCommands:
+				print ("[MasterNode] StartRemoteNode ERROR, no command for node", uuid)
+				return False
+			command, path = self.NodeCommands[uuid]
+			self.Supervisor.Add(uuid, command, path)
+		return self.Supervisor.Start(uuid)
+
+	# Called by Supervisor, output of the new process replaces the old one.
+	def SpawnNode(self, node):
+		proc = subprocess.Popen(node.Command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=node.WorkingDir)
+
+		pipe = self.GetPipe(node.UUID)
+		if pipe is None:
+			pipe = LocalPipe(node.UUID, proc)
+			self.Pipes.append(pipe)
+		else:
+			pipe.Pipe = proc
+		self.PipeReader.Add(node.UUID, proc)
+		self.NodeResources.Add(node.UUID, proc.pid)
+		return proc
 
-		pipe = LocalPipe(uuid, proc)
-		self.Pipes.append(pipe)
+	def GetSupervisorStatus(self):
+		return self.Supervisor.GetStatus()
 
 	def ExitRoutine(self):
-		self.Terminal.Stop()
\ No newline at end of file
+		self.Terminal.Stop()
+		self.PipeReader.Stop()
+		self.MachineInfo.Stop()
\ No newline at end of file
@@ -0,0 +1,298 @@
+#!/usr/bin/python
+import os
+import sys
+import json
+
+from mksdk import MkSLocalNodesCommands
+from mksdk import MkSProxyRelay
+
+# Typed messages of the local protocol.
+#
+# Routing code reads attributes instead of indexing nested dicts. Decode()
+# of a proxy message scans only routing members and keeps data as JSON text,
+# it is decoded on first access of Data and encoded back as is when the
+# message is forwarded untouched. Encode() returns the framed packet (bytes).
+
+NOT_DECODED = object()
+
+class ProxyMessage(object):
+	__slots__ = ('Command', 'Direction', 'RequestID', 'Piggy', 'Destination', 'Source', 'DataJson', 'DataValue')
+
+	def __init__(self, command, direction, destination, source, data=None, piggy=0, request_id=0, data_json=None):
+		self.Command 		= command
+		self.Direction 		= direction
+		self.Destination 	= destination
+		self.Source 		= source
+		self.Piggy 			= piggy
+		self.RequestID 		= request_id
+		self.DataJson 		= data_json
+		self.DataValue 		= data
+		if data_json is not None:
+			self.DataValue = NOT_DECODED
+
+	@property
+	def Data(self):
+		if self.DataValue is NOT_DECODED:
+			self.DataValue = json.loads(self.DataJson)
+		return self.DataValue
+
+	def IsProxy(self):
+		return "proxy" in self.Direction
+
+	# Body (JSON text) of a proxy packet, None if it is not one.
+	@staticmethod
+	def Decode(text):
+		try:
+			members, end 	= MkSProxyRelay.ScanObject(text, 0, MkSProxyRelay.LOCAL_SPEC)
+			header 			= members["payload"]["header"]
+			return ProxyMessage(members["command"], members["direction"], header["destination"], header["source"],
+								piggy=members.get("piggybag", 0), request_id=members.get("request_id", 0), data_json=members["payload"]["data"])
+		except (KeyError, IndexError, ValueError, TypeError, AttributeError):
+			return None
+
+	@staticmethod
+	def FromPacket(packet):
+		header = packet["payload"]["header"]
+		return ProxyMessage(packet["command"], packet["direction"], header["destination"], header["source"],
+							packet["payload"].get("data"), packet.get("piggybag", 0), packet.get("request_id", 0))
+
+	def ToPacket(self):
+		return {
+			'command': self.Command,
+			'direction': self.Direction,
+			'request_id': self.RequestID,
+			'piggybag': self.Piggy,
+			'payload': {
+				'header': {
+					'destination': self.Destination,
+					'source': self.Source
+				},
+				'data': self.Data
+			}
+		}
+
+	def Encode(self):
+		if self.DataValue is NOT_DECODED:
+			return MkSLocalNodesCommands.PROXY_RELAY_PACKET.Render(self.Command, self.Direction, self.RequestID, self.Piggy, self.Destination, self.Source, self.DataJson)
+		return MkSLocalNodesCommands.PROXY_PACKET.Render(self.Command, self.Direction, self.RequestID, self.Piggy, self.Destination, self.Source, self.Data)
+
+	# Response goes back to the source, piggybag and request id are echoed.
+	def Response(self, data):
+		direction = "response"
+		if self.IsProxy() is True:
+			direction = "proxy_response"
+		return ProxyMessage(self.Command, direction, self.Source, self.Destination, data, self.Piggy, self.RequestID)
+
+class PortRequest(object):
+	__slots__ = ('UUID', 'Type', 'Name')
+
+	def __init__(self, uuid, node_type, name):
+		self.UUID 	= uuid
+		self.Type 	= node_type
+		self.Name 	= name
+
+	@staticmethod
+	def FromPacket(packet):
+		return PortRequest(packet["uuid"], packet["type"], packet.get("name", ""))
+
+	def Encode(self):
+		return MkSLocalNodesCommands.GET_PORT_REQUEST.Render(self.UUID, self.Type, self.Name)
+
+class PortResponse(object):
+	__slots__ = ('Port',)
+
+	def __init__(self, port):
+		self.Port = port
+
+	@staticmethod
+	def FromPacket(packet):
+		return PortResponse(packet["port"])
+
+	def Encode(self):
+		return MkSLocalNodesCommands.GET_PORT_RESPONSE.Render(self.Port)
+
+class NodeItem(object):
+	__slots__ = ('IP', 'Port', 'UUID', 'Type')
+
+	def __init__(self, ip, port, uuid, node_type):
+		self.IP 	= ip
+		self.Port 	= port
+		self.UUID 	= uuid
+		self.Type 	= node_type
+
+	@staticmethod
+	def FromPacket(item):
+		return NodeItem(item["ip"], item["port"], item["uuid"], item["type"])
+
+	@staticmethod
+	def FromNode(node):
+		return NodeItem(node.IP, node.Port, node.UUID, node.Type)
+
+	def ToDict(self):
+		return { 'ip': self.IP, 'port': self.Port, 'uuid': self.UUID, 'type': self.Type }
+
+	# JSON fragment (no frame).
+	def Encode(self):
+		return MkSLocalNodesCommands.LOCAL_NODE_ITEM.Render(self.IP, self.Port, self.UUID, self.Type)
+
+def EncodeNodes(nodes):
+	return ",".join([node.Encode() for node in nodes])
+
+# Version of the topology a client has, 0 (or missing) asks for the full list.
+class TopologyRequest(object):
+	__slots__ = ('Command', 'Version')
+
+	def __init__(self, command, version=0):
+		self.Command 	= command
+		self.Version 	= version
+
+	@staticmethod
+	def FromPacket(packet):
+		version = packet.get("version", 0)
+		if not isinstance(version, int):
+			version = 0
+		return TopologyRequest(packet["command"], version)
+
+	def Encode(self):
+		if not self.Version:
+			if 'get_master_info' == self.Command:
+				return MkSLocalNodesCommands.GET_MASTER_INFO_REQUEST
+			return MkSLocalNodesCommands.GET_LOCAL_NODES_REQUEST
+		if 'get_master_info' == self.Command:
+			return MkSLocalNodesCommands.GET_MASTER_INFO_VERSION_REQUEST.Render(self.Version)
+		return MkSLocalNodesCommands.GET_LOCAL_NODES_VERSION_REQUEST.Render(self.Version)
+
+# Reply to a topology request of a client that already has this version.
+class TopologyNotModified(object):
+	__slots__ = ('Command', 'Version')
+
+	def __init__(self, command, version):
+		self.Command 	= command
+		self.Version 	= version
+
+	@staticmethod
+	def FromPacket(packet):
+		return TopologyNotModified(packet["command"], packet["version"])
+
+	def Encode(self):
+		return MkSLocalNodesCommands.TOPOLOGY_NOT_MODIFIED_RESPONSE.Render(self.Command, self.Version)
+
+class LocalNodesResponse(object):
+	__slots__ = ('Nodes', 'Version')
+
+	def __init__(self, nodes, version=0):
+		self.Nodes 		= nodes
+		self.Version 	= version
+
+	@staticmethod
+	def FromPacket(packet):
+		if packet.get("not_modified") is True:
+			return TopologyNotModified.FromPacket(packet)
+		return LocalNodesResponse([NodeItem.FromPacket(item) for item in packet.get("nodes", [])], packet.get("version", 0))
+
+	def Encode(self):
+		return MkSLocalNodesCommands.GET_LOCAL_NODES_RESPONSE.Render(self.Version, EncodeNodes(self.Nodes))
+
+# Snapshot of a master topology for a subscriber, events are sent after it.
+class TopologySubscribeResponse(LocalNodesResponse):
+	__slots__ = ()
+
+	@staticmethod
+	def FromPacket(packet):
+		return TopologySubscribeResponse([NodeItem.FromPacket(item) for item in packet.get("nodes", [])], packet.get("version", 0))
+
+	def Encode(self):
+		return MkSLocalNodesCommands.TOPOLOGY_SUBSCRIBE_RESPONSE.Render(self.Version, EncodeNodes(self.Nodes))
+
+class MasterInfoResponse(object):
+	__slots__ = ('HostName', 'UUID', 'Nodes', 'Version')
+
+	def __init__(self, host_name, uuid, nodes, version=0):
+		self.HostName 	= host_name
+		self.UUID 		= uuid
+		self.Nodes 		= nodes
+		self.Version 	= version
+
+	@staticmethod
+	def FromPacket(packet):
+		if packet.get("not_modified") is True:
+			return TopologyNotModified.FromPacket(packet)
+		info = packet["info"]
+		return MasterInfoResponse(info["hostname"], info["uuid"], [NodeItem.FromPacket(item) for item in info.get("nodes", [])], packet.get("version", 0))
+
+	def Encode(self):
+		return MkSLocalNodesCommands.GET_MASTER_INFO_RESPONSE.Render(self.Version, self.HostName, self.UUID, EncodeNodes(self.Nodes))
+
+# Topology change, command is master_append_node or master_remove_node.
+class NodeEvent(object):
+	__slots__ = ('Command', 'Node')
+
+	Templates = {
+		'master_append_node': 	MkSLocalNodesCommands.MASTER_APPEND_NODE_RESPONSE,
+		'master_remove_node': 	MkSLocalNodesCommands.MASTER_REMOVE_NODE_RESPONSE
+	}
+
+	def __init__(self, command, node):
+		self.Command 	= command
+		self.Node 		= node
+
+	@staticmethod
+	def FromPacket(packet):
+		return NodeEvent(packet["command"], NodeItem.FromPacket(packet["node"]))
+
+	def Encode(self):
+		node = self.Node
+		return self.Templates[self.Command].Render(node.IP, node.Port, node.UUID, node.Type)
+
+# Topology changes merged by master, removed nodes are applied first.
+class NodesDelta(object):
+	__slots__ = ('Removed', 'Appended')
+
+	def __init__(self, removed, appended):
+		self.Removed 	= removed
+		self.Appended 	= appended
+
+	@staticmethod
+	def FromPacket(packet):
+		return NodesDelta([NodeItem.FromPacket(item) for item in packet.get("removed", [])],
+						  [NodeItem.FromPacket(item) for item in packet.get("appended", [])])
+
+	# Same changes as classic events, for handlers of single events.
+	def GetEvents(self):
+		return [NodeEvent("master_remove_node", node) for node in self.Removed] + [NodeEvent("master_append_node", node) for node in self.Appended]
+
+	def Encode(self):
+		return MkSLocalNodesCommands.MASTER_NODES_DELTA_RESPONSE.Render(EncodeNodes(self.Removed), EncodeNodes(self.Appended))
+
+MESSAGE_TYPES = {
+	('get_port', 'request'): 				PortRequest,
+	('get_port', 'response'): 				PortResponse,
+	('get_local_nodes', 'request'): 		TopologyRequest,
+	('get_master_info', 'request'): 		TopologyRequest,
+	('get_local_nodes', 'response'): 		LocalNodesResponse,
+	('get_master_info', 'response'): 		MasterInfoResponse,
+	('master_append_node', 'response'): 	NodeEvent,
+	('master_remove_node', 'response'): 	NodeEvent,
+	('master_nodes_delta', 'response'): 	NodesDelta,
+	('topology_subscribe', 'response'): 	TopologySubscribeResponse
+}
+
+# Typed message of a decoded packet, None if there is no type for it.
+def FromPacket(packet):
+	direction = packet.get("direction", "")
+	if "proxy" in direction:
+		return ProxyMessage.FromPacket(packet)
+	messageType = MESSAGE_TYPES.get((packet.get("command"), direction))
+	if messageType is None:
+		return None
+	return messageType.FromPacket(packet)
+
+# Typed message of a packet body (JSON text), proxy data is decoded lazily.
+def Decode(text):
+	if isinstance(text, bytes) and bytes is not str:
+		text = text.decode('utf-8')
+	if '"direction":"proxy_' in text[:256]:
+		message = ProxyMessage.Decode(text)
+		if message is not None:
+			return message
+	return FromPacket(json.loads(text))
@@ -1,16 +1,21 @@
 #!/usr/bin/python
 import os
-import urllib2
+import sys
+if sys.version_info[0] < 3:
+	import urllib2
+else:
+	import urllib.request as urllib2
 import urllib
 import websocket
-import sys
 if sys.version_info[0] < 3:
 	import thread
 else:
-	import _thread
+	import _thread as thread
 import time
 import json
 
+from mksdk import MkSProxyRelay
+
 class Network ():
 	def __init__(self, uri, wsuri):
 		self.Name 		  	= "Communication to Node.JS"
@@ -26,6 +31,7 @@ class Network ():
 
 		self.OnConnectionCallback 		= None
 		self.OnDataArrivedCallback 		= None
+		self.OnRawDataArrivedCallback 	= None # Return True if message was handled without decoding
 		self.OnErrorCallback 			= None
 		self.OnConnectionClosedCallback = None
 
@@ -96,6 +102,8 @@ class Network ():
 		return "", False
 
 	def WSConnection_OnMessage_Handler (self, ws, message):
+		if self.OnRawDataArrivedCallback is not None and self.OnRawDataArrivedCallback(message) is True:
+			return
 		data = json.loads(message)
 		self.OnDataArrivedCallback(data)
 
@@ -191,6 +199,10 @@ class Network ():
 
 		return json.dumps(message)
 	
+	# Payload is JSON text, put in the message as is.
+	def BuildRelayMessage (self, direction, messageType, destination, source, command, payload, piggy):
+		return MkSProxyRelay.BuildGatewayMessage(str(self.UserDevKey), str(direction), str(messageType), str(destination), str(source), str(command), payload, piggy, str(int(time.time())))
+	
 	def GetUUIDFromJson(self, json):
 		return json['uuid']
 
@@ -4,7 +4,7 @@ import sys
 if sys.version_info[0] < 3:
 	import thread
 else:
-	import _thread
+	import _thread as thread
 import threading
 import time
 import json
@@ -17,6 +17,7 @@ from mksdk import MkSNetMachine
 from mksdk import MkSDevice
 from mksdk import MkSUtils
 from mksdk import MkSAbstractNode
+from mksdk import MkSProxyRelay
 
 class Node():
 	"""Node respomsable for coordinate between web services
@@ -91,6 +92,7 @@ class Node():
 		self.LocalServiceNode.OnNewNodeCallback 				= self.OnNewNodeHandler
 		self.LocalServiceNode.OnSlaveNodeDisconnectedCallback 	= self.OnSlaveNodeDisconnectedHandler
 		self.LocalServiceNode.OnSlaveResponseCallback 			= self.OnSlaveResponseHandler
+		self.LocalServiceNode.OnSlaveRelayCallback 				= self.OnSlaveRelayHandler
 		self.LocalServiceNode.OnGetNodeInfoRequestCallback 		= self.OnGetNodeInfoRequestHandler
 
 		parser = argparse.ArgumentParser(description='Execution module called Node')
@@ -138,11 +140,17 @@ class Node():
 			message = self.Network.BuildMessage(direction, "DIRECT", dest, src, command, payload, piggy)
 			self.Network.SendWebSocket(message)
 
+	# Payload is JSON text relayed from slave as is.
+	def OnSlaveRelayHandler(self, direction, dest, src, command, payload, piggy):
+		if self.Network.GetNetworkState() is "CONN":
+			message = self.Network.BuildRelayMessage(direction, "DIRECT", dest, src, command, payload, piggy)
+			self.Network.SendWebSocket(message)
+
 	def OnGetNodeInfoRequestHandler(self, sock, packet):
 		# Update response packet and encapsulate
 		msg = self.LocalServiceNode.Commands.ProxyResponse(packet, self.NodeInfo)
 		# Send to requestor
-		sock.send(msg)
+		self.LocalServiceNode.SendData(sock, msg)
 
 	def OnExitHandler(self):
 		self.Exit()
@@ -245,6 +253,7 @@ class Node():
 			self.Network.SetDeviceUUID(self.UUID)
 			self.Network.OnConnectionCallback  		= self.WebSocketConnectedCallback
 			self.Network.OnDataArrivedCallback 		= self.WebSocketDataArrivedCallback
+			self.Network.OnRawDataArrivedCallback 	= self.WebSocketRawDataArrivedCallback
 			self.Network.OnConnectionClosedCallback = self.WebSocketConnectionClosedCallback
 			self.Network.OnErrorCallback 			= self.WebSocketErrorCallback
 			self.AccessTick = 0
@@ -332,6 +341,16 @@ class Node():
 			# Find who has this destination adderes.
 			self.LocalServiceNode.HandleExternalRequest(json)
 
+	# Messages for other nodes are relayed by local service node without decoding payload.
+	def WebSocketRawDataArrivedCallback (self, message):
+		if getattr(self.LocalServiceNode, "IsProxyRelayEnabled", False) is False or len(message) < self.LocalServiceNode.ProxyRelayMinSize:
+			return False
+		relay = MkSProxyRelay.ParseGatewayMessage(message)
+		if relay is None or relay.Destination == self.UUID:
+			return False
+		self.State = "WORK"
+		return self.LocalServiceNode.RelayExternalRequest(relay)
+
 	def IsNodeRegistered(self, subscriber_uuid):
 		return subscriber_uuid in self.RegisteredNodes
 	
@@ -0,0 +1,236 @@
+#!/usr/bin/python
+import os
+import sys
+import threading
+from collections import deque
+
+from mksdk import MkSTimerScheduler
+
+class SupervisedNode():
+	def __init__(self, uuid, command, working_dir=None):
+		self.UUID 			= uuid
+		self.Command 		= command # argv list
+		self.WorkingDir 	= working_dir
+		self.Process 		= None
+		self.State 			= "stopped" # stopped, queued, starting, running, backoff
+		self.StartTime 		= 0
+		self.ReadyLatency 	= None # Seconds from start to WORKING (got port)
+		self.Restarts 		= 0
+		self.Backoff 		= 0
+		self.TimerID 		= None
+		self.LastExitCode 	= None
+
+	def GetStatus(self):
+		pid = None
+		if self.Process is not None:
+			pid = self.Process.pid
+		return {
+			'uuid': 			self.UUID,
+			'state': 			self.State,
+			'pid': 				pid,
+			'restarts': 		self.Restarts,
+			'ready_latency': 	self.ReadyLatency,
+			'last_exit_code': 	self.LastExitCode
+		}
+
+class NodeSupervisor():
+	"""Start, watch and restart node processes of the master.
+
+	Nodes are started concurrently, at most parallel of them may be starting
+	(launched but not WORKING yet) at a time, the rest wait in a queue. A node
+	is WORKING when OnReady() is called (master gave it a port), or after
+	ready_timeout when it never asks. A node that exits without Stop() is
+	started again after a backoff delay that doubles on every crash up to
+	max_backoff and is reset once the node stays up for stable_time.
+
+	spawn(node) starts the process of a SupervisedNode and returns the Popen,
+	it is called on a launch thread so forking never blocks the timer (socket
+	loop) thread. Exit of a process is reported by the owner with OnExit().
+	"""
+
+	def __init__(self, spawn, timers, parallel=4, min_backoff=1, max_backoff=60, ready_timeout=30, stable_time=60):
+		self.Spawn 			= spawn
+		self.Timers 		= timers
+		self.Parallel 		= parallel
+		self.MinBackoff 	= min_backoff
+		self.MaxBackoff 	= max_backoff
+		self.ReadyTimeout 	= ready_timeout
+		self.StableTime 	= stable_time
+		self.Nodes 			= {} # UUID -> SupervisedNode
+		self.Queue 			= deque() # Nodes waiting for a start slot
+		self.Starting 		= set() # UUIDs launched and not WORKING yet
+		self.Lock 			= threading.RLock()
+
+	def Add(self, uuid, command, working_dir=None):
+		self.Lock.acquire()
+		try:
+			node = self.Nodes.get(uuid)
+			if node is None:
+				node = SupervisedNode(uuid, command, working_dir)
+				self.Nodes[uuid] = node
+			else:
+				node.Command 	= command
+				node.WorkingDir = working_dir
+			return node
+		finally:
+			self.Lock.release()
+
+	def GetNode(self, uuid):
+		return self.Nodes.get(uuid)
+
+	def StartAll(self):
+		self.Lock.acquire()
+		try:
+			for node in self.Nodes.values():
+				self.Enqueue(node)
+		finally:
+			self.Lock.release()
+		self.Pump()
+
+	def Start(self, uuid):
+		self.Lock.acquire()
+		try:
+			node = self.Nodes.get(uuid)
+			if node is None:
+				return False
+			node.Backoff = 0
+			self.CancelTimer(node)
+			self.Enqueue(node)
+		finally:
+			self.Lock.release()
+		self.Pump()
+		return True
+
+	# Node is stopped on purpose, it is not restarted when it exits.
+	def Stop(self, uuid):
+		self.Lock.acquire()
+		try:
+			node = self.Nodes.get(uuid)
+			if node is None:
+				return None
+			self.CancelTimer(node)
+			if node in self.Queue:
+				self.Queue.remove(node)
+			self.Starting.discard(uuid)
+			node.State 	= "stopped"
+			process 	= node.Process
+		finally:
+			self.Lock.release()
+		self.Pump()
+		return process
+
+	def Enqueue(self, node):
+		if node.State in ("stopped", "backoff"):
+			node.State = "queued"
+			self.Queue.append(node)
+
+	def CancelTimer(self, node):
+		if node.TimerID is not None:
+			self.Timers.RemoveTimer(node.TimerID)
+			node.TimerID = None
+
+	# Launch queued nodes while there are free start slots.
+	def Pump(self):
+		while True:
+			self.Lock.acquire()
+			try:
+				if not self.Queue or len(self.Starting) >= self.Parallel:
+					return
+				node 			= self.Queue.popleft()
+				node.State 		= "starting"
+				node.StartTime 	= MkSTimerScheduler.GetTime()
+				self.Starting.add(node.UUID)
+			finally:
+				self.Lock.release()
+			thread 			= threading.Thread(target=self.Launch, args=(node,))
+			thread.daemon 	= True
+			thread.start()
+
+	def Launch(self, node):
+		try:
+			process = self.Spawn(node)
+		except Exception as e:
+			print ("[NodeSupervisor] Start ERROR", node.UUID, e)
+			process = None
+		self.Lock.acquire()
+		try:
+			node.Process = process
+			if node.State != "starting":
+				# Stopped while it was launched.
+				if process is not None:
+					process.terminate()
+				return
+			if process is None:
+				self.Starting.discard(node.UUID)
+				self.ScheduleRestart(node)
+			else:
+				node.TimerID = self.Timers.AddTimer(self.ReadyTimeout, lambda: self.ReadyTimeoutHandler(node, process), repeat=False)
+		finally:
+			self.Lock.release()
+
+	def ReadyTimeoutHandler(self, node, process):
+		self.Lock.acquire()
+		try:
+			if node.Process is not process or node.State != "starting":
+				return
+			node.TimerID = None
+			# Never asked for a port, don't hold the start slot.
+			print ("[NodeSupervisor] Node is not WORKING after start timeout", node.UUID)
+			node.State = "running"
+			self.Starting.discard(node.UUID)
+		finally:
+			self.Lock.release()
+		self.Pump()
+
+	# Node reached WORKING state.
+	def OnReady(self, uuid):
+		self.Lock.acquire()
+		try:
+			node = self.Nodes.get(uuid)
+			if node is None or node.State != "starting":
+				return
+			self.CancelTimer(node)
+			node.ReadyLatency 	= MkSTimerScheduler.GetTime() - node.StartTime
+			node.State 			= "running"
+			self.Starting.discard(uuid)
+		finally:
+			self.Lock.release()
+		self.Pump()
+
+	def OnExit(self, uuid, returncode):
+		self.Lock.acquire()
+		try:
+			node = self.Nodes.get(uuid)
+			if node is None:
+				return
+			node.LastExitCode = returncode
+			self.Starting.discard(uuid)
+			self.CancelTimer(node)
+			if node.State in ("starting", "running"):
+				if MkSTimerScheduler.GetTime() - node.StartTime >= self.StableTime:
+					node.Backoff = 0
+				self.ScheduleRestart(node)
+		finally:
+			self.Lock.release()
+		self.Pump()
+
+	def ScheduleRestart(self, node):
+		node.Backoff 	= min(max(node.Backoff * 2, self.MinBackoff), self.MaxBackoff)
+		node.State 		= "backoff"
+		node.Restarts 	+= 1
+		print ("[NodeSupervisor] Node restart in", node.Backoff, "sec", node.UUID)
+		node.TimerID 	= self.Timers.AddTimer(node.Backoff, lambda: self.RestartHandler(node), repeat=False)
+
+	def RestartHandler(self, node):
+		self.Lock.acquire()
+		try:
+			node.TimerID = None
+			if node.State != "backoff":
+				return
+			self.Enqueue(node)
+		finally:
+			self.Lock.release()
+		self.Pump()
+
+	def GetStatus(self):
+		return [node.GetStatus() for node in list(self.Nodes.values())]
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+import os
+import sys
+import threading
+
+class RequestFuture():
+	"""Result of a local node request.
+
+	Completed by the socket loop when the response with the same request id
+	arrives, or when the request times out or its connection is closed.
+	Wait() blocks the caller (never call it from the socket loop), callbacks
+	are called from the socket loop with the future.
+	"""
+
+	def __init__(self, request_id, sock):
+		self.ID 		= request_id
+		self.Socket 	= sock
+		self.Status 	= "pending" # pending, done, timeout, failed
+		self.Packet 	= None
+		self.Error 		= None
+		self.TimerID 	= None
+		self.Callbacks 	= []
+		self.Event 		= threading.Event()
+		self.Lock 		= threading.Lock()
+
+	def IsDone(self):
+		return self.Status != "pending"
+
+	# Return response packet, None on timeout or failure.
+	def Wait(self, timeout=None):
+		self.Event.wait(timeout)
+		return self.Packet
+
+	def AddCallback(self, callback):
+		self.Lock.acquire()
+		try:
+			if self.Status == "pending":
+				self.Callbacks.append(callback)
+				return
+		finally:
+			self.Lock.release()
+		callback(self)
+
+	def Complete(self, status, packet=None, error=None):
+		self.Lock.acquire()
+		try:
+			if self.Status != "pending":
+				return False
+			self.Status 	= status
+			self.Packet 	= packet
+			self.Error 		= error
+			callbacks 		= self.Callbacks
+			self.Callbacks 	= []
+		finally:
+			self.Lock.release()
+		self.Event.set()
+		for callback in callbacks:
+			try:
+				callback(self)
+			except Exception as e:
+				print ("[RequestFuture] Callback ERROR", e)
+		return True
+
+class PendingRequests():
+	"""Requests sent by a node and waiting for their response.
+
+	Each request gets a unique id carried in the "request_id" field of the
+	packet and echoed back in the response, so many requests of the same
+	command can be outstanding on one connection. Timeouts run on the node
+	timer scheduler.
+	"""
+
+	def __init__(self, timers, default_timeout=10):
+		self.Timers 			= timers
+		self.DefaultTimeout 	= default_timeout
+		self.Requests 			= {} # Request id -> RequestFuture
+		self.NextID 			= 0
+		self.Lock 				= threading.Lock()
+
+	def NewRequest(self, sock, timeout=None):
+		if timeout is None:
+			timeout = self.DefaultTimeout
+		self.Lock.acquire()
+		try:
+			# Positive int32, 0 means "no request id".
+			self.NextID = (self.NextID % 0x7FFFFFFF) + 1
+			future = RequestFuture(self.NextID, sock)
+			self.Requests[future.ID] = future
+		finally:
+			self.Lock.release()
+		future.TimerID = self.Timers.AddTimer(timeout, lambda: self.Expire(future.ID), repeat=False)
+		return future
+
+	def Pop(self, request_id):
+		self.Lock.acquire()
+		try:
+			future = self.Requests.pop(request_id, None)
+		finally:
+			self.Lock.release()
+		if future is not None:
+			self.Timers.RemoveTimer(future.TimerID)
+		return future
+
+	# Complete the request of this response. Return True if it was pending.
+	# Every node numbers its requests from 1, a response with the id of our
+	# request on another connection is not ours.
+	def Resolve(self, sock, request_id, packet):
+		self.Lock.acquire()
+		try:
+			future = self.Requests.get(request_id)
+			if future is None or future.Socket is not sock:
+				return False
+			del self.Requests[request_id]
+		finally:
+			self.Lock.release()
+		self.Timers.RemoveTimer(future.TimerID)
+		return future.Complete("done", packet)
+
+	def Cancel(self, request_id, error="cancelled"):
+		future = self.Pop(request_id)
+		if future is not None:
+			future.Complete("failed", error=error)
+
+	def Expire(self, request_id):
+		future = self.Pop(request_id)
+		if future is not None:
+			future.Complete("timeout", error="timeout")
+
+	# Connection is closed, its responses will never come.
+	def FailSocket(self, sock):
+		self.Lock.acquire()
+		try:
+			ids = [request_id for request_id, future in self.Requests.items() if future.Socket is sock]
+		finally:
+			self.Lock.release()
+		for request_id in ids:
+			self.Cancel(request_id, "disconnected")
+
+	def GetPendingCount(self):
+		return len(self.Requests)
@@ -0,0 +1,304 @@
+#!/usr/bin/python
+import os
+import sys
+import errno
+import threading
+if os.name != "nt":
+	import fcntl
+
+from mksdk import MkSSocketPoller
+
+class PipeStream():
+	def __init__(self, owner, name, fileobj):
+		self.Owner 		= owner
+		self.Name 		= name # stdout or stderr
+		self.File 		= fileobj
+		self.Partial 	= b"" # Line not terminated yet
+
+	def fileno(self):
+		return self.File.fileno()
+
+class PipeProcess():
+	def __init__(self, name, process):
+		self.Name 		= name
+		self.Process 	= process
+		self.Streams 	= []
+		self.ExitWait 	= 0.005 # Exit is usually seen just after pipes are closed
+
+class PipeReader():
+	"""Output capture of supervised child processes.
+
+	All stdout and stderr pipes are watched by one poller thread. Whatever is
+	available is read without blocking and split into lines incrementally,
+	on_line(name, stream, line) is called for each complete line (line keeps
+	its newline, like readline()). When all pipes of a process are closed on_exit(name, returncode)
+	is called, a process that closed its pipes but still runs is checked with
+	growing delay up to exit_interval until it exits.
+
+	Windows can't poll pipes, there every pipe is read by its own thread and
+	the process is waited for when all its pipes are closed.
+	"""
+
+	def __init__(self, on_line, on_exit=None, read_size=65536, exit_interval=0.5):
+		self.OnLine 		= on_line
+		self.OnExit 		= on_exit
+		self.ReadSize 		= read_size
+		self.ExitInterval 	= exit_interval
+		self.Poller 		= MkSSocketPoller.SocketPoller()
+		self.Processes 		= {} # Name -> PipeProcess
+		self.Exiting 		= [] # Pipes closed, waiting for exit code
+		self.Changes 		= [] # (add/remove, name, process) done by reader thread
+		self.Lock 			= threading.Lock()
+		self.Thread 		= None
+		self.Running 		= False
+		self.UseThreads 	= os.name == "nt" # Reader thread per pipe
+		if self.UseThreads is True:
+			return
+		# Self pipe, wakes the poller on Add(), Remove() and Stop().
+		self.WakeRead, self.WakeWrite = os.pipe()
+		self.SetNonBlocking(self.WakeRead)
+		self.Wake 			= PipeStream(None, "wake", os.fdopen(self.WakeRead, "rb", 0))
+
+	def SetNonBlocking(self, fd):
+		flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+		fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+	def Start(self):
+		if self.Thread is not None:
+			return
+		self.Running 		= True
+		if self.UseThreads is True:
+			return
+		self.Thread 		= threading.Thread(target=self.Reader_Thread)
+		self.Thread.daemon 	= True
+		self.Thread.start()
+
+	def Stop(self):
+		self.Running = False
+		if self.UseThreads is True:
+			return
+		self.Notify()
+		if self.Thread is not None and self.Thread is not threading.current_thread():
+			self.Thread.join()
+		self.Thread = None
+
+	def Notify(self):
+		try:
+			os.write(self.WakeWrite, b"x")
+		except OSError:
+			# Pipe is full, reader is already woken up.
+			pass
+
+	# Watch stdout and stderr (when they are pipes) of a subprocess.Popen.
+	def Add(self, name, process):
+		if self.UseThreads is True:
+			self.StartStreamThreads(PipeProcess(name, process))
+			return
+		self.Lock.acquire()
+		try:
+			self.Changes.append(("add", name, process))
+		finally:
+			self.Lock.release()
+		self.Notify()
+
+	# Stop watching, remaining output is dropped and on_exit is not called.
+	def Remove(self, name):
+		if self.UseThreads is True:
+			self.Lock.acquire()
+			try:
+				self.Processes.pop(name, None)
+			finally:
+				self.Lock.release()
+			return
+		self.Lock.acquire()
+		try:
+			self.Changes.append(("remove", name, None))
+		finally:
+			self.Lock.release()
+		self.Notify()
+
+	def GetNames(self):
+		return list(self.Processes.keys())
+
+	def ApplyChanges(self):
+		self.Lock.acquire()
+		try:
+			changes 		= self.Changes
+			self.Changes 	= []
+		finally:
+			self.Lock.release()
+		for action, name, process in changes:
+			if name in self.Processes:
+				self.Unwatch(self.Processes[name])
+			if "add" == action:
+				self.Watch(PipeProcess(name, process))
+
+	def Watch(self, item):
+		for streamName in ("stdout", "stderr"):
+			fileobj = getattr(item.Process, streamName, None)
+			if fileobj is None:
+				continue
+			self.SetNonBlocking(fileobj.fileno())
+			stream = PipeStream(item, streamName, fileobj)
+			item.Streams.append(stream)
+			self.Poller.Register(stream)
+		self.Processes[item.Name] = item
+		if not item.Streams:
+			self.Exiting.append(item)
+
+	def Unwatch(self, item):
+		for stream in item.Streams:
+			self.Poller.Unregister(stream)
+			stream.File.close()
+		item.Streams = []
+		del self.Processes[item.Name]
+		if item in self.Exiting:
+			self.Exiting.remove(item)
+
+	def Reader_Thread(self):
+		self.Poller.Register(self.Wake)
+		while self.Running is True:
+			timeout = None
+			if self.Exiting:
+				timeout = min([item.ExitWait for item in self.Exiting])
+			readable, writable = self.Poller.Poll(timeout)
+			for stream in readable:
+				if stream is self.Wake:
+					self.Drain()
+				else:
+					self.Read(stream)
+			if self.Changes:
+				self.ApplyChanges()
+			if self.Exiting:
+				self.CheckExit()
+		self.Poller.Unregister(self.Wake)
+
+	def Drain(self):
+		try:
+			while os.read(self.WakeRead, 4096):
+				pass
+		except OSError:
+			pass
+
+	def Read(self, stream):
+		if stream.Owner.Name not in self.Processes:
+			return
+		try:
+			data = os.read(stream.fileno(), self.ReadSize)
+		except OSError as e:
+			if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+				return
+			data = b""
+		if not data:
+			self.Close(stream)
+			return
+		self.Split(stream, data)
+
+	def Split(self, stream, data):
+		data 	= stream.Partial + data
+		start 	= 0
+		end 	= data.find(b"\n")
+		while end >= 0:
+			self.Line(stream, data[start:end + 1])
+			start 	= end + 1
+			end 	= data.find(b"\n", start)
+		stream.Partial = data[start:]
+		if len(stream.Partial) >= self.ReadSize:
+			# Output without newlines, don't buffer it forever.
+			self.Line(stream, stream.Partial)
+			stream.Partial = b""
+
+	def Line(self, stream, line):
+		try:
+			self.OnLine(stream.Owner.Name, stream.Name, line.decode("utf-8", "replace"))
+		except Exception as e:
+			print ("[PipeReader] Line callback ERROR", e)
+
+	# End of file, process exited or closed the pipe.
+	def Close(self, stream):
+		if stream.Partial:
+			self.Line(stream, stream.Partial)
+			stream.Partial = b""
+		self.Poller.Unregister(stream)
+		stream.File.close()
+		item = stream.Owner
+		item.Streams.remove(stream)
+		if not item.Streams:
+			self.Exiting.append(item)
+			self.CheckExit()
+
+	def CheckExit(self):
+		for item in list(self.Exiting):
+			if item.Process.poll() is None:
+				item.ExitWait = min(item.ExitWait * 2, self.ExitInterval)
+				continue
+			self.Exiting.remove(item)
+			del self.Processes[item.Name]
+			if self.OnExit is not None:
+				try:
+					self.OnExit(item.Name, item.Process.returncode)
+				except Exception as e:
+					print ("[PipeReader] Exit callback ERROR", e)
+
+	# Reader threads (Windows), output of a removed or replaced process is
+	# read and dropped, so the process never blocks on a full pipe.
+	def StartStreamThreads(self, item):
+		for streamName in ("stdout", "stderr"):
+			fileobj = getattr(item.Process, streamName, None)
+			if fileobj is not None:
+				item.Streams.append(PipeStream(item, streamName, fileobj))
+		self.Lock.acquire()
+		try:
+			self.Processes[item.Name] = item
+		finally:
+			self.Lock.release()
+		if not item.Streams:
+			thread = threading.Thread(target=self.WaitExit, args=(item,))
+			thread.daemon = True
+			thread.start()
+		for stream in list(item.Streams):
+			thread = threading.Thread(target=self.Stream_Thread, args=(stream,))
+			thread.daemon = True
+			thread.start()
+
+	def IsWatched(self, item):
+		return self.Processes.get(item.Name) is item
+
+	def Stream_Thread(self, stream):
+		while True:
+			try:
+				data = os.read(stream.fileno(), self.ReadSize)
+			except OSError:
+				data = b""
+			if not data:
+				break
+			if self.IsWatched(stream.Owner) is True:
+				self.Split(stream, data)
+		if stream.Partial and self.IsWatched(stream.Owner) is True:
+			self.Line(stream, stream.Partial)
+		stream.Partial = b""
+		stream.File.close()
+		item = stream.Owner
+		self.Lock.acquire()
+		try:
+			item.Streams.remove(stream)
+			closed = not item.Streams
+		finally:
+			self.Lock.release()
+		if closed is True:
+			self.WaitExit(item)
+
+	def WaitExit(self, item):
+		returncode = item.Process.wait()
+		self.Lock.acquire()
+		try:
+			watched = self.IsWatched(item)
+			if watched is True:
+				del self.Processes[item.Name]
+		finally:
+			self.Lock.release()
+		if watched is True and self.OnExit is not None:
+			try:
+				self.OnExit(item.Name, returncode)
+			except Exception as e:
+				print ("[PipeReader] Exit callback ERROR", e)
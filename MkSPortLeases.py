@@ -0,0 +1,142 @@
+#!/usr/bin/python
+import os
+import sys
+import threading
+from collections import deque
+from collections import OrderedDict
+
+from mksdk import MkSTimerScheduler
+
+class PortLeaseAllocator():
+	"""Slave listener ports leased by UUID.
+
+	Ports come from ranges of (first, last) ports, both included. A released
+	port stays reserved for its UUID for lease_time seconds, so a slave that
+	reconnects gets the same port back. Expired reservations return their port
+	to the free list. When no port is left the oldest reservation is taken
+	over. Allocate and Release are O(1), unused ports of a range are handed
+	out by a cursor and never materialized.
+	"""
+
+	def __init__(self, ranges=((10001, 10999),), lease_time=300):
+		for first, last in ranges:
+			if first < 1 or last > 65535 or first > last:
+				raise ValueError("Bad port range {0}-{1}".format(first, last))
+		self.Ranges 		= list(ranges)
+		self.LeaseTime 		= lease_time
+		self.RangeIndex 	= 0 # Cursor of ports never leased
+		self.NextPort 		= self.Ranges[0][0] if self.Ranges else 0
+		self.Free 			= deque() # Ports returned by expired leases
+		self.Active 		= {} # Port -> UUID (None for a slave without UUID)
+		self.ActiveUUIDs 	= {} # UUID -> port
+		self.Reserved 		= OrderedDict() # UUID -> (port, expire time), oldest first
+		self.Lock 			= threading.Lock()
+		# Statistics
+		self.AllocatedCount = 0
+		self.ReusedCount 	= 0
+		self.ExpiredCount 	= 0
+		self.TakenOverCount = 0
+
+	def GetCapacity(self):
+		return sum([last - first + 1 for first, last in self.Ranges])
+
+	# Return port leased to uuid, 0 if no port is left.
+	def Allocate(self, uuid=None):
+		self.Lock.acquire()
+		try:
+			self.ExpireLocked(MkSTimerScheduler.GetTime())
+			port = 0
+			if uuid and uuid not in self.ActiveUUIDs:
+				reserved = self.Reserved.pop(uuid, None)
+				if reserved is not None:
+					port = reserved[0]
+					self.ReusedCount += 1
+			elif uuid:
+				# UUID holds a port on another connection, both can't listen on it.
+				uuid = None
+			if 0 == port:
+				port = self.NewPortLocked()
+			if 0 == port:
+				return 0
+			self.Active[port] = uuid
+			if uuid:
+				self.ActiveUUIDs[uuid] = port
+			self.AllocatedCount += 1
+			return port
+		finally:
+			self.Lock.release()
+
+	def NewPortLocked(self):
+		if self.Free:
+			return self.Free.popleft()
+		while self.RangeIndex < len(self.Ranges):
+			first, last = self.Ranges[self.RangeIndex]
+			if self.NextPort <= last:
+				port = self.NextPort
+				self.NextPort += 1
+				return port
+			self.RangeIndex += 1
+			if self.RangeIndex < len(self.Ranges):
+				self.NextPort = self.Ranges[self.RangeIndex][0]
+		if self.Reserved:
+			# Out of ports, take the reservation that would expire first.
+			uuid, reserved = self.Reserved.popitem(last=False)
+			self.TakenOverCount += 1
+			return reserved[0]
+		return 0
+
+	# Slave left, its port is kept for its UUID until the lease expires.
+	def Release(self, port):
+		self.Lock.acquire()
+		try:
+			if port not in self.Active:
+				return False
+			uuid = self.Active.pop(port)
+			if uuid:
+				del self.ActiveUUIDs[uuid]
+			if uuid and self.LeaseTime > 0:
+				self.Reserved[uuid] = (port, MkSTimerScheduler.GetTime() + self.LeaseTime)
+			else:
+				self.Free.append(port)
+			return True
+		finally:
+			self.Lock.release()
+
+	def Expire(self, now=None):
+		if now is None:
+			now = MkSTimerScheduler.GetTime()
+		self.Lock.acquire()
+		try:
+			self.ExpireLocked(now)
+		finally:
+			self.Lock.release()
+
+	# Lease time is the same for all, so reservations expire in insertion order.
+	def ExpireLocked(self, now):
+		while self.Reserved:
+			uuid 		= next(iter(self.Reserved))
+			reserved 	= self.Reserved[uuid]
+			if reserved[1] > now:
+				return
+			del self.Reserved[uuid]
+			self.Free.append(reserved[0])
+			self.ExpiredCount += 1
+
+	def GetPort(self, uuid):
+		port = self.ActiveUUIDs.get(uuid)
+		if port is None:
+			reserved = self.Reserved.get(uuid)
+			if reserved is not None:
+				port = reserved[0]
+		return port
+
+	def GetStatistics(self):
+		return {
+			'capacity': 	self.GetCapacity(),
+			'active': 		len(self.Active),
+			'reserved': 	len(self.Reserved),
+			'allocated': 	self.AllocatedCount,
+			'reused': 		self.ReusedCount,
+			'expired': 		self.ExpiredCount,
+			'taken_over': 	self.TakenOverCount
+		}
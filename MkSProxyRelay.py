@@ -0,0 +1,144 @@
+#!/usr/bin/python
+import os
+import sys
+import re
+import json
+
+from mksdk import MkSLocalNodesCommands
+
+# Relay of proxy messages between Gateway and slaves without decoding payload.
+#
+# Members of a message are scanned in order. Routing members (header,
+# command, piggybag) are small and decoded by the C JSON decoder, payload is
+# only skipped and kept as a slice of the original JSON text, which is put
+# as is into the outgoing message. Skipping costs Python work per string and
+# bracket, not per byte, so big strings (file content) are nearly free. A
+# payload with many small members (sensor lists) is skipped by the C decoder
+# once MAX_SCAN_TOKENS is reached, it then costs about one json.loads of the
+# payload, still without encoding it again.
+
+STRUCTURE 	= re.compile(r'["\[\]{}]')
+MAX_SCAN_TOKENS = 64
+WHITESPACE 	= re.compile(r'[ \t\n\r]*')
+DECODER 	= json.JSONDecoder()
+ScanString 	= json.decoder.scanstring
+
+GATEWAY_MESSAGE = MkSLocalNodesCommands.PacketTemplate('{"header":{"message_type":{{message_type}},"destination":{{destination}},"source":{{source}},"direction":{{direction}}},"data":{"header":{"command":{{command}},"timestamp":{{timestamp}}},"payload":{{payload:raw}}},"user":{"key":{{key}}},"additional":{},"piggybag":{{piggy:json}}}', framed=False)
+
+# Routing fields of a Gateway message (local packets are MkSMessages.ProxyMessage).
+class RelayMessage():
+	def __init__(self):
+		self.MessageType 	= ""
+		self.Direction 		= ""
+		self.Destination 	= ""
+		self.Source 		= ""
+		self.Command 		= ""
+		self.RequestID 		= 0
+		self.Piggy 			= 0
+		self.Payload 		= "" # Raw JSON text
+
+def SkipWhitespace(text, pos):
+	if text[pos] in " \t\n\r":
+		return WHITESPACE.match(text, pos).end()
+	return pos
+
+# Return index after the string whose opening quote is before pos.
+def SkipString(text, pos):
+	while True:
+		end = text.find('"', pos)
+		if end < 0:
+			raise ValueError("Unterminated JSON string")
+		back = end - 1
+		while "\\" == text[back]:
+			back -= 1
+		# Quote is escaped by an odd number of backslashes.
+		if 0 == (end - back - 1) % 2:
+			return end + 1
+		pos = end + 1
+
+# Return index after the JSON value at pos (no whitespace before it).
+def SkipValue(text, pos):
+	char = text[pos]
+	if '"' == char:
+		return SkipString(text, pos + 1)
+	if char not in "{[":
+		return DECODER.raw_decode(text, pos)[1]
+	start 	= pos
+	depth 	= 0
+	tokens 	= 0
+	while True:
+		tokens += 1
+		if tokens > MAX_SCAN_TOKENS:
+			# Structure heavy, the C decoder is faster than this loop.
+			return DECODER.raw_decode(text, start)[1]
+		match = STRUCTURE.search(text, pos)
+		if match is None:
+			raise ValueError("Unterminated JSON value")
+		pos 	= match.end()
+		char 	= text[pos - 1]
+		if '"' == char:
+			pos = SkipString(text, pos)
+		elif char in "{[":
+			depth += 1
+		else:
+			depth -= 1
+			if 0 == depth:
+				return pos
+
+# Scan JSON object at pos, return (members, end). Spec maps member names to
+# None (kept as raw JSON text) or to the spec of a nested object, other
+# members are decoded.
+def ScanObject(text, pos, spec):
+	members = {}
+	pos 	= SkipWhitespace(text, pos)
+	if text[pos] != "{":
+		raise ValueError("Not a JSON object")
+	pos = SkipWhitespace(text, pos + 1)
+	if "}" == text[pos]:
+		return members, pos + 1
+	while True:
+		if text[pos] != '"':
+			raise ValueError("Bad JSON member")
+		key, pos 	= ScanString(text, pos + 1)
+		pos 		= SkipWhitespace(text, pos)
+		if text[pos] != ":":
+			raise ValueError("Bad JSON member")
+		pos = SkipWhitespace(text, pos + 1)
+		if key not in spec:
+			members[key], pos = DECODER.raw_decode(text, pos)
+		elif spec[key] is None:
+			start 			= pos
+			pos 			= SkipValue(text, pos)
+			members[key] 	= text[start:pos]
+		else:
+			members[key], pos = ScanObject(text, pos, spec[key])
+		pos = SkipWhitespace(text, pos)
+		if "," == text[pos]:
+			pos = SkipWhitespace(text, pos + 1)
+		elif "}" == text[pos]:
+			return members, pos + 1
+		else:
+			raise ValueError("Bad JSON object")
+
+GATEWAY_SPEC 	= { 'data': { 'payload': None } }
+LOCAL_SPEC 		= { 'payload': { 'data': None } }
+
+# Gateway (websocket) message. None if it can't be relayed, caller decodes it.
+def ParseGatewayMessage(text):
+	try:
+		members, end 		= ScanObject(text, 0, GATEWAY_SPEC)
+		header 				= members["header"]
+		message 			= RelayMessage()
+		message.MessageType = header.get("message_type", "")
+		message.Direction 	= header["direction"]
+		message.Destination = header["destination"]
+		message.Source 		= header["source"]
+		message.Command 	= members["data"]["header"]["command"]
+		message.Payload 	= members["data"]["payload"]
+		message.Piggy 		= members.get("piggybag", 0)
+		return message
+	except (KeyError, IndexError, ValueError, TypeError, AttributeError):
+		return None
+
+def BuildGatewayMessage(key, direction, message_type, destination, source, command, payload, piggy, timestamp):
+	return GATEWAY_MESSAGE.Render(message_type, destination, source, direction, command, timestamp, payload, key, piggy)
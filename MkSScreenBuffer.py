@@ -0,0 +1,85 @@
+#!/usr/bin/python
+import os
+import sys
+import threading
+
+class ScreenBuffer():
+	"""Last lines of a node output.
+
+	Lines are kept in a ring of max_lines slots and old lines are dropped when
+	there are more than max_lines or more than max_chars characters, so memory
+	is fixed however much a node prints. Every line gets a sequence number
+	that only grows, ReadSince(offset) returns the lines a reader did not see
+	yet and the offset to pass next time.
+	"""
+
+	def __init__(self, max_lines=500, max_chars=64 * 1024):
+		self.MaxLines 	= max_lines
+		self.MaxChars 	= max_chars
+		self.Lines 		= [None] * max_lines
+		self.FirstSeq 	= 0 # Oldest line kept
+		self.NextSeq 	= 0 # Sequence number of next line
+		self.Chars 		= 0
+		self.Lock 		= threading.Lock()
+
+	def Append(self, line):
+		if len(line) > self.MaxChars:
+			line = line[:self.MaxChars]
+		self.Lock.acquire()
+		try:
+			if self.NextSeq - self.FirstSeq == self.MaxLines:
+				self.DropOldest()
+			self.Lines[self.NextSeq % self.MaxLines] = line
+			self.NextSeq 	+= 1
+			self.Chars 		+= len(line)
+			while self.Chars > self.MaxChars:
+				self.DropOldest()
+		finally:
+			self.Lock.release()
+
+	def DropOldest(self):
+		index 				= self.FirstSeq % self.MaxLines
+		self.Chars 			-= len(self.Lines[index])
+		self.Lines[index] 	= None
+		self.FirstSeq 		+= 1
+
+	# Return (lines, next offset, dropped). Dropped is the number of lines after
+	# offset that were already pushed out. An offset ahead of the buffer (it was
+	# recreated) reads from the oldest line.
+	def ReadSince(self, offset=0, limit=None):
+		self.Lock.acquire()
+		try:
+			if offset > self.NextSeq:
+				offset = 0
+			start = max(offset, self.FirstSeq)
+			end = self.NextSeq
+			if limit is not None:
+				end = min(end, start + limit)
+			lines = [self.Lines[seq % self.MaxLines] for seq in range(start, end)]
+			return lines, end, start - offset
+		finally:
+			self.Lock.release()
+
+	# Last count lines, result as of ReadSince().
+	def ReadTail(self, count):
+		self.Lock.acquire()
+		try:
+			offset = max(self.FirstSeq, self.NextSeq - count)
+		finally:
+			self.Lock.release()
+		return self.ReadSince(offset)
+
+	def GetLines(self):
+		return self.ReadSince(0)[0]
+
+	def GetOffset(self):
+		return self.NextSeq
+
+	def Clear(self):
+		self.Lock.acquire()
+		try:
+			self.Lines 		= [None] * self.MaxLines
+			self.FirstSeq 	= self.NextSeq
+			self.Chars 		= 0
+		finally:
+			self.Lock.release()
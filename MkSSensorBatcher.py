@@ -0,0 +1,114 @@
+#!/usr/bin/python
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+from mksdk import MkSTimerScheduler
+
+class SensorChangeBatcher():
+	"""Coalesce sensor change notifications into multi sensor messages.
+
+	Changes are payloads like { 'sensors': [{ 'id': 1, 'value': 23 }, ...] }.
+	Within a window only the latest change of each sensor (by "id", or "uuid")
+	is kept, and all of them are passed to flush_callback as one payload when
+	the window ends or max_sensors sensors are waiting. Window 0 sends every
+	change right away. Payloads without a sensors list can't be merged and
+	flush the batch.
+	"""
+
+	def __init__(self, flush_callback, timers, window=0.1, max_sensors=64):
+		self.FlushCallback 		= flush_callback
+		self.Timers 			= timers
+		self.Window 			= window
+		self.MaxSensors 		= max_sensors
+		self.Sensors 			= OrderedDict() # Sensor key -> latest change
+		self.Extra 				= {} # Other keys of the payloads, latest wins
+		self.FirstChangeTime 	= 0
+		self.TimerID 			= None
+		self.Lock 				= threading.Lock()
+		# Statistics
+		self.ChangesCount 		= 0
+		self.FlushesCount 		= 0
+		self.SensorsSent 		= 0
+		self.MaxBatchSize 		= 0
+		self.TotalLatency 		= 0
+		self.MaxLatency 		= 0
+
+	def Add(self, payload):
+		sensors = None
+		if isinstance(payload, dict):
+			sensors = payload.get('sensors')
+		if not isinstance(sensors, list) or self.Window <= 0:
+			self.Flush()
+			self.ChangesCount += 1
+			self.Send(payload, 1, 0)
+			return
+
+		flush = False
+		self.Lock.acquire()
+		try:
+			if not self.Sensors:
+				self.FirstChangeTime = MkSTimerScheduler.GetTime()
+			for sensor in sensors:
+				key = sensor.get('id', sensor.get('uuid')) if isinstance(sensor, dict) else None
+				if key is None:
+					# Not a sensor we can tell apart, keep it.
+					key = ('unkeyed', len(self.Sensors))
+				elif key in self.Sensors:
+					# Latest value wins, the sensor keeps its place.
+					self.Sensors[key] = sensor
+					continue
+				self.Sensors[key] = sensor
+			for key in payload:
+				if key != 'sensors':
+					self.Extra[key] = payload[key]
+			self.ChangesCount += 1
+			if len(self.Sensors) >= self.MaxSensors:
+				flush = True
+			elif self.TimerID is None:
+				self.TimerID = self.Timers.AddTimer(self.Window, self.Flush, repeat=False)
+		finally:
+			self.Lock.release()
+		if flush is True:
+			self.Flush()
+
+	def Flush(self):
+		self.Lock.acquire()
+		try:
+			if self.TimerID is not None:
+				self.Timers.RemoveTimer(self.TimerID)
+				self.TimerID = None
+			if not self.Sensors:
+				return
+			payload 		= dict(self.Extra)
+			payload['sensors'] = list(self.Sensors.values())
+			latency 		= MkSTimerScheduler.GetTime() - self.FirstChangeTime
+			self.Sensors 	= OrderedDict()
+			self.Extra 		= {}
+		finally:
+			self.Lock.release()
+		self.Send(payload, len(payload['sensors']), latency)
+
+	def Send(self, payload, size, latency):
+		self.FlushesCount 	+= 1
+		self.SensorsSent 	+= size
+		self.TotalLatency 	+= latency
+		self.MaxBatchSize 	= max(self.MaxBatchSize, size)
+		self.MaxLatency 	= max(self.MaxLatency, latency)
+		try:
+			self.FlushCallback(payload)
+		except Exception as e:
+			print ("[SensorChangeBatcher] Flush ERROR", e)
+
+	def GetStatistics(self):
+		flushes = max(self.FlushesCount, 1)
+		return {
+			'changes': 				self.ChangesCount,
+			'flushes': 				self.FlushesCount,
+			'sensors_sent': 		self.SensorsSent,
+			'avg_batch_size': 		float(self.SensorsSent) / flushes,
+			'max_batch_size': 		self.MaxBatchSize,
+			'avg_flush_latency': 	self.TotalLatency / flushes,
+			'max_flush_latency': 	self.MaxLatency
+		}
@@ -6,17 +6,20 @@ import time
 if sys.version_info[0] < 3:
 	import thread
 else:
-	import _thread
+	import _thread as thread
 import threading
 import socket
 
 from flask import Flask, render_template, jsonify, Response, request
 import logging
 
-import MkSGlobals
+from mksdk import MkSGlobals
 from mksdk import MkSFile
 from mksdk import MkSAbstractNode
 from mksdk import MkSLocalNodesCommands
+from mksdk import MkSBinaryProtocol
+from mksdk import MkSSensorBatcher
+from mksdk import MkSMessages
 
 class SlaveNode(MkSAbstractNode.AbstractNode):
 	def __init__(self):
@@ -47,6 +50,7 @@ class SlaveNode(MkSAbstractNode.AbstractNode):
 			'get_node_info':						self.GetNodeInfoHandler,
 			'master_append_node':					self.MasterAppendNode,
 			'master_remove_node':					self.MasterRemoveNodeHandler,
+			'master_nodes_delta':					self.MasterNodesDeltaHandler,
 			'undefined':							self.UndefindHandler
 		}
 		# Request - Response handler to sent request. (slave is responder)
@@ -76,28 +80,54 @@ class SlaveNode(MkSAbstractNode.AbstractNode):
 		self.OnGetNodeInfoRequestCallback 			= None
 		self.OnMasterAppendNodeCallback 			= None
 		self.OnMasterRemoveNodeCallback 			= None
+		# Dispatch (packet is decoded once by AbstractNode)
+		self.RegisterDispatchHandlers(["request", "proxy_request"], self.RequestHandlers)
+		self.RegisterDispatchHandlers(["response", "proxy_response"], self.ResponseHandlers)
+		self.SetDispatchDefault(["request", "proxy_request"], self.HandlerRouter_Request)
+		self.SetDispatchDefault(["response", "proxy_response"], self.HandlerRouter_Response)
+		# File loading and user sensor callbacks may take long, they run off the
+		# socket loop once the node enables SetHandlerExecutor().
+		self.SetSlowHandlers(["request", "proxy_request"], ["get_file", "get_sensor_info", "set_sensor_info", "upload_file"])
 		# Flags
 		self.IsListenerEnabled 						= False
+		self.CompressFileContent 					= True # zlib for get_file on binary connections
+		self.IsConnectingMaster 					= False
 		# Counters
 		self.MasterConnectionTries 					= 0
 		self.Ticker 								= 0
+		# Const
+		self.CONNECT_MASTER_INTERVAL 				= 10
+		self.WAIT_FOR_PORT_INTERVAL 				= 10
+		self.GATEWAY_PING_INTERVAL 					= 15
+		# Timers (real time, independent of socket traffic)
+		self.RegisterStateTimer("CONNECT_MASTER", self.CONNECT_MASTER_INTERVAL, self.ConnectMasterTimerHandler)
+		self.RegisterStateTimer("WAIT_FOR_PORT", self.WAIT_FOR_PORT_INTERVAL, self.WaitForPortTimerHandler)
+		self.RegisterStateTimer("WORKING", self.GATEWAY_PING_INTERVAL, self.SendGatewayPing)
+		# Sensor changes are coalesced and sent as one message per window.
+		self.SensorBatcher 							= MkSSensorBatcher.SensorChangeBatcher(self.SendSensorInfoBatch, self.Timers)
 
 		self.ChangeState("IDLE")
 
 	def MasterAppendNode(self, sock, packet):
 		if self.OnMasterAppendNodeCallback is not None:
-			self.OnMasterAppendNodeCallback(packet["node"]["uuid"], 
-											packet["node"]["type"], 
-											packet["node"]["ip"],
-											packet["node"]["port"])
+			node = MkSMessages.NodeEvent.FromPacket(packet).Node
+			self.OnMasterAppendNodeCallback(node.UUID, node.Type, node.IP, node.Port)
 	
 	def MasterRemoveNodeHandler(self, sock, packet):
 		if self.OnMasterRemoveNodeCallback is not None:
-			self.OnMasterRemoveNodeCallback(packet["node"]["uuid"], 
-											packet["node"]["type"], 
-											packet["node"]["ip"],
-											packet["node"]["port"])
+			node = MkSMessages.NodeEvent.FromPacket(packet).Node
+			self.OnMasterRemoveNodeCallback(node.UUID, node.Type, node.IP, node.Port)
 	
+	# Merged joins and leaves, passed to the single event callbacks.
+	def MasterNodesDeltaHandler(self, sock, packet):
+		for event in MkSMessages.NodesDelta.FromPacket(packet).GetEvents():
+			node = event.Node
+			if "master_append_node" == event.Command:
+				if self.OnMasterAppendNodeCallback is not None:
+					self.OnMasterAppendNodeCallback(node.UUID, node.Type, node.IP, node.Port)
+			elif self.OnMasterRemoveNodeCallback is not None:
+				self.OnMasterRemoveNodeCallback(node.UUID, node.Type, node.IP, node.Port)
+
 	def GetNodesListHandler(self, sock, packet):
 		if self.OnGetNodesListCallback is not None:
 			self.OnGetNodesListCallback(packet["payload"]["data"])
@@ -109,7 +139,6 @@ class SlaveNode(MkSAbstractNode.AbstractNode):
 	def GetFileHandler(self, sock, packet):
 		print ("[SlaveNode] GetFileHandler")
 
-		objFile 	= MkSFile.File()
 		uiType 		= packet["payload"]["data"]["ui_type"]
 		fileType 	= packet["payload"]["data"]["file_type"]
 		fileName 	= packet["payload"]["data"]["file_name"]
@@ -122,20 +151,35 @@ class SlaveNode(MkSAbstractNode.AbstractNode):
 
 		path = os.path.join(".","ui",folder[uiType],"ui." + fileType)
 		print (path)
-		content = objFile.LoadStateFromFile(path)
-		
+		replacements = []
 		if ("html" in fileType):
-			content = content.replace("[NODE_UUID]", self.UUID)
-			content = content.replace("[GATEWAY_IP]", self.GatewayIP)
+			replacements = [("[NODE_UUID]", self.UUID), ("[GATEWAY_IP]", self.GatewayIP)]
+
+		# Binary connection takes file bytes as is, JSON needs hex.
+		encoding 	= "hex"
+		conn 		= self.GetConnection(self.MasterSocket)
+		if conn is not None and conn.Protocol == "binary":
+			encoding = "raw"
+			if self.CompressFileContent is True:
+				encoding = "zlib"
+
+		if self.Executor is not None:
+			content, encoding = self.Executor.Run(MkSFile.LoadUIFileContent, path, replacements, encoding)
+		else:
+			content, encoding = MkSFile.LoadUIFileContent(path, replacements, encoding)
 		
 		payload = {
 			'file_type': fileType,
 			'ui_type': uiType,
-			'content': content.encode('hex')
+			'content': content
 		}
 		
-		msg = self.Commands.ProxyResponse(packet, payload)
-		self.MasterSocket.send(msg)
+		if "hex" == encoding:
+			msg = self.Commands.ProxyResponseSegments(packet, payload)
+		else:
+			payload['content'] = ""
+			msg = MkSBinaryProtocol.AttachmentSegments(self.Commands.GenerateProxyResponse(packet, payload), ["payload", "data", "content"], content, encoding)
+		self.SendData(self.MasterSocket, msg)
 
 	# GET_NODE_INFO
 	def GetNodeInfoRequestHandler(self, sock, packet):
@@ -172,29 +216,48 @@ class SlaveNode(MkSAbstractNode.AbstractNode):
 	Local Face RESP API methods
 	"""
 	def SendSensorInfoChange(self, sensors):
-		json = self.Commands.GenerateJsonProxyRequest(self.UUID, "WEBFACE", "get_sensor_info", {})
+		self.SensorBatcher.Add(sensors)
+
+	def SendSensorInfoBatch(self, sensors):
+		if self.MasterSocket is None:
+			return
+		json = self.Commands.GenerateJsonProxyRequest(self.UUID, "WEBFACE", "get_sensor_info", {}, 0)
 		msg  = self.Commands.ProxyResponse(json, sensors)
-		self.MasterSocket.send(msg)
+		self.SendData(self.MasterSocket, msg)
+
+	# Window 0 sends every change right away.
+	def SetSensorBatching(self, window, max_sensors=64):
+		self.SensorBatcher.Flush()
+		self.SensorBatcher.Window 		= window
+		self.SensorBatcher.MaxSensors 	= max_sensors
+
+	def GetSensorBatchStatistics(self):
+		return self.SensorBatcher.GetStatistics()
 
 	def SendGatewayPing(self):
 		print ("[SlaveNode] SendGatewayPing")
 		# payload = self.Commands.SendPingRequest("GATEWAY", self.UUID)
 		# self.MasterSocket.send(payload)
 	
-	def GetListOfNodeFromGateway(self):
+	# Requests via Gateway return a RequestFuture (MkSPendingRequests), response
+	# callbacks (OnGetNodesListCallback, OnGetNodeInfoCallback, ...) are still called.
+	def GetListOfNodeFromGateway(self, timeout=None):
 		print ("[SlaveNode] GetListOfNodeFromGateway")
-		payload = self.Commands.SendListOfNodesRequest("GATEWAY", self.UUID)
-		self.MasterSocket.send(payload)
+		request = self.PendingRequests.NewRequest(self.MasterSocket, timeout)
+		payload = self.Commands.SendListOfNodesRequest("GATEWAY", self.UUID, request.ID)
+		return self.SendRequest(self.MasterSocket, request, payload)
 	
-	def GetNodeInfo(self, uuid):
+	def GetNodeInfo(self, uuid, timeout=None):
 		print ("[SlaveNode] GetNodeInfo")
-		payload = self.Commands.NodeInfoRequest(uuid, self.UUID)
-		self.MasterSocket.send(payload)
+		request = self.PendingRequests.NewRequest(self.MasterSocket, timeout)
+		payload = self.Commands.NodeInfoRequest(uuid, self.UUID, request.ID)
+		return self.SendRequest(self.MasterSocket, request, payload)
 	
-	def SendMessageToNodeViaGateway(self, uuid, message_type, data):
+	def SendMessageToNodeViaGateway(self, uuid, message_type, data, timeout=None):
 		print ("[SlaveNode] SendMessageToNodeViaGateway")
-		payload = self.Commands.SendMessageToNodeViaGatewayRequest(message_type, uuid, self.UUID, data)
-		self.MasterSocket.send(payload)
+		request = self.PendingRequests.NewRequest(self.MasterSocket, timeout)
+		payload = self.Commands.SendMessageToNodeViaGatewayRequest(message_type, uuid, self.UUID, data, request.ID)
+		return self.SendRequest(self.MasterSocket, request, payload)
 
 	def CleanMasterList(self):
 		for node in self.MasterNodesList:
@@ -218,11 +281,16 @@ class SlaveNode(MkSAbstractNode.AbstractNode):
 		self.UI.AddEndpoint("/get/node_widget/<key>",		"get_node_widget",	self.GetNodeWidgetHandler)
 		self.UI.AddEndpoint("/get/node_config/<key>",		"get_node_config",	self.GetNodeConfigHandler)
 
-	def ConnectMaster(self):
-		sock, status = self.ConnectNodeSocket((self.MyLocalIP, 16999))
+	def ConnectLocalMaster(self):
+		if self.IsConnectingMaster is True:
+			return
+		self.IsConnectingMaster = True
+		self.StartConnectMaster(self.MyLocalIP, self.LocalMasterConnectedHandler)
+
+	def LocalMasterConnectedHandler(self, sock, status):
+		self.IsConnectingMaster = False
 		if status is True:
-			node = self.AppendConnection(sock, self.MyLocalIP, 16999)
-			node.LocalType = "MASTER"
+			node = self.GetConnection(sock)
 			self.ChangeState("GET_PORT")
 			self.MasterNodesList.append(node)
 			if self.OnMasterFoundCallback is not None:
@@ -230,27 +298,30 @@ class SlaveNode(MkSAbstractNode.AbstractNode):
 			# Save socket as master socket
 			self.MasterSocket = sock
 		else:
+			# Retry is done by CONNECT_MASTER state timer.
 			self.ChangeState("CONNECT_MASTER")
-			time.sleep(5)
 
 	def StateIdle(self):
 		# Init state logic must be here.
 		print ("StateIdle")
-		self.ConnectMaster()
+		self.ConnectLocalMaster()
 
 	def StateConnectMaster(self):
+		pass
+
+	def ConnectMasterTimerHandler(self):
 		print ("StateConnectMaster")
-		if 0 == self.Ticker % 20:
-			if self.MasterConnectionTries > 3:
-				self.ChangeState("EXIT")
+		if self.MasterConnectionTries > 3:
+			self.ChangeState("EXIT")
+			return
 
-			self.ConnectMaster()
-			self.MasterConnectionTries += 1
+		self.MasterConnectionTries += 1
+		self.ConnectLocalMaster()
 
 	def StateGetPort(self):
 		print ("StateGetPort")
 		payload = self.Commands.GetPortRequest(self.UUID, self.Type, self.Name)
-		self.MasterSocket.send(payload)
+		self.SendData(self.MasterSocket, payload)
 		self.ChangeState("WAIT_FOR_PORT")
 	
 	def SendCustomCommandResponse(self, sock, packet, payload):
@@ -258,7 +329,7 @@ class SlaveNode(MkSAbstractNode.AbstractNode):
 		if ("proxy" in direction):
 			print (" P R O X Y ")
 			msg = self.Commands.ProxyResponse(packet, payload)
-			sock.send(msg)
+			self.SendData(sock, msg)
 		else:
 			print (" R E G U L A R")
 
@@ -267,7 +338,7 @@ class SlaveNode(MkSAbstractNode.AbstractNode):
 		if ("proxy" in direction):
 			print (" P R O X Y ")
 			msg = self.Commands.ProxyResponse(packet, sensors)
-			sock.send(msg)
+			self.SendData(sock, msg)
 		else:
 			print (" R E G U L A R")
 
@@ -275,12 +346,14 @@ class SlaveNode(MkSAbstractNode.AbstractNode):
 		#sock.send(payload)
 
 	def StateWaitForPort(self):
+		pass
+
+	def WaitForPortTimerHandler(self):
 		print ("StateWaitForPort")
-		if 0 == self.Ticker % 20:
-			if 0 == self.SlaveListenerPort:
-				self.ChangeState("GET_PORT")
-			else:
-				self.ChangeState("START_LISTENER")
+		if 0 == self.SlaveListenerPort:
+			self.ChangeState("GET_PORT")
+		else:
+			self.ChangeState("START_LISTENER")
 
 	def StateStartListener(self):
 		print ("StateStartListener")
@@ -291,8 +364,7 @@ class SlaveNode(MkSAbstractNode.AbstractNode):
 			self.ChangeState("WORKING")
 
 	def StateWorking(self):
-		if 0 == self.Ticker % 30:
-			self.SendGatewayPing()
+		pass
 
 	def StateExit(self):
 		print ("StateExit")
@@ -319,16 +391,6 @@ class SlaveNode(MkSAbstractNode.AbstractNode):
 			if self.OnCustomCommandResponseCallback is not None:
 				self.OnCustomCommandResponseCallback(sock, json_data)
 
-	# TODO - Master and Slave have same HandleRouter, consider moving to abstruct class
-	def HandlerRouter(self, sock, data):
-		jsonData 	= json.loads(data)
-		direction 	= jsonData['direction']
-
-		if direction in ["response", "proxy_response"]:
-			self.HandlerRouter_Response(sock, jsonData)
-		elif direction in ["request", "proxy_request"]:
-			self.HandlerRouter_Request(sock, jsonData)
-
 	def NodeDisconnectHandler(self, sock):
 		print ("NodeDisconnectHandler")
 		# Check if disconneced connection is a master.
@@ -348,7 +410,7 @@ class SlaveNode(MkSAbstractNode.AbstractNode):
 		self.MasterNodesList.append(conn)
 		# Get Master slave nodes.
 		packet = self.CommandsGetLocalNodes()
-		sock.send(packet)
+		self.SendData(sock, packet)
 
 	# RESPONSE Handlers >
 
@@ -365,7 +427,7 @@ class SlaveNode(MkSAbstractNode.AbstractNode):
 		pass
 
 	def GetPortResponseHandler(self, sock, packet):
-		self.SlaveListenerPort = packet["port"]
+		self.SlaveListenerPort = MkSMessages.PortResponse.FromPacket(packet).Port
 		self.ChangeState("START_LISTENER")
 		# Raise event
 
@@ -397,5 +459,5 @@ class SlaveNode(MkSAbstractNode.AbstractNode):
 		if self.OnExitCallback is not None:
 			self.OnExitCallback()
 			packet = self.Commands.ExitResponse("OK")
-			sock.send(packet)
+			self.SendData(sock, packet)
 			
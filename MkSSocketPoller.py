@@ -0,0 +1,154 @@
+#!/usr/bin/python
+import os
+import sys
+import time
+import select
+import socket
+try:
+	import selectors
+except ImportError:
+	selectors = None
+
+class Waker():
+	"""Socket pair, registered in a SocketPoller to wake Poll() from another
+	thread. Sockets work with select() on Windows too, pipes don't."""
+
+	def __init__(self):
+		self.Reader, self.Writer = socket.socketpair()
+		self.Reader.setblocking(False)
+		self.Writer.setblocking(False)
+
+	def fileno(self):
+		return self.Reader.fileno()
+
+	def Notify(self):
+		try:
+			self.Writer.send(b"x")
+		except socket.error:
+			# Buffer is full, poller is already woken up.
+			pass
+
+	def Drain(self):
+		try:
+			while self.Reader.recv(4096):
+				pass
+		except socket.error:
+			pass
+
+	def Close(self):
+		self.Reader.close()
+		self.Writer.close()
+
+class SocketPoller():
+	"""Readiness notification for the node sockets.
+
+	Sockets are registered once and only ready ones are returned by Poll().
+	Uses selectors (epoll on Linux) when available, on Python 2 falls back to
+	select.epoll and at last to select.select.
+	"""
+
+	def __init__(self):
+		self.Selector 	= None
+		self.Epoll 		= None
+		self.Sockets 	= {} # fileno -> [sock, read, write]
+		if selectors is not None:
+			self.Selector = selectors.DefaultSelector()
+		elif hasattr(select, "epoll"):
+			self.Epoll = select.epoll()
+
+	def GetEpollMask(self, read, write):
+		mask = 0
+		if read is True:
+			mask |= select.EPOLLIN
+		if write is True:
+			mask |= select.EPOLLOUT
+		return mask
+
+	def GetSelectorMask(self, read, write):
+		mask = 0
+		if read is True:
+			mask |= selectors.EVENT_READ
+		if write is True:
+			mask |= selectors.EVENT_WRITE
+		return mask
+
+	def Register(self, sock, read=True, write=False):
+		fd = sock.fileno()
+		self.Sockets[fd] = [sock, read, write]
+		if self.Selector is not None:
+			mask = self.GetSelectorMask(read, write)
+			if mask:
+				self.Selector.register(sock, mask)
+		elif self.Epoll is not None:
+			self.Epoll.register(fd, self.GetEpollMask(read, write))
+
+	def Modify(self, sock, read, write):
+		fd = sock.fileno()
+		item = self.Sockets.get(fd)
+		if item is None:
+			return
+		if item[1] == read and item[2] == write:
+			return
+		wasActive = item[1] or item[2]
+		item[1] = read
+		item[2] = write
+		if self.Selector is not None:
+			mask = self.GetSelectorMask(read, write)
+			if mask and wasActive:
+				self.Selector.modify(sock, mask)
+			elif mask:
+				self.Selector.register(sock, mask)
+			elif wasActive:
+				self.Selector.unregister(sock)
+		elif self.Epoll is not None:
+			self.Epoll.modify(fd, self.GetEpollMask(read, write))
+
+	def Unregister(self, sock):
+		fd = sock.fileno()
+		item = self.Sockets.pop(fd, None)
+		if item is None:
+			return
+		if self.Selector is not None:
+			if item[1] or item[2]:
+				self.Selector.unregister(sock)
+		elif self.Epoll is not None:
+			self.Epoll.unregister(fd)
+
+	def IsRegistered(self, sock):
+		return sock.fileno() in self.Sockets
+
+	def Poll(self, timeout):
+		readable = []
+		writable = []
+		if self.Selector is not None:
+			for key, events in self.Selector.select(timeout):
+				if events & selectors.EVENT_READ:
+					readable.append(key.fileobj)
+				if events & selectors.EVENT_WRITE:
+					writable.append(key.fileobj)
+		elif self.Epoll is not None:
+			if timeout is None:
+				timeout = -1
+			for fd, events in self.Epoll.poll(timeout):
+				item = self.Sockets.get(fd)
+				if item is None:
+					continue
+				if events & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+					readable.append(item[0])
+				if events & select.EPOLLOUT:
+					writable.append(item[0])
+		else:
+			readers = [item[0] for item in self.Sockets.values() if item[1] is True]
+			writers = [item[0] for item in self.Sockets.values() if item[2] is True]
+			if readers or writers:
+				readable, writable, exceptional = select.select(readers, writers, [], timeout)
+			elif timeout is not None:
+				time.sleep(timeout)
+		return readable, writable
+
+	def Close(self):
+		if self.Selector is not None:
+			self.Selector.close()
+		elif self.Epoll is not None:
+			self.Epoll.close()
+		self.Sockets = {}
@@ -0,0 +1,254 @@
+#!/usr/bin/python
+import os
+import sys
+import errno
+import socket
+import struct
+import threading
+from collections import deque
+from itertools import islice
+
+from mksdk import MkSBinaryProtocol
+
+MKS_MAGIC 	= b"MKS: "
+MKS_EOL 	= b"\n"
+MKB_MAGIC 	= MkSBinaryProtocol.MKB_MAGIC
+MKB_LENGTH 	= struct.Struct("!I") # Body length at offset 7 of binary header
+MAX_SEGMENTS 	= 64 # Buffers per sendmsg() call, far below IOV_MAX
+
+class StreamReassembler():
+	"""Per connection reassembly buffer for MKS frames.
+
+	A frame on the wire is "MKS: <header>\\n<body>\\n". TCP gives no guarantee
+	about segment boundaries, so one recv() may hold half a frame or several
+	frames. Data is appended to a single bytearray and complete frames are
+	sliced out of it, partial frames stay in the buffer until the rest arrives.
+	Binary frames ("MKB" header with body length) are returned whole, header
+	included, text frames are returned as body only.
+	"""
+
+	def __init__(self, max_frame_size=16 * 1024 * 1024):
+		self.Buffer 			= bytearray()
+		self.MaxFrameSize		= max_frame_size
+		# Parser position (all offsets are absolute in self.Buffer)
+		self.Offset 			= 0		# Start of unconsumed data
+		self.BodyStart			= -1	# Body start of the frame being collected
+		self.ScanFrom			= 0		# Where to continue looking for the body EOL
+		# Statistics
+		self.FramesCount 		= 0
+		self.DroppedBytes 		= 0
+
+	def Feed(self, data):
+		self.Buffer.extend(data)
+
+	def GetFrames(self):
+		frames 	= []
+		buf 	= self.Buffer
+		size 	= len(buf)
+
+		while self.Offset < size:
+			if self.BodyStart < 0:
+				if buf.startswith(MKB_MAGIC, self.Offset):
+					if size - self.Offset < MkSBinaryProtocol.HEADER_SIZE:
+						break
+					end = self.Offset + MkSBinaryProtocol.HEADER_SIZE + MKB_LENGTH.unpack_from(buf, self.Offset + 7)[0]
+					if end > size:
+						if end - self.Offset > self.MaxFrameSize:
+							print ("[StreamReassembler] Frame too big, dropping", end - self.Offset)
+							self.DroppedBytes 	+= size - self.Offset
+							self.Offset 		= size
+						break
+					frames.append(memoryview(buf)[self.Offset:end].tobytes())
+					self.FramesCount 	+= 1
+					self.Offset 		= end
+					continue
+
+				start = self.Offset
+				if buf.startswith(MKS_MAGIC, start) is False:
+					start = self.FindMagic(buf, start)
+				if start < 0:
+					# Keep a tail that may be the beginning of a magic.
+					keep = max(self.Offset, size - len(MKS_MAGIC) + 1)
+					self.DroppedBytes += keep - self.Offset
+					self.Offset = keep
+					break
+				if start != self.Offset:
+					# Garbage between frames.
+					self.DroppedBytes += start - self.Offset
+					self.Offset = start
+					continue
+				headerEnd = buf.find(MKS_EOL, start + len(MKS_MAGIC))
+				if headerEnd < 0:
+					if size - self.Offset > self.MaxFrameSize:
+						# Header without EOL, the peer is not sending MKS frames.
+						print ("[StreamReassembler] Header too big, dropping", size - self.Offset)
+						self.DroppedBytes 	+= size - self.Offset
+						self.Offset 		= size
+					break
+				self.BodyStart 	= headerEnd + 1
+				self.ScanFrom 	= self.BodyStart
+
+			bodyEnd = buf.find(MKS_EOL, self.ScanFrom)
+			if bodyEnd < 0:
+				# Do not rescan what we already looked at on next feed.
+				self.ScanFrom = size
+				if size - self.Offset > self.MaxFrameSize:
+					print ("[StreamReassembler] Frame too big, dropping", size - self.Offset)
+					self.DroppedBytes += size - self.Offset
+					self.Offset 	= size
+					self.BodyStart 	= -1
+				break
+
+			frames.append(memoryview(buf)[self.BodyStart:bodyEnd].tobytes())
+			self.FramesCount 	+= 1
+			self.Offset 		= bodyEnd + 1
+			self.BodyStart 		= -1
+
+		self.Compact()
+		return frames
+
+	def FindMagic(self, buf, start):
+		text 	= buf.find(MKS_MAGIC, start)
+		binary 	= buf.find(MKB_MAGIC, start)
+		if text < 0 or (binary >= 0 and binary < text):
+			return binary
+		return text
+
+	def Compact(self):
+		# Drop consumed bytes. Done lazily so big frames are not moved around
+		# on every recv().
+		if self.Offset == 0:
+			return
+		if self.Offset == len(self.Buffer) or self.Offset > 65536:
+			shift = self.Offset
+			del self.Buffer[:shift]
+			self.Offset = 0
+			if self.BodyStart >= 0:
+				self.BodyStart 	-= shift
+				self.ScanFrom 	-= shift
+
+	def GetBufferedSize(self):
+		return len(self.Buffer) - self.Offset
+
+	def Clear(self):
+		self.Buffer 	= bytearray()
+		self.Offset 	= 0
+		self.BodyStart 	= -1
+		self.ScanFrom 	= 0
+
+class OutboundQueue():
+	"""Per connection queue of outgoing data.
+
+	Data is queued and written as much as the socket accepts, the rest is sent
+	when the socket becomes writable again. A frame can be queued as a list of
+	segments, they are written with one sendmsg() call and a partial write
+	only moves an offset, payload bytes are not copied. Above the high watermark the
+	connection is congested until the queue drains below the low watermark,
+the node does not relay droppable traffic (proxy requests) to it meanwhile.
+	Data that would grow the queue above max_size is refused and the queue is
+	marked overflow, the owner drops the connection. Clear() resets it.
+	"""
+
+	def __init__(self, high_watermark=1024 * 1024, low_watermark=256 * 1024, max_size=16 * 1024 * 1024):
+		self.Chunks 		= deque()
+		self.Offset 		= 0 # Bytes of first chunk already sent
+		self.Size 			= 0 # Bytes waiting to be sent
+		self.HighWatermark 	= high_watermark
+		self.LowWatermark 	= low_watermark
+		self.MaxSize 		= max_size
+		self.IsCongested 	= False
+		self.IsOverflow 	= False
+		self.IsGather 		= True
+		self.Lock 			= threading.Lock()
+		# Statistics
+		self.SentBytes 		= 0
+
+	# Data is bytes/str or a list of segments of one frame (header, body, ...),
+	# segments are queued as they are and never joined.
+	def Push(self, data):
+		if isinstance(data, (list, tuple)):
+			segments = data
+		else:
+			segments = [data]
+		chunks 	= []
+		size 	= 0
+		for segment in segments:
+			if not isinstance(segment, (bytes, bytearray, memoryview)):
+				segment = segment.encode('utf-8')
+			if len(segment) > 0:
+				chunks.append(segment)
+				size += len(segment)
+		if 0 == size:
+			return True
+		self.Lock.acquire()
+		try:
+			if self.Size + size > self.MaxSize:
+				# Peer does not read, connection should be dropped.
+				self.IsOverflow = True
+				return False
+			self.Chunks.extend(chunks)
+			self.Size += size
+			if self.Size > self.HighWatermark:
+				self.IsCongested = True
+		finally:
+			self.Lock.release()
+		return True
+
+	# Send queued segments with one sendmsg() call (send() per segment where
+	# sendmsg is missing). Return number of bytes the socket took.
+	def SendSegments(self, sock):
+		if self.IsGather is True:
+			buffers = [memoryview(chunk) for chunk in islice(self.Chunks, 0, MAX_SEGMENTS)]
+			buffers[0] = buffers[0][self.Offset:]
+			try:
+				return sock.sendmsg(buffers), sum(len(buffer) for buffer in buffers)
+			except (AttributeError, NotImplementedError):
+				# Python 2 and SSL sockets.
+				self.IsGather = False
+		buffer = memoryview(self.Chunks[0])[self.Offset:]
+		return sock.send(buffer), len(buffer)
+
+	# Write as much as possible without blocking. Return True if queue is empty.
+	def Flush(self, sock):
+		self.Lock.acquire()
+		try:
+			while self.Chunks:
+				try:
+					sent, size = self.SendSegments(sock)
+				except socket.error as e:
+					if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+						break
+					raise
+				self.Size 		-= sent
+				self.SentBytes 	+= sent
+				# Drop fully sent segments, keep offset into the partial one.
+				offset = self.Offset + sent
+				while self.Chunks and offset >= len(self.Chunks[0]):
+					offset -= len(self.Chunks.popleft())
+				self.Offset = offset
+				if sent < size:
+					# Socket buffer is full.
+					break
+
+			if self.IsCongested is True and self.Size <= self.LowWatermark:
+				self.IsCongested = False
+			return 0 == self.Size
+		finally:
+			self.Lock.release()
+
+	def GetQueueDepth(self):
+		return self.Size
+
+	def IsEmpty(self):
+		return 0 == self.Size
+
+	def Clear(self):
+		self.Lock.acquire()
+		try:
+			self.Chunks.clear()
+			self.Offset 		= 0
+			self.Size 			= 0
+			self.IsCongested 	= False
+			self.IsOverflow 	= False
+		finally:
+			self.Lock.release()
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+import os
+import sys
+import time
+import heapq
+import threading
+
+if hasattr(time, "monotonic"):
+	GetTime = time.monotonic
+else:
+	GetTime = time.time
+
+class Timer():
+	def __init__(self, timer_id, deadline, interval, callback, repeat):
+		self.ID 		= timer_id
+		self.Deadline 	= deadline
+		self.Interval 	= interval
+		self.Callback 	= callback
+		self.Repeat 	= repeat
+		self.Cancelled 	= False
+
+class TimerScheduler():
+	"""Real time timers for the node loop.
+
+	Timers are kept in a heap ordered by deadline. The loop asks GetTimeout()
+	how long it may sleep in I/O wait and calls RunExpired() after waking up,
+	so periodic work runs on wall clock time and not per loop iteration.
+	A timer added from another thread that is due before the loop wakes up
+	calls the wakeup set by SetWakeup().
+	"""
+
+	def __init__(self):
+		self.Heap 		= []
+		self.Timers 	= {}
+		self.NextID 	= 0
+		self.Lock 		= threading.Lock()
+		self.Wakeup 	= None
+		self.LoopThread = None
+
+	# Called by the loop thread, wakeup() must interrupt its I/O wait.
+	def SetWakeup(self, wakeup):
+		self.Wakeup 	= wakeup
+		self.LoopThread = threading.current_thread()
+
+	def AddTimer(self, interval, callback, repeat=True, delay=None):
+		if delay is None:
+			delay = interval
+		self.Lock.acquire()
+		try:
+			self.NextID += 1
+			timer = Timer(self.NextID, GetTime() + delay, interval, callback, repeat)
+			self.Timers[timer.ID] = timer
+			# Sequence number keeps heap order stable for equal deadlines.
+			heapq.heappush(self.Heap, (timer.Deadline, timer.ID, timer))
+			earliest = self.Heap[0][2] is timer
+		finally:
+			self.Lock.release()
+		if earliest is True and self.Wakeup is not None and threading.current_thread() is not self.LoopThread:
+			# Loop may sleep past the new deadline.
+			self.Wakeup()
+		return timer.ID
+
+	def RemoveTimer(self, timer_id):
+		self.Lock.acquire()
+		try:
+			timer = self.Timers.pop(timer_id, None)
+			if timer is not None:
+				# Lazy removal, dropped when it reaches the heap top.
+				timer.Cancelled = True
+		finally:
+			self.Lock.release()
+
+	def GetTimeout(self, max_timeout=None):
+		self.Lock.acquire()
+		try:
+			while self.Heap and self.Heap[0][2].Cancelled is True:
+				heapq.heappop(self.Heap)
+			if not self.Heap:
+				return max_timeout
+			timeout = max(0, self.Heap[0][0] - GetTime())
+		finally:
+			self.Lock.release()
+		if max_timeout is not None:
+			timeout = min(timeout, max_timeout)
+		return timeout
+
+	def RunExpired(self):
+		now 	= GetTime()
+		expired = []
+		self.Lock.acquire()
+		try:
+			while self.Heap and self.Heap[0][0] <= now:
+				deadline, timer_id, timer = heapq.heappop(self.Heap)
+				if timer.Cancelled is True:
+					continue
+				expired.append(timer)
+				if timer.Repeat is True:
+					# Next deadline from the previous one (no drift), skip missed periods.
+					timer.Deadline = deadline + timer.Interval
+					if timer.Deadline <= now:
+						timer.Deadline = now + timer.Interval
+					heapq.heappush(self.Heap, (timer.Deadline, timer.ID, timer))
+				else:
+					del self.Timers[timer.ID]
+		finally:
+			self.Lock.release()
+
+		# Callbacks run without the lock, they may add or remove timers.
+		for timer in expired:
+			if timer.Cancelled is True:
+				continue
+			try:
+				timer.Callback()
+			except Exception as e:
+				print ("[TimerScheduler] Timer callback ERROR", e)
+		return len(expired)
+
+	def Clear(self):
+		self.Lock.acquire()
+		try:
+			self.Heap 	= []
+			self.Timers = {}
+		finally:
+			self.Lock.release()
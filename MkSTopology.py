@@ -0,0 +1,154 @@
+#!/usr/bin/python
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+from mksdk import MkSMessages
+
+class TopologyDeltaBatcher():
+	"""Merge bursts of slave joins and leaves into one topology message.
+
+	Events are collected for a window and broadcast as one master_nodes_delta
+	message (removed nodes first, then appended). A node that joins and leaves
+	on the same port within the window is never announced. A window with a single event is
+	sent as the classic master_append_node or master_remove_node message.
+	"""
+
+	def __init__(self, broadcast, timers, window=0.2):
+		self.Broadcast 		= broadcast # broadcast(frame)
+		self.Timers 		= timers
+		self.Window 		= window
+		self.Appended 		= OrderedDict() # UUID -> NodeItem
+		self.Removed 		= OrderedDict() # UUID -> NodeItem
+		self.TimerID 		= None
+		self.Lock 			= threading.Lock()
+		# Statistics
+		self.EventsCount 	= 0
+		self.FlushesCount 	= 0
+
+	def Append(self, node):
+		self.Add(node, True)
+
+	def Remove(self, node):
+		self.Add(node, False)
+
+	def Add(self, node, is_append):
+		self.Lock.acquire()
+		try:
+			self.EventsCount += 1
+			if is_append is True:
+				self.Appended[node.UUID] = node
+			else:
+				appended = self.Appended.get(node.UUID)
+				if appended is not None and appended.Port == node.Port:
+					# Joined and left in this window, nobody saw it.
+					del self.Appended[node.UUID]
+				else:
+					# A pending join on another port (stale socket of a reconnected
+					# slave closed) stays, it is sent after the removal.
+					self.Removed[node.UUID] = node
+			if self.Window <= 0:
+				flush = True
+			else:
+				flush = False
+				if self.TimerID is None:
+					self.TimerID = self.Timers.AddTimer(self.Window, self.Flush, repeat=False)
+		finally:
+			self.Lock.release()
+		if flush is True:
+			self.Flush()
+
+	def Flush(self):
+		self.Lock.acquire()
+		try:
+			if self.TimerID is not None:
+				self.Timers.RemoveTimer(self.TimerID)
+				self.TimerID = None
+			removed 		= list(self.Removed.values())
+			appended 		= list(self.Appended.values())
+			self.Removed 	= OrderedDict()
+			self.Appended 	= OrderedDict()
+		finally:
+			self.Lock.release()
+
+		if 0 == len(removed) + len(appended):
+			return
+		if 1 == len(appended) and not removed:
+			message = MkSMessages.NodeEvent("master_append_node", appended[0])
+		elif 1 == len(removed) and not appended:
+			message = MkSMessages.NodeEvent("master_remove_node", removed[0])
+		else:
+			message = MkSMessages.NodesDelta(removed, appended)
+		self.FlushesCount += 1
+		self.Broadcast(message.Encode())
+
+class TopologySnapshot():
+	"""Serialized topology of a master with a version number.
+
+	Responses to get_local_nodes and get_master_info are encoded once and
+	reused until Invalidate() is called on slave append or remove, which also
+	moves the version. A client that sends the version it already has gets a
+	small not_modified reply instead of the node list.
+	"""
+
+	def __init__(self, get_nodes):
+		self.GetNodes 			= get_nodes # get_nodes() -> list of MkSMessages.NodeItem
+		self.Version 			= 1
+		self.Frames 			= {} # Command -> encoded response of this version
+		self.Lock 				= threading.Lock()
+		# Statistics
+		self.BuildsCount 		= 0
+		self.HitsCount 			= 0
+		self.NotModifiedCount 	= 0
+
+	def Invalidate(self):
+		self.Lock.acquire()
+		try:
+			# Positive int32, 0 means "client has no version".
+			self.Version 	= (self.Version % 0x7FFFFFFF) + 1
+			self.Frames 	= {}
+		finally:
+			self.Lock.release()
+
+	def GetVersion(self):
+		return self.Version
+
+	def Get(self, command, build, known_version):
+		self.Lock.acquire()
+		try:
+			version = self.Version
+			if known_version == version:
+				self.NotModifiedCount += 1
+				key 	= "not_modified:" + command
+				frame 	= self.Frames.get(key)
+				if frame is None:
+					frame = MkSMessages.TopologyNotModified(command, version).Encode()
+					self.Frames[key] = frame
+				return frame
+			frame = self.Frames.get(command)
+			if frame is not None:
+				self.HitsCount += 1
+				return frame
+		finally:
+			self.Lock.release()
+
+		frame = build(version)
+		self.Lock.acquire()
+		try:
+			self.BuildsCount += 1
+			# Topology may have changed while building, keep only a current frame.
+			if version == self.Version:
+				self.Frames[command] = frame
+		finally:
+			self.Lock.release()
+		return frame
+
+	def LocalNodesResponse(self, known_version=0):
+		return self.Get("get_local_nodes", lambda version: MkSMessages.LocalNodesResponse(self.GetNodes(), version).Encode(), known_version)
+
+	def SubscribeResponse(self):
+		return self.Get("topology_subscribe", lambda version: MkSMessages.TopologySubscribeResponse(self.GetNodes(), version).Encode(), 0)
+
+	def MasterInfoResponse(self, host_name, uuid, known_version=0):
+		return self.Get("get_master_info", lambda version: MkSMessages.MasterInfoResponse(host_name, uuid, self.GetNodes(), version).Encode(), known_version)